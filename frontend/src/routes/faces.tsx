@@ -11,6 +11,12 @@ export const FacesRoute = () => {
   const clusters = useLoaderData() as any
   const [selected, setSelected] = React.useState<any>(null)
   const [cluster, setCluster] = React.useState<any>(null)
+  const loadMoreFaces = () => {
+    fetch(`/api/face-clusters/${encodeURIComponent(cluster.id)}?offset=${cluster.next_offset}`)
+      .then(r => r.json())
+      .then(r => setCluster({...cluster, faces: [...cluster.faces, ...r.faces], next_offset: r.next_offset}))
+  }
+
   React.useEffect(() => {
     if (selected) {
       fetch(`/api/face-clusters/${encodeURIComponent(selected.id)}`)
@@ -52,7 +58,7 @@ export const FacesRoute = () => {
               <RootLink search={{tag: `face:${cluster.id}`}}>View in search</RootLink>
             </p>
 
-            <SetLabelForm faceCluster={cluster} onUpdate={(c: any) => setCluster(c) /* TODO: update list */} />
+            <SetLabelForm faceCluster={cluster} onUpdate={(c: any) => setCluster({...cluster, label: c.label, wikidata_qid: c.wikidata_qid}) /* TODO: update list */} />
 
             <div className="d-flex flex-wrap">
               {cluster.faces.map(({image_id, face}: any) => {
@@ -65,6 +71,9 @@ export const FacesRoute = () => {
                 )
               })}
             </div>
+            {cluster.next_offset != null && (
+              <button type="button" className="btn btn-secondary" onClick={loadMoreFaces}>Load more</button>
+            )}
           </div>
         )}
       </div>
@@ -91,7 +91,7 @@ function DetailOverlaySidebar({
       .then(r => setAutotags(r))
   }, [selectedImage.id])
 
-  const allTags = (selectedImage.manual_tags?.map((it: any) => ({...it, is_manual: true})) ?? []).concat(selectedImage.tags ?? [])
+  const allTags = (selectedImage.manual_tags?.map((it: any) => ({...it, is_manual: true})) ?? []).concat(selectedImage.tags ?? [], selectedImage.custom_tags ?? [])
 
   const [recentTags, addRecentTag] = useRecentlyAddedManualTags()
   const addCharacterTag = (name: string) => {
@@ -9,11 +9,11 @@ export const searchResultLoader: LoaderFunction = async ({ request }) => {
   const url = new URL(request.url)
   const root = extractRootSearchParams(url.searchParams)
   const tag = applyQuickFilters(root.tag, root)
-  const {page} = extractIndexSearchParams(url.searchParams)
+  const {page, cursor} = extractIndexSearchParams(url.searchParams)
   return {
     images: await (await fetch('/api/images?' + new URLSearchParams({
       ...(tag && {tag}),
-      ...(page && {page: String(page)}),
+      ...(cursor ? {cursor} : page && {page: String(page)}),
       ...(root.sort && {sort: root.sort}),
     }))).json()
   }
@@ -81,13 +81,13 @@ export function SearchResultRoute() {
       <ul className="pagination justify-content-center">
         {page > 1 && (
           <li className="page-item">
-            <RootLink className="page-link" search={search} indexParams={{page: page - 1}}>&larr; prev</RootLink>
+            <RootLink className="page-link" search={search} indexParams={{page: page - 1, cursor: page > 2 ? images.prev_cursor : undefined}}>&larr; prev</RootLink>
           </li>
         )}
         
         {images.has_next_page && (
           <li className="page-item">
-            <RootLink className="page-link" search={search} indexParams={{page: page + 1}}>next &rarr;</RootLink>
+            <RootLink className="page-link" search={search} indexParams={{page: page + 1, cursor: images.next_cursor}}>next &rarr;</RootLink>
           </li>
         )}
       </ul>
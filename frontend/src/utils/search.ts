@@ -19,12 +19,14 @@ export function extractRootSearchParams(searchParams: URLSearchParams): RootSear
 
 export type IndexSearchParams = {
   page?: number
+  cursor?: string
 }
 
 export function extractIndexSearchParams(searchParams: URLSearchParams): IndexSearchParams {
   const pageParam = searchParams.get('page')
   return {
     page: pageParam ? Number(pageParam) : 1,
+    cursor: searchParams.get('cursor') ?? undefined,
   }
 }
 
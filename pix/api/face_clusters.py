@@ -1,14 +1,17 @@
 from typing import List, Union
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query
 from pydantic import BaseModel
 import requests
 
 from pix.app import AppGraph
-from pix.model.face_cluster import FaceClusterRepo
+from pix.model.face_cluster import FaceCluster, FaceClusterFace, FaceClusterRepo
 from pix.model.image import ImageFace, ImageRepo
 
 face_clusters_router = APIRouter()
 
+FACE_PAGE_SIZE = 100
+MAX_FACE_PAGE_SIZE = 1000
+
 
 class FaceClusterFaceDto(BaseModel):
     image_id: str
@@ -21,50 +24,75 @@ class FaceClusterDto(BaseModel):
     wikidata_qid: Union[str, None]
     face_count: Union[int, None]
     faces: List[FaceClusterFaceDto]
+    # offset of the next page of faces, None if this is the last one; faces that don't exist anymore are
+    # left out of the page, so it may be shorter than the limit
+    next_offset: Union[int, None] = None
 
 
 @face_clusters_router.get("/api/face-clusters")
 def list_face_clusters() -> List[FaceClusterDto]:
     fc_repo = AppGraph.get_instance(FaceClusterRepo)
-    image_repo = AppGraph.get_instance(ImageRepo)
+    face_clusters = [fc for fc in fc_repo.all() if fc.faces]
+    # the first face of every cluster with one image lookup
+    faces = _get_face_dtos([fc.faces[0] for fc in face_clusters])
     result = []
-    for fc in fc_repo.all():
-        if not fc.faces: continue
-        face = fc.faces[0]
+    for fc, face in zip(face_clusters, faces):
+        if face is None: continue
         result.append(FaceClusterDto(
             id=fc.id,
             label=fc.label,
             wikidata_qid=fc.wikidata_qid,
             face_count=len(fc.faces),
-            faces=[FaceClusterFaceDto(
-                image_id=face.image_id,
-                face=image_repo.get(face.image_id).faces[face.index],
-            )],
+            faces=[face],
         ))
     result.sort(key=lambda fc: fc.face_count, reverse=True)
     return result
 
 
 @face_clusters_router.get("/api/face-clusters/{face_cluster_id}")
-def get_face_cluster(face_cluster_id: str) -> FaceClusterDto:
+def get_face_cluster(
+        face_cluster_id: str,
+        offset: int = Query(0, ge=0),
+        limit: int = Query(FACE_PAGE_SIZE, ge=1, le=MAX_FACE_PAGE_SIZE),
+) -> FaceClusterDto:
     fc_repo = AppGraph.get_instance(FaceClusterRepo)
     face_cluster = fc_repo.get(face_cluster_id)
-    image_repo = AppGraph.get_instance(ImageRepo)
-    faces = []
-    for face in face_cluster.faces:
-        faces.append(FaceClusterFaceDto(
-            image_id=face.image_id,
-            face=image_repo.get(face.image_id).faces[face.index],
-        ))
+    if face_cluster is None:
+        raise HTTPException(404)
+
+    return _face_cluster_dto(face_cluster, offset, limit)
+
+
+def _face_cluster_dto(face_cluster: FaceCluster, offset: int, limit: int) -> FaceClusterDto:
+    """The cluster with a page of its faces; `face_count` is the total."""
+    faces = _get_face_dtos(face_cluster.faces[offset:offset + limit])
     return FaceClusterDto(
         id=face_cluster.id,
         label=face_cluster.label,
         wikidata_qid=face_cluster.wikidata_qid,
-        face_count=len(faces),
-        faces=faces,
+        face_count=len(face_cluster.faces),
+        faces=[face for face in faces if face is not None],
+        next_offset=offset + limit if offset + limit < len(face_cluster.faces) else None,
     )
 
 
+def _get_face_dtos(faces: List[FaceClusterFace]) -> List[Union[FaceClusterFaceDto, None]]:
+    """Resolve the faces from their images loaded at once, None for faces that don't exist anymore."""
+    image_repo = AppGraph.get_instance(ImageRepo)
+    images = image_repo.get_many([face.image_id for face in faces], fields=["faces"])
+    result = []
+    for face in faces:
+        image = images.get(face.image_id)
+        if image is None or not image.faces or face.index >= len(image.faces):
+            result.append(None)
+            continue
+        result.append(FaceClusterFaceDto(
+            image_id=face.image_id,
+            face=image.faces[face.index],
+        ))
+    return result
+
+
 class SetFaceClusterLabelRequest(BaseModel):
     wikidata_qid: str
 
@@ -89,17 +117,4 @@ def set_face_cluster_label(face_cluster_id: str, request: SetFaceClusterLabelReq
     face_cluster.label = label
     fc_repo.update(face_cluster)
 
-    image_repo = AppGraph.get_instance(ImageRepo)
-    faces = []
-    for face in face_cluster.faces:
-        faces.append(FaceClusterFaceDto(
-            image_id=face.image_id,
-            face=image_repo.get(face.image_id).faces[face.index],
-        ))
-    return FaceClusterDto(
-        id=face_cluster.id,
-        label=face_cluster.label,
-        wikidata_qid=face_cluster.wikidata_qid,
-        face_count=len(faces),
-        faces=faces,
-    )
+    return _face_cluster_dto(face_cluster, 0, FACE_PAGE_SIZE)
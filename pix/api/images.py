@@ -1,26 +1,26 @@
+from collections import defaultdict
 import datetime
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from typing import Dict, List, Literal, Optional, Union
+from typing import Dict, List, Literal, Optional, Tuple, Union
 from fastapi import APIRouter, HTTPException
 import numpy as np
 from pydantic import BaseModel
 import requests
 
 from pix.app import AppGraph
-from pix.autotagger.wd import WdAutotagger
-from pix.embeddings.clip import ClipEmbedding
-from pix.autotagger.custom import CustomAutotagger
+from pix.autotagger.custom import REGISTRY_KEY as CUSTOM_REGISTRY_KEY, CustomAutotagger
 from pix.embedding_index import MultiEmbeddingIndexManager
-from pix.embeddings.csd import CsdEmbedding
 from pix.model.face_cluster import FaceClusterRepo
-from pix.model.image import Image, ImageRepo, ImageTag, TagQuery, TagQueryTermFace, Vector
+from pix.model.image import EMBEDDING_TYPE_DEFAULT, Image, ImageRepo, ImageTag, TagQuery, TagQueryTermFace, Vector
+from pix.model_registry import ModelRegistry
+from pix.query_embedding import QueryEmbeddingService
+from pix.tag_index import TagIndex
+from pixdb.inject import Graph
 
 
 images_router = APIRouter()
 
-EMBEDDING_TYPE_DEFAULT = "default"
-
 
 class ImageDto(BaseModel):
     id: str
@@ -33,10 +33,16 @@ class ImageDto(BaseModel):
 
     tags: Union[List[ImageTag], None]
     manual_tags: Union[List[ImageTag], None]
+    custom_tags: Union[List[ImageTag], None]
     embedding_types: List[str]
     # embedding: Union[Vector, None] = None
     # faces: Union[List[ImageFace], None] = None
 
+    @staticmethod
+    def doc_fields() -> List[str]:
+        """Image fields needed by `from_doc`, to load only them from the repo."""
+        return [name for name in ImageDto.model_fields.keys() if name != "id"]
+
     @staticmethod
     def from_doc(image: Image):
         fields = image.model_dump()
@@ -45,12 +51,8 @@ class ImageDto(BaseModel):
     
     @staticmethod
     def get_embedding_types(image: Image):
-        embedding_types = []
-        if image.embedding:
-            embedding_types.append(EMBEDDING_TYPE_DEFAULT)
-        if image.embeddings:
-            embedding_types.extend(image.embeddings.keys())
-        return embedding_types
+        # default first, it is selected by default in the frontend
+        return sorted(image.embedding_types, key=lambda embedding_type: embedding_type != EMBEDDING_TYPE_DEFAULT)
 
 
 class QueryFaceClusterDto(BaseModel):
@@ -64,20 +66,31 @@ class ListImagesResult(BaseModel):
     count: int
     has_next_page: bool
     query_face_clusters: List[QueryFaceClusterDto]
+    # cursors of the adjacent pages, to pass as `cursor`
+    next_cursor: Union[str, None] = None
+    prev_cursor: Union[str, None] = None
 
 
 @images_router.get("/api/images")
-def list_images(page: int = 1, tag: Optional[str] = None, sort: Optional[Literal['asc', 'desc']] = None) -> ListImagesResult:
+def list_images(page: int = 1, tag: Optional[str] = None, sort: Optional[Literal['asc', 'desc']] = None,
+                cursor: Optional[str] = None) -> ListImagesResult:
+    """Pages are selected with `cursor` from the previous result, or by `page` number (slower on deep pages)."""
     limit = 20
-    offset = (page - 1) * limit
+    offset = (page - 1) * limit if cursor is None else 0
+    descending = sort != 'asc'
+    backward = False
+    after = None
+    if cursor is not None:
+        backward, after = _decode_cursor(cursor)
     image_repo = AppGraph.get_instance(ImageRepo)
     if tag:
-        tag = TagQuery.parse(tag)
-        images = image_repo.list_by_tag_collected_at_desc(tag, offset, limit + 1, descending=sort != 'asc')
-        count = image_repo.count_by_tag(tag)
+        tag_query = TagQuery.parse(tag)
+        images = image_repo.list_by_tag_collected_at_desc(tag_query, offset, limit + 1, descending=descending != backward,
+                                                          fields=ImageDto.doc_fields(), after=after)
+        count = AppGraph.get_instance(TagIndex).count(tag_query)
         query_face_clusters = []
         face_cluster_repo = AppGraph.get_instance(FaceClusterRepo)
-        for term in tag.terms:
+        for term in tag_query.terms:
             if isinstance(term.tag, TagQueryTermFace):
                 fc = face_cluster_repo.get(term.tag.face_cluster_id)
                 if not fc: continue
@@ -87,37 +100,49 @@ def list_images(page: int = 1, tag: Optional[str] = None, sort: Optional[Literal
                     label=fc.label,
                 ))
     else:
-        images = image_repo.list_by_collected_at_desc(offset, limit + 1, descending=sort != 'asc')
-        count = image_repo.count()
+        images = image_repo.list_by_collected_at_desc(offset, limit + 1, descending=descending != backward,
+                                                      fields=ImageDto.doc_fields(), after=after)
+        count = AppGraph.get_instance(TagIndex).count(TagQuery([]))
         query_face_clusters = []
-    has_next_page = len(images) > limit
+    has_more = len(images) > limit
     images = images[:limit]
+    if backward:
+        images.reverse()
+        has_next_page = True
+        has_prev_page = has_more
+    else:
+        has_next_page = has_more
+        has_prev_page = after is not None or offset > 0
     return ListImagesResult(
         data=list(map(ImageDto.from_doc, images)),
         count=count,
         has_next_page=has_next_page,
         query_face_clusters=query_face_clusters,
+        next_cursor=_encode_cursor(images[-1], backward=False) if images and has_next_page else None,
+        prev_cursor=_encode_cursor(images[0], backward=True) if images and has_prev_page else None,
     )
 
 
+def _encode_cursor(image: Image, backward: bool) -> str:
+    return ("b" if backward else "a") + ":" + image.collected_at.isoformat() + "," + image.id
+
+
+def _decode_cursor(cursor: str) -> Tuple[bool, Tuple[datetime.datetime, str]]:
+    """(backward, (collected_at, id)) of the image to continue from."""
+    try:
+        direction, key = cursor.split(":", 1)
+        collected_at, id = key.split(",", 1)
+        return direction == "b", (datetime.datetime.fromisoformat(collected_at), id)
+    except ValueError:
+        raise HTTPException(400, "Invalid cursor")
+
+
 @images_router.get("/api/images/search")
-def search_images(q: str, limit: int = 100):
-    image_repo = AppGraph.get_instance(ImageRepo)
+def search_images(q: str, limit: int = 100, tag: Optional[str] = None):
     index = AppGraph.get_instance(MultiEmbeddingIndexManager).get_manager("clip")
-    embedding = AppGraph.get_instance(ClipEmbedding)
-    embedding.load_model()
+    emb = AppGraph.get_instance(QueryEmbeddingService).encode_text(q)
 
-    result = []
-    for sim_id, score in index.search(embedding.encode_text(q), limit):
-        sim_image = image_repo.get(sim_id)
-        if sim_image is None: continue
-
-        result.append({
-            "image": ImageDto.from_doc(sim_image),
-            "score": score,
-        })
-    
-    return result
+    return _similar_image_results(index.search(emb, limit, _filter_ids(tag)))
 
 
 @images_router.get("/api/images/search/similar/compare")
@@ -129,22 +154,7 @@ def search_similar_images_compare(url: str):
                 f.write(chunk)
             f.flush()
 
-        embeddings = {}
-
-        for model_name, model_cls in (
-            ("clip", ClipEmbedding),
-            ("csd", CsdEmbedding),
-        ):
-            model = AppGraph.get_instance(model_cls)
-            model.load_model()
-            emb = model.extract(Path(f.name))
-            embeddings[model_name] = Vector.from_numpy(emb)
-
-        model = AppGraph.get_instance(WdAutotagger)
-        model.load_model()
-        emb = model.extract(Path(f.name)).embedding
-        if emb is not None:
-            embeddings[EMBEDDING_TYPE_DEFAULT] = Vector.from_numpy(emb)
+        embeddings = AppGraph.get_instance(QueryEmbeddingService).extract(Path(f.name))
 
     return _search_similar_images(embeddings)
 
@@ -160,33 +170,89 @@ def get_image(image_id: str):
 
 
 @images_router.get("/api/images/{image_id}/similar")
-def list_similar_images(image_id: str, count: int = 10, embedding_type: str = EMBEDDING_TYPE_DEFAULT):
+def list_similar_images(image_id: str, count: int = 10, embedding_type: str = EMBEDDING_TYPE_DEFAULT, tag: Optional[str] = None):
     image_repo = AppGraph.get_instance(ImageRepo)
     image = image_repo.get(image_id)
     if image is None:
         raise HTTPException(404)
     
-    if embedding_type == EMBEDDING_TYPE_DEFAULT:
-        emb = image.embedding
-    else:
-        emb = image.embeddings.get(embedding_type)
-        
+    image_repo.load_embeddings([image], [embedding_type])
+    emb = image.get_embedding(embedding_type)
     if not emb:
         return []
 
     index = AppGraph.get_instance(MultiEmbeddingIndexManager).get_manager(embedding_type)
-    result = []
-    for sim_id, score in index.search(emb.to_numpy(), count + 1):
-        if sim_id == image_id: continue
-        sim_image = image_repo.get(sim_id)
-        if sim_image is None: continue
+    hits = index.search(emb.to_numpy(), count + 1, _filter_ids(tag))
+    return _similar_image_results([hit for hit in hits if hit[0] != image_id][:count])
 
-        result.append({
-            "image": ImageDto.from_doc(sim_image),
+
+class SimilarImagesRequest(BaseModel):
+    image_ids: List[str]
+    count: int = 10
+    embedding_type: str = EMBEDDING_TYPE_DEFAULT
+    tag: Optional[str] = None
+
+
+@images_router.post("/api/images/similar")
+def list_images_similar_to_all(request: SimilarImagesRequest):
+    """Images similar to all of the given images, ranked by the mean score over them."""
+    image_ids, embs = _get_query_embeddings(request.image_ids, request.embedding_type)
+    if not image_ids:
+        return []
+
+    index = AppGraph.get_instance(MultiEmbeddingIndexManager).get_manager(request.embedding_type)
+    # hits missing from the top-k of some query count as zero for it
+    scores = defaultdict(float)
+    for hits in index.search_batch(embs, request.count + len(image_ids), _filter_ids(request.tag)):
+        for sim_id, score in hits:
+            if sim_id in image_ids: continue
+            scores[sim_id] += score / len(image_ids)
+
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:request.count]
+    return _similar_image_results(ranked)
+
+
+@images_router.post("/api/images/similar/batch")
+def list_similar_images_batch(request: SimilarImagesRequest):
+    """`list_similar_images` for many images with one index search."""
+    image_ids, embs = _get_query_embeddings(request.image_ids, request.embedding_type)
+    if not image_ids:
+        return {}
+
+    index = AppGraph.get_instance(MultiEmbeddingIndexManager).get_manager(request.embedding_type)
+    results = {}
+    for image_id, hits in zip(image_ids, index.search_batch(embs, request.count + 1, _filter_ids(request.tag))):
+        results[image_id] = _similar_image_results([hit for hit in hits if hit[0] != image_id][:request.count])
+    return results
+
+
+def _filter_ids(tag: Optional[str]) -> Union[np.ndarray, None]:
+    """Encoded ids of the images matching the tag query, to search only them."""
+    if not tag:
+        return None
+    return AppGraph.get_instance(TagIndex).list_id_keys(TagQuery.parse(tag))
+
+
+def _get_query_embeddings(image_ids: List[str], embedding_type: str):
+    image_repo = AppGraph.get_instance(ImageRepo)
+    embs = image_repo.get_embeddings(embedding_type, image_ids)
+    found_ids = [image_id for image_id in dict.fromkeys(image_ids) if image_id in embs]
+    if not found_ids:
+        return found_ids, None
+    return found_ids, np.stack([embs[image_id] for image_id in found_ids])
+
+
+def _similar_image_results(hits: List[Tuple[str, float]]):
+    image_repo = AppGraph.get_instance(ImageRepo)
+    sim_images = image_repo.get_many([sim_id for sim_id, _ in hits], fields=ImageDto.doc_fields())
+    return [
+        {
+            "image": ImageDto.from_doc(sim_images[sim_id]),
             "score": score,
-        })
-    
-    return result
+        }
+        for sim_id, score in hits
+        if sim_id in sim_images
+    ]
 
 
 @images_router.get("/api/images/{image_id}/similar/compare")
@@ -196,40 +262,42 @@ def list_similar_images_compare(image_id: str):
     if image is None:
         raise HTTPException(404)
     
-    embeddings = dict(image.embeddings)
-    if image.embedding:
-        embeddings[EMBEDDING_TYPE_DEFAULT] = image.embedding
-    return _search_similar_images(embeddings, image_id)
+    image_repo.load_embeddings([image])
+    return _search_similar_images(image.get_all_embeddings(), image_id)
 
 
 def _search_similar_images(embeddings: Dict[str, Vector], image_id: Union[str, None] = None):
     image_repo = AppGraph.get_instance(ImageRepo)
 
-    results = []
     count = 5
-    all_sim_images = {}
     if image_id:
         count += 1  # to exclude query image itself
 
+    hits_by_type = {}
     for embedding_type in embeddings.keys():
         index = AppGraph.get_instance(MultiEmbeddingIndexManager).get_manager(embedding_type)
         emb = embeddings[embedding_type]
+        hits_by_type[embedding_type] = [hit for hit in index.search(emb.to_numpy(), count) if hit[0] != image_id]
 
-        result = []
-        for sim_id, score in index.search(emb.to_numpy(), count):
-            if sim_id == image_id: continue
-            sim_image = all_sim_images.get(sim_id) or image_repo.get(sim_id)
-            if sim_image is None: continue
-            all_sim_images[sim_id] = sim_image
+    # one lookup for the hits of all types, shared by the results
+    sim_images = image_repo.get_many(
+        [sim_id for hits in hits_by_type.values() for sim_id, _ in hits],
+        fields=ImageDto.doc_fields(),
+    )
+    image_dtos = {sim_id: ImageDto.from_doc(sim_image) for sim_id, sim_image in sim_images.items()}
 
-            result.append({
-                "image": ImageDto.from_doc(sim_image),
-                "score": score,
-            })
-        
+    results = []
+    for embedding_type, hits in hits_by_type.items():
         results.append({
             "type": embedding_type,
-            "images": result,
+            "images": [
+                {
+                    "image": image_dtos[sim_id],
+                    "score": score,
+                }
+                for sim_id, score in hits
+                if sim_id in image_dtos
+            ],
         })
     
     # extend result
@@ -238,18 +306,10 @@ def _search_similar_images(embeddings: Dict[str, Vector], image_id: Union[str, N
         query_emb = embeddings[embedding_type]
         query_emb = query_emb.to_numpy()
 
-        missing_image_ids = all_sim_images.keys() - set(image["image"].id for image in result["images"])
-        for missing_image_id in missing_image_ids:
-            missing_image = all_sim_images[missing_image_id]
-            if embedding_type == EMBEDDING_TYPE_DEFAULT:
-                emb = missing_image.embedding
-            else:
-                emb = missing_image.embeddings.get(embedding_type)
-            if emb is None: continue
-            emb = emb.to_numpy()
-
+        missing_image_ids = image_dtos.keys() - set(image["image"].id for image in result["images"])
+        for missing_image_id, emb in image_repo.get_embeddings(embedding_type, missing_image_ids).items():
             result["images"].append({
-                "image": ImageDto.from_doc(missing_image),
+                "image": image_dtos[missing_image_id],
                 "score": np.dot(query_emb, emb).astype(float) / (np.linalg.norm(query_emb) * np.linalg.norm(emb)),
             })
         
@@ -312,10 +372,10 @@ def get_image_custom_autotags(image_id: str):
     if image is None:
         raise HTTPException(404)
 
+    image_repo.load_embeddings([image], [EMBEDDING_TYPE_DEFAULT])
     if image.embedding is None:
         return []
     
-    autotagger = AppGraph.get_instance(CustomAutotagger)
-    autotagger.load_model()
-
-    return autotagger.extract(image.embedding.to_numpy())
+    graph = AppGraph.get_instance(Graph)
+    with AppGraph.get_instance(ModelRegistry).use(CUSTOM_REGISTRY_KEY, lambda: graph.create_instance(CustomAutotagger)) as autotagger:
+        return autotagger.extract(image.embedding.to_numpy())
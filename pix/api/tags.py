@@ -4,7 +4,8 @@ from pydantic import BaseModel
 
 from pix.app import AppGraph
 from pix.model.character import CharacterRepo
-from pix.model.image import ImageRepo
+from pix.model.image import ImageRepo, TagQuery
+from pix.tag_index import TagIndex
 
 tags_router = APIRouter()
 
@@ -17,7 +18,11 @@ class ListTagsResultItem(BaseModel):
 @tags_router.get("/api/tags")
 def list_tags(q: Optional[str] = None):
     image_repo = AppGraph.get_instance(ImageRepo)
-    tags = image_repo.list_all_tags_with_count(q)
+    if q:
+        # counts among the images matching the query
+        tags = AppGraph.get_instance(TagIndex).tag_counts(TagQuery.parse(q))
+    else:
+        tags = image_repo.list_all_tags_with_count(q)
     tags.sort(key=lambda tc: tc[1], reverse=True)
     return [ListTagsResultItem(tag=tag, image_count=count) for tag, count in tags]
 
@@ -1,4 +1,5 @@
 import json
+from typing import List, Tuple, Union
 from typing_extensions import Annotated
 import numpy as np
 import onnxruntime as rt
@@ -6,25 +7,59 @@ from pathlib import Path
 
 from pixdb.inject import Value
 
+# key of the model in the `ModelRegistry`
+REGISTRY_KEY = "custom"
+
 
 class CustomAutotagger:
     def __init__(self, model_dir: Annotated[Path, Value("custom_autotagger_model_dir")]):
         self._model_dir = model_dir
         self.score_character_threshold = 0.7
         self._model = None
-    
+
+    @property
+    def model_path(self) -> Path:
+        return self._model_dir / "model.onnx"
+
+    @property
+    def tags(self) -> List[str]:
+        return self._meta["tags"]
+
     def load_model(self):
         if self._model is not None:
             return
 
-        self._model = rt.InferenceSession(self._model_dir / "model.onnx")
+        self._model = rt.InferenceSession(self.model_path)
+        self._input_name = self._model.get_inputs()[0].name
+        self._label_name = self._model.get_outputs()[0].name
         with open(self._model_dir / "meta.json") as fp:
             self._meta = json.load(fp)
+        self._tag_names = np.array(self._meta["tags"], dtype=object)
     
     def extract(self, embedding: np.array):
-        input_name = self._model.get_inputs()[0].name
-        label_name = self._model.get_outputs()[0].name
-        probs, = self._model.run([label_name], {input_name: np.expand_dims(embedding, 0)})
-        tags = list(zip(self._meta["tags"], probs[0].astype(float)))
-        tags = [(tag, score) for tag, score in tags if score > self.score_character_threshold]
-        return tags
+        return self.extract_batch(np.expand_dims(embedding, 0))[0]
+
+    def extract_batch(self, embeddings: np.ndarray, top_k: Union[int, None] = None) -> List[List[Tuple[str, float]]]:
+        """(tag, score) above the threshold for each row of the WD embedding matrix, at most `top_k` by score if given."""
+        probs, = self._model.run([self._label_name], {self._input_name: embeddings})
+        return select_tags(probs, self._tag_names, self.score_character_threshold, top_k)
+
+
+def select_tags(probs: np.ndarray, tag_names: np.ndarray, threshold: float, top_k: Union[int, None] = None) -> List[List[Tuple[str, float]]]:
+    if top_k is not None and top_k < probs.shape[1]:
+        # columns of the k best scores per row, in label order like the thresholded selection
+        cols = np.sort(np.argpartition(-probs, top_k - 1, axis=1)[:, :top_k], axis=1)
+        rows = np.repeat(np.arange(len(probs)), top_k)
+        cols = cols.ravel()
+        selected = probs[rows, cols] > threshold
+        rows, cols = rows[selected], cols[selected]
+    else:
+        rows, cols = np.nonzero(probs > threshold)
+
+    names = tag_names[cols].tolist()
+    scores = probs[rows, cols].astype(float).tolist()
+    bounds = np.searchsorted(rows, np.arange(len(probs) + 1))
+    return [
+        list(zip(names[bounds[i]:bounds[i + 1]], scores[bounds[i]:bounds[i + 1]]))
+        for i in range(len(probs))
+    ]
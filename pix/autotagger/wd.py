@@ -25,6 +25,9 @@ VIT_MODEL_REPO = "SmilingWolf/wd-v1-4-vit-tagger-v2"
 MODEL_FILENAME = "model.onnx"
 LABEL_FILENAME = "selected_tags.csv"
 
+# key of the model in the `ModelRegistry`
+REGISTRY_KEY = "wd"
+
 
 @dataclass
 class AutotagResult:
@@ -39,6 +42,7 @@ class WdAutotagger:
         self.score_general_threshold = 0.35
         self.score_character_threshold = 0.85
         self._predict = None
+        self._input_size = None
 
     def load_model(self):
         if self._predict is not None:
@@ -62,23 +66,37 @@ class WdAutotagger:
             print(f"modifying model finished - took {end - start} s")
 
         model = rt.InferenceSession(self.modified_model_cache_path)
-        
+        _, self._input_size, _, _ = model.get_inputs()[0].shape
+
         self._predict = functools.partial(
             predict,
             model=model,
-            tag_names=tag_names,
-            rating_indexes=rating_indexes,
-            general_indexes=general_indexes,
-            character_indexes=character_indexes,
+            input_name=model.get_inputs()[0].name,
+            output_names=[output.name for output in model.get_outputs()[:2]],
+            tag_names=np.array(tag_names, dtype=object),
+            rating_indexes=np.array(rating_indexes, dtype=np.int64),
+            general_indexes=np.array(general_indexes, dtype=np.int64),
+            character_indexes=np.array(character_indexes, dtype=np.int64),
         )
 
     def extract(self, file: Path) -> AutotagResult:
+        return self.extract_batch([file])[0]
+
+    def extract_batch(self, files: List[Path]) -> List[AutotagResult]:
+        return self.predict_batch(np.stack([self.preprocess(file) for file in files]))
+
+    def preprocess(self, file: Path) -> np.ndarray:
+        """Decode the image into a model input. Can run in other threads while `predict_batch` runs."""
         with PIL.Image.open(file) as im:
-            return self._predict(
-                im,
-                general_threshold=self.score_general_threshold,
-                character_threshold=self.score_character_threshold,
-            )
+            return preprocess_image(im, self._input_size)
+
+    def predict_batch(self, images: np.ndarray) -> List[AutotagResult]:
+        """Run the model once on stacked `preprocess` results."""
+        return self._predict(
+            images,
+            general_threshold=self.score_general_threshold,
+            character_threshold=self.score_character_threshold,
+        )
 
 
 def load_labels(huggingface_token: str) -> List[str]:
@@ -96,18 +114,7 @@ def load_labels(huggingface_token: str) -> List[str]:
     return tag_names, rating_indexes, general_indexes, character_indexes
 
 
-def predict(
-    image: PIL.Image.Image,
-    model: rt.InferenceSession,
-    general_threshold: float,
-    character_threshold: float,
-    tag_names: List[str],
-    rating_indexes: List[np.int64],
-    general_indexes: List[np.int64],
-    character_indexes: List[np.int64],
-):
-    _, height, width, _ = model.get_inputs()[0].shape
-
+def preprocess_image(image: PIL.Image.Image, height: int) -> np.ndarray:
     # Alpha to white
     image = image.convert("RGBA")
     new_image = PIL.Image.new("RGBA", image.size, "WHITE")
@@ -120,29 +127,48 @@ def predict(
 
     image = dbimutils.make_square(image, height)
     image = dbimutils.smart_resize(image, height)
-    image = image.astype(np.float32)
-    image = np.expand_dims(image, 0)
-
-    input_name = model.get_inputs()[0].name
-    label_name = model.get_outputs()[0].name
-    emb_name = model.get_outputs()[1].name
-    probs, emb = model.run([label_name, emb_name], {input_name: image})
-
-    labels = list(zip(tag_names, probs[0].astype(float)))
-
-    # First 4 labels are actually ratings: pick one with argmax
-    ratings_names = [labels[i] for i in rating_indexes]
-    ratings = [(f"rating:{tag[0]}", TagType.RATING, score) for tag, score in ratings_names if score > general_threshold]
-
-    # Then we have general tags: pick any where prediction confidence > threshold
-    general_names = [labels[i] for i in general_indexes]
-    general_res = [(tag, None, score) for tag, score in general_names if score > general_threshold]
+    return image.astype(np.float32)
 
-    # Everything else is characters: pick any where prediction confidence > threshold
-    character_names = [labels[i] for i in character_indexes]
-    character_res = [(tag, TagType.CHARACTER, score) for tag, score in character_names if score > character_threshold]
 
-    return AutotagResult(
-        tags=ratings + general_res + character_res,
-        embedding=emb[0],
-    )
+def predict(
+    images: np.ndarray,
+    model: rt.InferenceSession,
+    input_name: str,
+    output_names: List[str],
+    general_threshold: float,
+    character_threshold: float,
+    tag_names: np.ndarray,
+    rating_indexes: np.ndarray,
+    general_indexes: np.ndarray,
+    character_indexes: np.ndarray,
+) -> List[AutotagResult]:
+    probs, embs = model.run(output_names, {input_name: images})
+
+    # First 4 labels are actually ratings, then we have general tags: pick any where prediction confidence > threshold
+    ratings = _select_above(probs, tag_names, rating_indexes, general_threshold)
+    general = _select_above(probs, tag_names, general_indexes, general_threshold)
+    # Everything else is characters
+    characters = _select_above(probs, tag_names, character_indexes, character_threshold)
+
+    results = []
+    for i, emb in enumerate(embs):
+        tags = []
+        tags.extend((f"rating:{tag[0]}", TagType.RATING, score) for tag, score in ratings[i])
+        tags.extend((tag, None, score) for tag, score in general[i])
+        tags.extend((tag, TagType.CHARACTER, score) for tag, score in characters[i])
+        results.append(AutotagResult(tags=tags, embedding=emb))
+    return results
+
+
+def _select_above(probs: np.ndarray, tag_names: np.ndarray, indexes: np.ndarray, threshold: float) -> List[List[Tuple[str, float]]]:
+    """(tag name, score) of the labels at `indexes` scoring above the threshold, per row of the probability matrix."""
+    scores = probs[:, indexes]
+    rows, cols = np.nonzero(scores > threshold)
+    selected_names = tag_names[indexes[cols]].tolist()
+    selected_scores = scores[rows, cols].astype(float).tolist()
+    # np.nonzero is row-major, so each row's selection is a contiguous run
+    bounds = np.searchsorted(rows, np.arange(len(probs) + 1))
+    return [
+        list(zip(selected_names[bounds[i]:bounds[i + 1]], selected_scores[bounds[i]:bounds[i + 1]]))
+        for i in range(len(probs))
+    ]
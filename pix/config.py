@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Dict, Union
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -18,3 +19,24 @@ class Settings(BaseSettings):
     huggingface_token: str
     custom_autotagger_model_dir: Path
     csd_pretrained_model_path: Path
+
+    # faiss index factory strings (e.g. "HNSW32", "IVF1024,PQ64") and search parameters
+    # (e.g. "efSearch=64", "nprobe=16") by embedding type; Flat when not set
+    embedding_index_types: Dict[str, str] = {}
+    embedding_index_search_params: Dict[str, str] = {}
+
+    # torch device of the embedding models, e.g. "cpu" or "cuda"; cuda if available when not set
+    embedding_device: Union[str, None] = None
+    # autocast dtype on cuda, models run in float32 on cpu
+    embedding_dtype: str = "float16"
+    # intra-op threads for cpu inference; the runtime's default when not set
+    embedding_threads: Union[int, None] = None
+    # "torch", or "onnx" to run the graphs exported by the `export_onnx` task on ONNX Runtime
+    embedding_runtime: str = "torch"
+    # export and run int8 quantized graphs
+    embedding_onnx_quantize: bool = False
+
+    # models of the API process are unloaded least recently used first to stay within this, unbounded when not set
+    model_memory_budget_mb: Union[int, None] = None
+    # models of the API process unused for this long are unloaded
+    model_idle_seconds: float = 900
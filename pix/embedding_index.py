@@ -1,20 +1,68 @@
+from datetime import datetime
+import json
+import logging
+import os
 from pathlib import Path
-from typing import List, Mapping, Tuple, Union
+import shutil
+import tempfile
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Sequence, Tuple, Union
 import numpy as np
 import faiss
 
+logger = logging.getLogger(__name__)
+
+INDEX_TYPE_FLAT = "Flat"
+
 
 class EmbeddingIndex:
     _INDEX_FILENAME = "index"
+    # legacy id list, one line per label
     _ID_FILENAME = "ids"
+    # utf-8 doc ids concatenated, and the offset of each label's id in it (empty for removed docs)
+    _ID_DATA_FILENAME = "ids.data"
+    _ID_OFFSETS_FILENAME = "ids.offsets.npy"
+    # utf-8 doc ids of present docs in sorted order and their labels, to map ids to labels by binary search
+    _SORTED_IDS_FILENAME = "ids.sorted.npy"
+    _SORTED_LABELS_FILENAME = "ids.sorted_labels.npy"
+    _META_FILENAME = "meta.json"
+    # versioned layout: CURRENT names the directory under versions/ to read
+    _CURRENT_FILENAME = "CURRENT"
+    _VERSIONS_DIRNAME = "versions"
+    # the previous version is kept for readers that resolved CURRENT just before a swap
+    keep_versions = 2
+
+    # vectors buffered before training index types that need it (IVF, PQ, ...)
+    train_size = 50000
+    # HNSW efSearch / IVF nprobe are scaled up by the inverse of the filter selectivity; filters too selective
+    # for the HNSW efSearch to stay under this are searched exactly over the reconstructed selected vectors
+    max_filtered_ef_search = 4096
+    # selected vectors reconstructed at once by exact filtered searches
+    exact_search_chunk_size = 10000
 
-    def __init__(self) -> None:
-        self._index: Union[faiss.IndexFlatIP, None] = None
-        self._doc_ids = []
+    def __init__(self, index_type: str = INDEX_TYPE_FLAT, search_params: str = "") -> None:
+        """
+        `index_type` is a faiss index factory string, e.g. "Flat", "HNSW32" or "IVF1024,PQ64".
+        `search_params` is a faiss ParameterSpace string, e.g. "efSearch=64" or "nprobe=16".
+        """
+        self._index: Union[faiss.Index, None] = None
+        # faiss label -> doc id, None for removed docs
+        self._doc_ids: Union[List[Union[str, None]], _IdTable] = []
+        # doc id -> label, None for indexes loaded with mmap, which look labels up in the `_IdTable`
+        self._labels: Union[Dict[str, int], None] = {}
+        self._read_only = False
+        # (labels, vectors) added before the index is trained
+        self._pending: List[Tuple[np.ndarray, np.ndarray]] = []
+        # build state saved with the index, e.g. the last applied embedding change
+        self.meta: Dict[str, Any] = {"index_type": index_type, "search_params": search_params}
+
+    @property
+    def index_type(self) -> str:
+        return self.meta.get("index_type", INDEX_TYPE_FLAT)
     
     def _ensure_index(self, dim: Union[int, None]):
         if self._index is None:
-            self._index = faiss.IndexFlatIP(dim)
+            self._index = self._create_index(dim, self.index_type)
             return self._index
         
         if self._index.d != dim:
@@ -22,52 +70,408 @@ class EmbeddingIndex:
         
         return self._index
 
+    def _create_index(self, dim: int, index_type: str) -> faiss.Index:
+        index = faiss.index_factory(dim, index_type, faiss.METRIC_INNER_PRODUCT)
+        try:
+            # IVF indexes store our labels natively, and IDMap2 would remap them wrongly on removal
+            faiss.extract_index_ivf(index)
+        except RuntimeError:
+            index = faiss.IndexIDMap2(index)
+        if self.meta.get("search_params"):
+            faiss.ParameterSpace().set_index_parameters(index, self.meta["search_params"])
+        return index
+
+    def set_search_params(self, search_params: str):
+        self.meta["search_params"] = search_params
+        if search_params and self._index is not None:
+            faiss.ParameterSpace().set_index_parameters(self._index, search_params)
+
     def add(self, doc_id: str, emb: np.array):
-        index = self._ensure_index(emb.shape[-1])
-        xb = np.stack([emb]).astype('float32')
+        self.add_batch([doc_id], emb.reshape(1, -1))
+
+    def add_batch(self, doc_ids: List[str], embs: np.ndarray):
+        """Add (or replace) the docs with one matrix of embeddings, one row per doc."""
+        self._check_writable()
+        if len(set(doc_ids)) != len(doc_ids):
+            raise ValueError("duplicate doc ids in batch")
+        self.remove([doc_id for doc_id in doc_ids if doc_id in self._labels])
+        index = self._ensure_index(embs.shape[-1])
+        xb = np.array(embs, dtype='float32', copy=True).reshape(len(doc_ids), -1)
         faiss.normalize_L2(xb)
-        index.add(xb)
-        self._doc_ids.append(doc_id)
+        start = len(self._doc_ids)
+        labels = np.arange(start, start + len(doc_ids), dtype='int64')
+        self._doc_ids.extend(doc_ids)
+        self._labels.update(zip(doc_ids, range(start, start + len(doc_ids))))
+        if not index.is_trained:
+            self._pending.append((labels, xb))
+            if sum(len(labels) for labels, _ in self._pending) >= self.train_size:
+                self._train()
+            return
+        index.add_with_ids(xb, labels)
+
+    def _train(self):
+        """Train the index on the buffered vectors and add them."""
+        if not self._pending:
+            return
+        labels = np.concatenate([labels for labels, _ in self._pending])
+        xb = np.concatenate([xb for _, xb in self._pending])
+        try:
+            self._index.train(xb)
+        except RuntimeError:
+            # e.g. fewer vectors than IVF centroids or PQ codes
+            logger.warning(f"could not train {self.index_type} index with {len(xb)} vectors, using {INDEX_TYPE_FLAT}")
+            self.meta["requested_index_type"] = self.index_type
+            self.meta["index_type"] = INDEX_TYPE_FLAT
+            self.meta["search_params"] = ""
+            self._index = self._create_index(self._index.d, INDEX_TYPE_FLAT)
+        self._index.add_with_ids(xb, labels)
+        self._pending = []
+
+    def remove(self, doc_ids: Iterable[str]):
+        """Raises RuntimeError if the index type doesn't support removal (e.g. HNSW)."""
+        self._check_writable()
+        labels = [self._labels[doc_id] for doc_id in doc_ids if doc_id in self._labels]
+        if not labels:
+            return
+        if self._pending:
+            removed = np.array(labels, dtype='int64')
+            self._pending = [
+                (pending_labels[mask], xb[mask])
+                for pending_labels, xb in self._pending
+                for mask in [~np.isin(pending_labels, removed)]
+            ]
+        self._index.remove_ids(np.array(labels, dtype='int64'))
+        for label in labels:
+            del self._labels[self._doc_ids[label]]
+            self._doc_ids[label] = None
+
+    def _check_writable(self):
+        if self._read_only:
+            raise ValueError("index loaded with mmap is read-only")
+
+    def __contains__(self, doc_id: str) -> bool:
+        if self._labels is None:
+            return len(self._labels_of([doc_id])) > 0
+        return doc_id in self._labels
+
+    def _labels_of(self, doc_ids: Union[Iterable[str], np.ndarray]) -> np.ndarray:
+        """Labels of the docs in the index, given as ids or as a numpy array of utf-8 encoded ids."""
+        if self._labels is None:
+            keys = doc_ids if isinstance(doc_ids, np.ndarray) else encode_ids(doc_ids)
+            labels = self._doc_ids.labels_of(keys)
+        else:
+            if isinstance(doc_ids, np.ndarray):
+                doc_ids = (key.decode() for key in doc_ids)
+            labels = np.array([self._labels.get(doc_id, -1) for doc_id in doc_ids], dtype='int64')
+        return labels[labels >= 0]
+
+    def __len__(self) -> int:
+        if self._labels is None:
+            return self._doc_ids.count_present()
+        return len(self._labels)
+
+    @property
+    def removed_count(self) -> int:
+        return len(self._doc_ids) - len(self)
     
-    def search(self, emb: np.array, top_k: int) -> List[Tuple[str, float]]:
-        xb = np.stack([emb]).astype('float32')
+    def search(self, emb: np.array, top_k: int, doc_ids: Union[Iterable[str], np.ndarray, None] = None) -> List[Tuple[str, float]]:
+        return self.search_batch(emb.reshape(1, -1), top_k, doc_ids)[0]
+
+    def search_batch(
+        self,
+        embs: np.ndarray,
+        top_k: int,
+        doc_ids: Union[Iterable[str], np.ndarray, None] = None,
+    ) -> List[List[Tuple[str, float]]]:
+        """Search with a matrix of query embeddings, returns hits for each row.
+
+        With `doc_ids` (ids, or a numpy array of utf-8 encoded ids), only those docs are searched.
+        """
+        self._train()
+        xb = np.array(embs, dtype='float32', copy=True)
         faiss.normalize_L2(xb)
-        distances, indices = self._ensure_index(emb.shape[-1]).search(xb, top_k)
-        return [(self._doc_ids[i], float(distance)) for i, distance in zip(indices[0], distances[0]) if i != -1]
+        index = self._ensure_index(xb.shape[-1])
+        if doc_ids is None:
+            distances, indices = index.search(xb, top_k)
+        else:
+            labels = np.unique(self._labels_of(doc_ids))
+            if len(labels) == 0:
+                return [[] for _ in range(len(xb))]
+            params = self._filtered_search_params(faiss.IDSelectorBatch(labels), len(labels), top_k)
+            if params is None:
+                distances, indices = self._search_exact(xb, top_k, labels)
+            else:
+                distances, indices = index.search(xb, top_k, params=params)
+        return [
+            [(self._doc_ids[i], float(distance)) for i, distance in zip(row_indices, row_distances) if i != -1]
+            for row_indices, row_distances in zip(indices, distances)
+        ]
+
+    def _filtered_search_params(
+        self,
+        selector: faiss.IDSelector,
+        selected_count: int,
+        top_k: int,
+    ) -> Union[faiss.SearchParameters, None]:
+        """Parameters to search only the selected labels, None if they should be searched exactly."""
+        # the parameters must match the index type, and replace the ones set with set_search_params
+        # the walk/probes only reach enough selected neighbors if they visit more of the index
+        scale = max(len(self) // selected_count, 1)
+        try:
+            ivf = faiss.extract_index_ivf(self._index)
+            # probing all lists is exhaustive over the selected vectors
+            return faiss.SearchParametersIVF(sel=selector, nprobe=min(ivf.nprobe * scale, ivf.nlist))
+        except RuntimeError:
+            pass
+        index = self._index
+        if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+            index = faiss.downcast_index(index.index)
+        # legacy indexes are bare, e.g. IndexFlatIP without IDMap
+        if hasattr(index, "hnsw"):
+            ef_search = max(index.hnsw.efSearch, top_k) * scale
+            if ef_search > self.max_filtered_ef_search:
+                return None
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search)
+        return faiss.SearchParameters(sel=selector)
+
+    def _search_exact(self, xb: np.ndarray, top_k: int, labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(distances, labels) of the top_k of the given labels by inner product with their reconstructed vectors."""
+        scores = np.concatenate([
+            xb @ self._index.reconstruct_batch(labels[start:start + self.exact_search_chunk_size]).T
+            for start in range(0, len(labels), self.exact_search_chunk_size)
+        ], axis=1)
+        k = min(top_k, len(labels))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        return np.take_along_axis(top_scores, order, axis=1), labels[np.take_along_axis(top, order, axis=1)]
 
-    def load(self, dir: Path):
-        self._index = faiss.read_index(str(dir / EmbeddingIndex._INDEX_FILENAME))
-        with (dir / EmbeddingIndex._ID_FILENAME).open() as fp:
-            self._doc_ids = [x.rstrip() for x in fp]
+    def load(self, dir: Path, mmap: bool = False):
+        """With `mmap`, the index and the ids are read-only and memory-mapped, so processes loading
+        the same files share their pages in the OS cache."""
+        if mmap:
+            io_flags = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+        else:
+            io_flags = 0
+        self._index = faiss.read_index(str(dir / EmbeddingIndex._INDEX_FILENAME), io_flags)
+        if (dir / EmbeddingIndex._ID_OFFSETS_FILENAME).exists():
+            id_table = _IdTable.load(dir, mmap)
+            self._doc_ids = id_table if mmap else list(id_table)
+        else:
+            with (dir / EmbeddingIndex._ID_FILENAME).open() as fp:
+                self._doc_ids = [x.rstrip() or None for x in fp]
+        if isinstance(self._doc_ids, _IdTable):
+            self._labels = None
+        else:
+            self._labels = {doc_id: label for label, doc_id in enumerate(self._doc_ids) if doc_id is not None}
+        self._read_only = mmap
+        meta_path = dir / EmbeddingIndex._META_FILENAME
+        if meta_path.exists():
+            with meta_path.open() as fp:
+                self.meta = json.load(fp)
+        else:
+            self.meta = {}
+        self.set_search_params(self.meta.get("search_params", ""))
 
     def save(self, dir: Path):
+        self._train()
         faiss.write_index(self._index, str(dir / EmbeddingIndex._INDEX_FILENAME))
-        with (dir / EmbeddingIndex._ID_FILENAME).open("w") as fp:
-            fp.writelines(x + "\n" for x in self._doc_ids)
+        _IdTable.save(dir, self._doc_ids)
+        self.save_meta(dir)
+
+    def save_meta(self, dir: Path):
+        _write_atomic(dir / EmbeddingIndex._META_FILENAME, json.dumps(self.meta))
+
+    def save_version(self, dir: Path) -> Path:
+        """Save as a new version under `dir` and atomically switch CURRENT to it.
+
+        Readers never see a partially written index, and old versions are removed.
+        """
+        versions_dir = dir / EmbeddingIndex._VERSIONS_DIRNAME
+        versions_dir.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(tempfile.mkdtemp(prefix=".tmp-", dir=versions_dir))
+        try:
+            self.save(tmp_dir)
+            version_dir = versions_dir / datetime.now().strftime("%Y%m%d%H%M%S%f")
+            os.rename(tmp_dir, version_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        _write_atomic(dir / EmbeddingIndex._CURRENT_FILENAME, version_dir.name)
+        EmbeddingIndex._remove_old_versions(dir, version_dir.name)
+        return version_dir
+
+    @staticmethod
+    def _remove_old_versions(dir: Path, current_version: str):
+        versions = sorted(
+            path.name for path in (dir / EmbeddingIndex._VERSIONS_DIRNAME).iterdir()
+            if not path.name.startswith(".") and path.name <= current_version
+        )
+        for version in versions[:-EmbeddingIndex.keep_versions]:
+            shutil.rmtree(dir / EmbeddingIndex._VERSIONS_DIRNAME / version, ignore_errors=True)
+        # files of the legacy unversioned layout
+        for filename in (
+            EmbeddingIndex._INDEX_FILENAME,
+            EmbeddingIndex._ID_FILENAME,
+            EmbeddingIndex._ID_DATA_FILENAME,
+            EmbeddingIndex._ID_OFFSETS_FILENAME,
+            EmbeddingIndex._SORTED_IDS_FILENAME,
+            EmbeddingIndex._SORTED_LABELS_FILENAME,
+            EmbeddingIndex._META_FILENAME,
+        ):
+            (dir / filename).unlink(missing_ok=True)
+
+    @staticmethod
+    def current_dir(dir: Path) -> Path:
+        """The directory of the current version under `dir`, or `dir` itself in the legacy unversioned layout."""
+        try:
+            version = (dir / EmbeddingIndex._CURRENT_FILENAME).read_text().strip()
+        except FileNotFoundError:
+            return dir
+        return dir / EmbeddingIndex._VERSIONS_DIRNAME / version
+
+
+class _IdTable(Sequence):
+    """Doc ids by label, read from the offset-indexed id files without a Python object per id."""
+
+    def __init__(self, data: Union[np.ndarray, bytes], offsets: np.ndarray,
+                 sorted_ids: Union[np.ndarray, None] = None, sorted_labels: Union[np.ndarray, None] = None):
+        self._data = data
+        self._offsets = offsets
+        if sorted_ids is None:
+            # saved before the sorted ids were
+            present = [(doc_id.encode(), label) for label, doc_id in enumerate(self) if doc_id is not None]
+            sorted_ids, sorted_labels = _sort_ids(present)
+        self._sorted_ids = sorted_ids
+        self._sorted_labels = sorted_labels
+
+    @staticmethod
+    def load(dir: Path, mmap: bool) -> "_IdTable":
+        offsets = np.load(str(dir / EmbeddingIndex._ID_OFFSETS_FILENAME), mmap_mode="r" if mmap else None)
+        data_path = dir / EmbeddingIndex._ID_DATA_FILENAME
+        if mmap and offsets[-1] > 0:
+            data = np.memmap(str(data_path), dtype=np.uint8, mode="r")
+        else:
+            # empty files can't be mapped
+            with data_path.open("rb") as fp:
+                data = fp.read()
+        sorted_ids_path = dir / EmbeddingIndex._SORTED_IDS_FILENAME
+        if sorted_ids_path.exists():
+            sorted_ids = np.load(str(sorted_ids_path), mmap_mode="r" if mmap else None)
+            sorted_labels = np.load(str(dir / EmbeddingIndex._SORTED_LABELS_FILENAME), mmap_mode="r" if mmap else None)
+            return _IdTable(data, offsets, sorted_ids, sorted_labels)
+        return _IdTable(data, offsets)
+
+    @staticmethod
+    def save(dir: Path, doc_ids: Sequence[Union[str, None]]):
+        encoded = [(doc_id or "").encode() for doc_id in doc_ids]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=offsets[1:])
+        with (dir / EmbeddingIndex._ID_DATA_FILENAME).open("wb") as fp:
+            fp.write(b"".join(encoded))
+        with (dir / EmbeddingIndex._ID_OFFSETS_FILENAME).open("wb") as fp:
+            np.save(fp, offsets)
+        sorted_ids, sorted_labels = _sort_ids([(x, label) for label, x in enumerate(encoded) if x])
+        with (dir / EmbeddingIndex._SORTED_IDS_FILENAME).open("wb") as fp:
+            np.save(fp, sorted_ids)
+        with (dir / EmbeddingIndex._SORTED_LABELS_FILENAME).open("wb") as fp:
+            np.save(fp, sorted_labels)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, label: int) -> Union[str, None]:
+        start, end = self._offsets[label], self._offsets[label + 1]
+        if start == end:
+            return None
+        return bytes(self._data[start:end]).decode()
+
+    def __iter__(self) -> Iterator[Union[str, None]]:
+        return (self[label] for label in range(len(self)))
+
+    def count_present(self) -> int:
+        return int(np.count_nonzero(np.diff(self._offsets)))
+
+    def labels_of(self, keys: np.ndarray) -> np.ndarray:
+        """Labels of the utf-8 encoded doc ids, -1 for unknown ones."""
+        if len(self._sorted_ids) == 0 or len(keys) == 0:
+            return np.full(len(keys), -1, dtype='int64')
+        positions = np.minimum(np.searchsorted(self._sorted_ids, keys), len(self._sorted_ids) - 1)
+        found = self._sorted_ids[positions] == keys
+        return np.where(found, self._sorted_labels[positions], -1).astype('int64')
+
+
+def encode_ids(doc_ids: Iterable[str]) -> np.ndarray:
+    """Doc ids as a numpy array of utf-8 bytes, the form `EmbeddingIndex` looks them up in."""
+    return np.array([doc_id.encode() for doc_id in doc_ids], dtype=bytes)
+
+
+def _sort_ids(ids_and_labels: List[Tuple[bytes, int]]) -> Tuple[np.ndarray, np.ndarray]:
+    ids = np.array([doc_id for doc_id, _ in ids_and_labels], dtype=bytes)
+    labels = np.array([label for _, label in ids_and_labels], dtype='int64')
+    order = np.argsort(ids, kind="stable")
+    return ids[order], labels[order]
+
+
+def _write_atomic(path: Path, content: str):
+    tmp_path = Path(f"{path}.tmp")
+    with tmp_path.open("w") as fp:
+        fp.write(content)
+    os.replace(tmp_path, path)
 
 
 class EmbeddingIndexManager:
     def __init__(self, dir: Path):
         self.dir = dir
         self._index: Union[EmbeddingIndex, None] = None
-        self._last_modified = -1
+        self._version: Union[str, None] = None
+        self._reload_lock = threading.Lock()
+        # set while a watcher reloads new versions in the background
+        self.watched = False
     
-    def search(self, emb: np.array, top_k: int) -> List[Tuple[str, float]]:
+    def search(self, emb: np.array, top_k: int, doc_ids: Union[Iterable[str], np.ndarray, None] = None) -> List[Tuple[str, float]]:
         index = self._load_index()
-        return index.search(emb, top_k)
+        return index.search(emb, top_k, doc_ids)
+
+    def search_batch(
+        self,
+        embs: np.ndarray,
+        top_k: int,
+        doc_ids: Union[Iterable[str], np.ndarray, None] = None,
+    ) -> List[List[Tuple[str, float]]]:
+        index = self._load_index()
+        return index.search_batch(embs, top_k, doc_ids)
 
     def _load_index(self) -> EmbeddingIndex:
-        mtime = (self.dir / EmbeddingIndex._INDEX_FILENAME).stat().st_mtime
+        index = self._index
+        if index is None or not self.watched:
+            self.reload()
+            index = self._index
+        return index
 
-        if self._index is not None and self._last_modified != mtime:
-            self._index = None
+    def reload(self, only_loaded: bool = False) -> bool:
+        """Load the current version if it changed, while the loaded one keeps serving searches.
+
+        Concurrent callers wait for a single load. Returns whether a new version was loaded.
+        """
+        with self._reload_lock:
+            if only_loaded and self._index is None:
+                return False
+            version_dir = EmbeddingIndex.current_dir(self.dir)
+            if version_dir == self.dir:
+                # legacy layout
+                version = str((self.dir / EmbeddingIndex._INDEX_FILENAME).stat().st_mtime)
+            else:
+                version = version_dir.name
+            if version == self._version:
+                return False
 
-        if self._index is None:
             index = EmbeddingIndex()
-            index.load(self.dir)
+            index.load(version_dir, mmap=True)
             self._index = index
-            self._last_modified = mtime
-        return self._index
+            self._version = version
+            logger.info(f"loaded embedding index {self.dir} ({version})")
+            return True
 
 
 class MultiEmbeddingIndexManager:
@@ -80,3 +484,25 @@ class MultiEmbeddingIndexManager:
     
     def get_manager(self, name: str):
         return self.managers[name]
+
+    def start_watcher(self, interval_seconds: float = 10):
+        """Preload new versions of the indexes in use from a background thread."""
+        self._stop_watcher = threading.Event()
+        for manager in self.managers.values():
+            manager.watched = True
+        self._watcher = threading.Thread(target=self._watch, args=(interval_seconds, ), daemon=True)
+        self._watcher.start()
+
+    def stop_watcher(self):
+        self._stop_watcher.set()
+        self._watcher.join()
+        for manager in self.managers.values():
+            manager.watched = False
+
+    def _watch(self, interval_seconds: float):
+        while not self._stop_watcher.wait(interval_seconds):
+            for manager in self.managers.values():
+                try:
+                    manager.reload(only_loaded=True)
+                except Exception:
+                    logger.exception(f"failed to reload embedding index {manager.dir}")
@@ -0,0 +1,32 @@
+from pathlib import Path
+from typing import Any, List, Protocol
+
+import numpy as np
+import PIL.Image
+
+
+class Embedder(Protocol):
+    # images per `extract_preprocessed` call when embedding the library
+    batch_size: int = 1
+
+    def load_model(self): ...
+
+    def preprocess(self, im: PIL.Image.Image) -> Any:
+        """Model input of one decoded RGB image. Can run in other threads while the model runs."""
+        ...
+
+    def extract_preprocessed(self, inputs: List[Any]) -> np.ndarray:
+        """Embeddings of `preprocess` results as rows of a float32 matrix."""
+        ...
+
+    def extract_batch(self, files: List[Path]) -> np.ndarray:
+        return self.extract_preprocessed([self.preprocess(decode_image(file)) for file in files])
+
+    def extract(self, file: Path) -> np.ndarray:
+        return self.extract_batch([file])[0]
+
+
+def decode_image(file: Path) -> PIL.Image.Image:
+    """Decode the image file into an RGB image, to be shared by the models' `preprocess`."""
+    with PIL.Image.open(file) as im:
+        return im.convert("RGB")
@@ -1,12 +1,13 @@
-from pathlib import Path
-import PIL
 import open_clip
+import PIL.Image
 import torch
 
+from pix.embeddings.torch_embedder import TorchEmbedder
 
-class ClipEmbedding:
-    def __init__(self):
-        self._model_loaded = False
+
+class ClipEmbedding(TorchEmbedder):
+    batch_size = 32
+    model_id = "open_clip/ViT-B-32/laion2b_s34b_b79k"
 
     def load_model(self):
         if self._model_loaded:
@@ -14,17 +15,17 @@ class ClipEmbedding:
 
         model, _, preprocess = open_clip.create_model_and_transforms('ViT-B-32', pretrained='laion2b_s34b_b79k')
         model.eval()  # model in train mode by default, impacts some models with BatchNorm or stochastic depth active
-        self.model = model
-        self.preprocess = preprocess
+        self.model = model.to(self.runtime.device)
+        self._preprocess = preprocess
         self.tokenizer = open_clip.get_tokenizer('ViT-B-32')
         self._model_loaded = True
 
-    def extract(self, file: Path):
-        with PIL.Image.open(file) as im:
-            image = self.preprocess(im).unsqueeze(0)
-            with torch.no_grad(), torch.cuda.amp.autocast():
-                return self.model.encode_image(image)[0].numpy()
+    def preprocess(self, im: PIL.Image.Image) -> torch.Tensor:
+        return self._preprocess(im)
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        return self.model.encode_image(images)
     
     def encode_text(self, text: str):
-        with torch.no_grad(), torch.cuda.amp.autocast():
-            return self.model.encode_text(self.tokenizer([text]))[0].numpy()
+        with self.runtime.inference():
+            return self.model.encode_text(self.tokenizer([text]).to(self.runtime.device))[0].float().cpu().numpy()
@@ -1,24 +1,28 @@
 from collections import OrderedDict
 from pathlib import Path
-from typing import Union
 from typing_extensions import Annotated
-import PIL
+import PIL.Image
 import torch
 from torch import nn
 import torchvision.transforms as transforms
 import torchvision.transforms.functional as F
 
 from pix.embeddings.csd_model import CSD_CLIP
+from pix.embeddings.torch_embedder import TorchEmbedder, TorchRuntime
 from pixdb.inject import Value
 
-DEVICE = None  # change to `cuda` to use gpu
 
+class CsdEmbedding(TorchEmbedder):
+    batch_size = 8
 
-class CsdEmbedding:
-    def __init__(self, csd_pretrained_model_path: Annotated[Path, Value]):
-        self._model_loaded = False
+    def __init__(self, runtime: TorchRuntime, csd_pretrained_model_path: Annotated[Path, Value]):
+        super().__init__(runtime)
         self._model_path = csd_pretrained_model_path
 
+    @property
+    def model_id(self) -> str:
+        return f"csd/{self._model_path.name}"
+
     def load_model(self):
         if self._model_loaded:
             return
@@ -32,8 +36,7 @@ class CsdEmbedding:
         msg = model.load_state_dict(state_dict, strict=False)
         # print(f"=> loaded checkpoint with msg {msg}")
 
-        if DEVICE:
-            model = model.to(DEVICE)
+        model = model.to(self.runtime.device)
         
         model.eval()  # model in train mode by default, impacts some models with BatchNorm or stochastic depth active
 
@@ -49,17 +52,15 @@ class CsdEmbedding:
         ])
 
         self.model = model
-        self.preprocess = transforms_branch0
+        self._preprocess = transforms_branch0
         self._model_loaded = True
 
-    def extract(self, file: Path):
-        with PIL.Image.open(file) as im:
-            if im.mode != 'RGB':
-                im = im.convert('RGB')
-            image = self.preprocess(im).unsqueeze(0).to(DEVICE)
-            with torch.no_grad(), torch.cuda.amp.autocast():
-                _, _, emb = self.model(image)
-                return emb[0].cpu().numpy()
+    def preprocess(self, im: PIL.Image.Image) -> torch.Tensor:
+        return self._preprocess(im)
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        _, _, emb = self.model(images)
+        return emb
 
 
 def convert_state_dict(state_dict):
@@ -1,33 +1,32 @@
-from pathlib import Path
-import PIL
+import PIL.Image
 import torch
 from transformers import AutoImageProcessor, AutoModel
 
+from pix.embeddings.torch_embedder import TorchEmbedder, TorchRuntime
 
-class Dinov2Embedding:
-    def __init__(self):
-        self._model_loaded = False
+
+class Dinov2Embedding(TorchEmbedder):
+    batch_size = 16
+    model_id = 'facebook/dinov2-base'
+
+    def __init__(self, runtime: TorchRuntime):
+        super().__init__(runtime)
         self._traced_model = None
 
     def load_model(self):
         if self._model_loaded:
             return
 
-        self.model = AutoModel.from_pretrained('facebook/dinov2-base')
-        self.preprocess = AutoImageProcessor.from_pretrained('facebook/dinov2-base')
+        self.model = AutoModel.from_pretrained(self.model_id).to(self.runtime.device)
+        self.processor = AutoImageProcessor.from_pretrained(self.model_id)
         self._model_loaded = True
 
-    def extract(self, file: Path):
-        with PIL.Image.open(file) as im:
-            inputs = self.preprocess(images=im, return_tensors='pt')
-            return self._model(inputs).pooler_output[0].numpy()
-    
-    def _model(self, inputs):
-        with torch.no_grad(), torch.cuda.amp.autocast():
-            # if self._traced_model is None:
-            #     self.model.config.return_dict = False
-            #     self._traced_model = torch.jit.trace(self.model, [inputs.pixel_values])
-
-            # return self._traced_model(inputs.pixel_values)
-            return self.model(**inputs)
-            
\ No newline at end of file
+    def preprocess(self, im: PIL.Image.Image) -> torch.Tensor:
+        return self.processor(images=im, return_tensors='pt').pixel_values[0]
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        # if self._traced_model is None:
+        #     self.model.config.return_dict = False
+        #     self._traced_model = torch.jit.trace(self.model, [images])
+        # return self._traced_model(images)
+        return self.model(pixel_values=images).pooler_output
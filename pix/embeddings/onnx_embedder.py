@@ -0,0 +1,182 @@
+from dataclasses import dataclass
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+from typing_extensions import Annotated
+
+import numpy as np
+import onnxruntime as rt
+import PIL.Image
+
+from pix.embeddings.base import Embedder
+from pixdb.inject import Value
+
+logger = logging.getLogger(__name__)
+
+_CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+_CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+_IMAGENET_MEAN = (0.485, 0.456, 0.406)
+_IMAGENET_STD = (0.229, 0.224, 0.225)
+
+# bump when `TorchEmbedder.export_onnx` changes the exported graphs, so that they are exported again
+EXPORT_VERSION = 1
+
+
+@dataclass
+class ImageTransform:
+    """Resize, center crop and normalize like the torchvision / transformers preprocessing of a model, in numpy."""
+
+    # shortest side, or (height, width)
+    size: Union[int, Tuple[int, int]]
+    crop_size: Union[int, None]
+    resample: int
+    mean: Tuple[float, float, float]
+    std: Tuple[float, float, float]
+    # transformers floors the crop offsets where torchvision rounds them
+    floor_crop_offsets: bool = False
+
+    @property
+    def input_size(self) -> Tuple[int, int]:
+        if self.crop_size:
+            return self.crop_size, self.crop_size
+        return self.size
+
+    def __call__(self, im: PIL.Image.Image) -> np.ndarray:
+        if isinstance(self.size, int):
+            width, height = im.size
+            if width <= height:
+                width, height = self.size, int(self.size * height / width)
+            else:
+                width, height = int(self.size * width / height), self.size
+        else:
+            height, width = self.size
+        im = im.resize((width, height), self.resample)
+
+        if self.crop_size:
+            if self.floor_crop_offsets:
+                left, top = (width - self.crop_size) // 2, (height - self.crop_size) // 2
+            else:
+                left, top = int(round((width - self.crop_size) / 2.0)), int(round((height - self.crop_size) / 2.0))
+            im = im.crop((left, top, left + self.crop_size, top + self.crop_size))
+
+        x = np.asarray(im, dtype=np.float32) / 255
+        x = (x - np.array(self.mean, dtype=np.float32)) / np.array(self.std, dtype=np.float32)
+        return x.transpose(2, 0, 1)
+
+
+TRANSFORMS: Dict[str, ImageTransform] = {
+    "clip": ImageTransform(224, 224, PIL.Image.BICUBIC, _CLIP_MEAN, _CLIP_STD),
+    "resnet": ImageTransform(232, 224, PIL.Image.BILINEAR, _IMAGENET_MEAN, _IMAGENET_STD),
+    "dinov2": ImageTransform(256, 224, PIL.Image.BICUBIC, _IMAGENET_MEAN, _IMAGENET_STD, floor_crop_offsets=True),
+    "csd": ImageTransform(224, 224, PIL.Image.BICUBIC, _CLIP_MEAN, _CLIP_STD),
+    "siglip2": ImageTransform((256, 256), None, PIL.Image.BILINEAR, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+}
+
+
+class OnnxEmbedder(Embedder):
+    """Runs an embedding model exported by `TorchEmbedder.export_onnx` with ONNX Runtime, without torch."""
+
+    batch_size = 16
+
+    def __init__(self, model_path: Path, transform: ImageTransform, threads: Union[int, None] = None):
+        self.model_path = model_path
+        self._transform = transform
+        self._threads = threads
+        self._session = None
+
+    def load_model(self):
+        if self._session is not None:
+            return
+
+        options = rt.SessionOptions()
+        if self._threads:
+            options.intra_op_num_threads = self._threads
+        session = rt.InferenceSession(str(self.model_path), options)
+        self._input_name = session.get_inputs()[0].name
+        self._output_name = session.get_outputs()[0].name
+        self._session = session
+
+    def preprocess(self, im: PIL.Image.Image) -> np.ndarray:
+        return self._transform(im)
+
+    def extract_preprocessed(self, inputs: List[np.ndarray]) -> np.ndarray:
+        output, = self._session.run([self._output_name], {self._input_name: np.stack(inputs)})
+        return output.astype(np.float32)
+
+
+class OnnxEmbedders:
+    """ONNX graphs of the embedding models under data_dir, like `WdAutotagger` caches its modified graph."""
+
+    def __init__(
+            self,
+            data_dir: Annotated[Path, Value],
+            embedding_onnx_quantize: Annotated[bool, Value],
+            embedding_threads: Annotated[Union[int, None], Value],
+    ):
+        self.dir = data_dir / "onnx"
+        self.quantize = embedding_onnx_quantize
+        self._threads = embedding_threads
+        self._embedders: Dict[str, OnnxEmbedder] = {}
+
+    def path(self, embedding_type: str, quantized: bool = False) -> Path:
+        return self.dir / (f"{embedding_type}.int8.onnx" if quantized else f"{embedding_type}.onnx")
+
+    def meta_path(self, embedding_type: str) -> Path:
+        """{"model_id", "export_version"} of the exported graph, written after it."""
+        return self.dir / f"{embedding_type}.json"
+
+    def exists(self, embedding_type: str) -> bool:
+        """Whether the graph was exported by this version. The model id can only be checked by `export`, with torch."""
+        return (
+            embedding_type in TRANSFORMS
+            and self.path(embedding_type, self.quantize).exists()
+            and self._load_meta(embedding_type).get("export_version") == EXPORT_VERSION
+        )
+
+    def get(self, embedding_type: str) -> Union[OnnxEmbedder, None]:
+        """The embedder of the exported graph (quantized if configured), None if it was not exported."""
+        embedder = self._embedders.get(embedding_type)
+        if embedder is None:
+            embedder = self.create(embedding_type)
+            if embedder is not None:
+                embedder = self._embedders.setdefault(embedding_type, embedder)
+        return embedder
+
+    def create(self, embedding_type: str) -> Union[OnnxEmbedder, None]:
+        """A new embedder not shared with `get`, None if the graph was not exported."""
+        if not self.exists(embedding_type):
+            return None
+        return OnnxEmbedder(self.path(embedding_type, self.quantize), TRANSFORMS[embedding_type], self._threads)
+
+    def export(self, embedding_type: str, torch_embedder):
+        """Export the graph of the torch embedder, and its int8 quantization if configured.
+
+        Graphs exported before from the same model by the same `EXPORT_VERSION` are kept.
+        """
+        path = self.path(embedding_type)
+        quantized_path = self.path(embedding_type, quantized=True)
+        meta = {"model_id": torch_embedder.model_id, "export_version": EXPORT_VERSION}
+        if not path.exists() or self._load_meta(embedding_type) != meta:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            # quantized from the outdated graph
+            quantized_path.unlink(missing_ok=True)
+            logger.info(f"{embedding_type}: exporting to {path}")
+            torch_embedder.export_onnx(path, TRANSFORMS[embedding_type].input_size)
+            with open(self.meta_path(embedding_type), "w") as fp:
+                json.dump(meta, fp)
+
+        if self.quantize and not quantized_path.exists():
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            logger.info(f"{embedding_type}: quantizing to {quantized_path}")
+            tmp_path = quantized_path.with_name(quantized_path.name + ".tmp")
+            quantize_dynamic(path, tmp_path, weight_type=QuantType.QInt8)
+            tmp_path.replace(quantized_path)
+
+    def _load_meta(self, embedding_type: str) -> dict:
+        path = self.meta_path(embedding_type)
+        if not path.exists():
+            return {}
+        with open(path) as fp:
+            return json.load(fp)
@@ -0,0 +1,65 @@
+import importlib
+import logging
+from typing import Callable, Dict, Tuple, Type, Union
+from typing_extensions import Annotated
+
+from pix.embeddings.base import Embedder
+from pix.embeddings.onnx_embedder import OnnxEmbedders
+from pixdb.inject import Graph, Value
+
+logger = logging.getLogger(__name__)
+
+# imported on first use, so that torch is not imported when running on ONNX Runtime
+TORCH_EMBEDDERS: Dict[str, str] = {
+    "clip": "pix.embeddings.clip:ClipEmbedding",
+    "resnet": "pix.embeddings.resnet:ResnetEmbedding",
+    "dinov2": "pix.embeddings.dinov2:Dinov2Embedding",
+    "csd": "pix.embeddings.csd:CsdEmbedding",
+    "siglip2": "pix.embeddings.siglip2:Siglip2Embedding",
+}
+
+
+class EmbedderProvider:
+    """Embedders by embedding type, on the runtime selected by the `embedding_runtime` setting.
+
+    With "onnx", the graphs exported by the `export_onnx` task are used, falling back to torch for
+    embedding types that were not exported.
+    """
+
+    def __init__(self, graph: Graph, embedding_runtime: Annotated[str, Value], onnx_embedders: OnnxEmbedders):
+        self._graph = graph
+        self._runtime = embedding_runtime
+        self._onnx_embedders = onnx_embedders
+
+    def runtime_of(self, embedding_type: str) -> str:
+        """The runtime embedders of the type run on, "onnx" or "torch"."""
+        if self._runtime == "onnx":
+            if self._onnx_embedders.exists(embedding_type):
+                return "onnx"
+            logger.warning(f"{embedding_type}: no exported ONNX graph, using torch")
+        return "torch"
+
+    def get(self, embedding_type: str) -> Embedder:
+        if self.runtime_of(embedding_type) == "onnx":
+            return self._onnx_embedders.get(embedding_type)
+        return self.get_torch(embedding_type)
+
+    def get_torch(self, embedding_type: str) -> Embedder:
+        return self._graph.get_instance(self.torch_class(embedding_type))
+
+    def create(self, embedding_type: str, runtime: Union[str, None] = None) -> Embedder:
+        """A new embedder not shared with `get`, e.g. to be owned by the `ModelRegistry`."""
+        if (runtime or self.runtime_of(embedding_type)) == "onnx":
+            return self._onnx_embedders.create(embedding_type)
+        return self._graph.create_instance(self.torch_class(embedding_type))
+
+    def registry_entry(self, embedding_type: str, runtime: Union[str, None] = None) -> Tuple[str, Callable[[], Embedder]]:
+        """Key and factory of the embedder in the `ModelRegistry`, so that the pipeline and queries running
+        in the API process share one instance."""
+        runtime = runtime or self.runtime_of(embedding_type)
+        return f"{runtime}:{embedding_type}", lambda: self.create(embedding_type, runtime)
+
+    @staticmethod
+    def torch_class(embedding_type: str) -> Type[Embedder]:
+        module_name, class_name = TORCH_EMBEDDERS[embedding_type].split(":")
+        return getattr(importlib.import_module(module_name), class_name)
@@ -1,13 +1,14 @@
-from pathlib import Path
-import PIL
+import PIL.Image
 import torch
 from torchvision import models
 from torchvision.models.feature_extraction import create_feature_extractor
 
+from pix.embeddings.torch_embedder import TorchEmbedder
 
-class ResnetEmbedding:
-    def __init__(self):
-        self._model_loaded = False
+
+class ResnetEmbedding(TorchEmbedder):
+    batch_size = 32
+    model_id = f"torchvision/resnet152/{models.ResNet152_Weights.DEFAULT.name}"
 
     def load_model(self):
         if self._model_loaded:
@@ -16,14 +17,12 @@ class ResnetEmbedding:
         model = models.resnet152(weights=models.ResNet152_Weights.DEFAULT)
         model = create_feature_extractor(model, return_nodes={'flatten': 'flatten'})
         model.eval()
-        self.model = model
-        self.preprocess = models.ResNet152_Weights.DEFAULT.transforms()
+        self.model = model.to(self.runtime.device)
+        self._preprocess = models.ResNet152_Weights.DEFAULT.transforms()
         self._model_loaded = True
 
-    def extract(self, file: Path):
-        with PIL.Image.open(file) as im:
-            if im.mode != 'RGB':
-                im = im.convert('RGB')
-            image = self.preprocess(im).unsqueeze(0)
-            with torch.no_grad(), torch.cuda.amp.autocast():
-                return self.model(image)['flatten'].numpy()
+    def preprocess(self, im: PIL.Image.Image) -> torch.Tensor:
+        return self._preprocess(im)
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        return self.model(images)['flatten']
@@ -0,0 +1,92 @@
+from contextlib import contextmanager
+import logging
+from pathlib import Path
+from typing import List, Tuple, Union
+from typing_extensions import Annotated
+
+import numpy as np
+import torch
+
+from pix.embeddings.base import Embedder
+from pixdb.inject import Value
+
+logger = logging.getLogger(__name__)
+
+
+class TorchRuntime:
+    """Device, precision and threads the torch embedding models run with."""
+
+    def __init__(
+            self,
+            embedding_device: Annotated[Union[str, None], Value],
+            embedding_dtype: Annotated[str, Value],
+            embedding_threads: Annotated[Union[int, None], Value],
+    ):
+        cuda_available = torch.cuda.is_available()
+        if embedding_device is None:
+            embedding_device = "cuda" if cuda_available else "cpu"
+        elif embedding_device.startswith("cuda") and not cuda_available:
+            logger.warning(f"{embedding_device} is not available, falling back to cpu")
+            embedding_device = "cpu"
+        self.device = torch.device(embedding_device)
+        # mixed precision only pays off on gpu
+        self.autocast_dtype = getattr(torch, embedding_dtype) if self.device.type == "cuda" else None
+        if embedding_threads:
+            torch.set_num_threads(embedding_threads)
+
+    @contextmanager
+    def inference(self):
+        with torch.inference_mode(), torch.autocast(
+            self.device.type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None
+        ):
+            yield
+
+
+class TorchEmbedder(Embedder):
+    """Runs a torch model on stacked batches of preprocessed images.
+
+    Subclasses load `self.model` onto `self.runtime.device` in `load_model`, and implement `preprocess`
+    (a tensor without the batch dimension) and `forward`.
+    """
+
+    # the weights loaded by `load_model`, to tell whether a graph exported by `export_onnx` is outdated
+    model_id: str = ""
+
+    def __init__(self, runtime: TorchRuntime):
+        self.runtime = runtime
+        self._model_loaded = False
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError
+
+    def extract_preprocessed(self, inputs: List[torch.Tensor]) -> np.ndarray:
+        with self.runtime.inference():
+            return self.forward(torch.stack(inputs).to(self.runtime.device)).float().cpu().numpy()
+
+    def export_onnx(self, path: Path, input_size: Tuple[int, int]):
+        """Export `forward` as an ONNX graph taking a batch of `preprocess` results of any size."""
+        self.load_model()
+        tmp_path = path.with_name(path.name + ".tmp")
+        with torch.no_grad():
+            torch.onnx.export(
+                _ForwardModule(self).eval(),
+                torch.zeros(1, 3, *input_size, device=self.runtime.device),
+                tmp_path,
+                input_names=["images"],
+                output_names=["embeddings"],
+                dynamic_axes={"images": {0: "batch"}, "embeddings": {0: "batch"}},
+                opset_version=17,
+                # TorchScript-based exporter, the quantizer fails on the shapes recorded by the dynamo one
+                dynamo=False,
+            )
+        tmp_path.replace(path)
+
+
+class _ForwardModule(torch.nn.Module):
+    def __init__(self, embedder: TorchEmbedder):
+        super().__init__()
+        self.model = embedder.model
+        self._forward = embedder.forward
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        return self._forward(images).float()
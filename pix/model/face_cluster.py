@@ -1,9 +1,10 @@
 import sqlalchemy as sa
-from typing import List, Union
+from typing import Callable, Collection, Dict, List, Union
 from pydantic import BaseModel
+from pixdb.db import Database
 from pixdb.repo import Repo
 
-from pixdb.schema import IndexField, Schema
+from pixdb.schema import IndexField, Indexer, Schema
 from pix.model.base import metadata
 
 
@@ -27,6 +28,17 @@ class FaceClusterRepo(Repo[FaceCluster]):
         lambda fc: [(face.image_id, face.index) for face in fc.faces]
     )
 
+    def __init__(self, db: Database):
+        super().__init__(db)
+        # called with the ids of images whose faces were added to or removed from clusters, e.g. to update caches
+        self.face_change_listeners: List[Callable[[Collection[str]], None]] = []
+
+    def _on_index_changed(self, indexer: Indexer, inserted_rows: List[Dict], deleted_rows: List[Dict]):
+        if indexer is self.idx_face_ref:
+            changed_ids = {row["image_id"] for row in inserted_rows} | {row["image_id"] for row in deleted_rows}
+            for listener in self.face_change_listeners:
+                listener(changed_ids)
+
     def get_by_face_ref(self, image_id: str, index: int) -> Union[FaceCluster, None]:
         fc = self.db.execute(
             sa.select(self.table)
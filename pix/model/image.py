@@ -1,17 +1,27 @@
 import base64
+from collections import Counter
 from dataclasses import dataclass
 import datetime
 from enum import Enum
+import logging
 import numpy as np
 import sqlalchemy as sa
-from typing import List, Mapping, Tuple, Union
-from pydantic import BaseModel
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from typing import Callable, Collection, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple, Union
+from pydantic import BaseModel, Field, PrivateAttr, model_validator
 from pix.model.face_cluster import FaceClusterRepo
+from pixdb.db import Database
 from pixdb.repo import Repo
 
-from pixdb.schema import IndexField, Schema
+from pixdb.schema import IndexField, Indexer, Schema
 from pix.model.base import metadata
 
+logger = logging.getLogger(__name__)
+
+# name of the WD tagger embedding (`Image.embedding`) in the embedding store
+EMBEDDING_TYPE_DEFAULT = "default"
+
 
 class TagType(Enum):
     CHARACTER = "CHARACTER"
@@ -57,10 +67,25 @@ class Image(BaseModel):
 
     tags: Union[List[ImageTag], None] = None
     manual_tags: Union[List[ImageTag], None] = None
-    embedding: Union[Vector, None] = None
-    embeddings: Union[Mapping[str, Vector], None] = None
+    # predictions of the custom autotagger, replaced as a whole by each run
+    custom_tags: Union[List[ImageTag], None] = None
+    embedding_types: List[str] = []
+    # Vectors are not stored in the document but in ImageRepo's embedding table,
+    # they are only present when loaded with `ImageRepo.load_embeddings` or newly set.
+    embedding: Union[Vector, None] = Field(default=None, exclude=True)
+    embeddings: Union[Mapping[str, Vector], None] = Field(default=None, exclude=True)
     faces: Union[List[ImageFace], None] = None
 
+    # vectors as loaded from the embedding store, to skip rewriting unchanged ones
+    _stored_embeddings: Dict[str, Vector] = PrivateAttr(default_factory=dict)
+    _removed_embedding_types: Set[str] = PrivateAttr(default_factory=set)
+
+    @model_validator(mode="after")
+    def _add_loaded_embedding_types(self):
+        # documents written before the embedding store have the vectors inline
+        self.embedding_types = list(dict.fromkeys(self.embedding_types + list(self.get_all_embeddings().keys())))
+        return self
+
     def get_all_tags(self) -> List[ImageTag]:
         tags = []
         if self.manual_tags:
@@ -68,8 +93,52 @@ class Image(BaseModel):
                 tags.append(tag.model_copy(update={"score": tag.score or 1.0}))
         if self.tags:
             tags.extend(self.tags)
+        if self.custom_tags:
+            tags.extend(self.custom_tags)
         return tags
 
+    def get_tag_scores(self) -> Dict[str, Union[float, None]]:
+        """Score of each distinct tag of `get_all_tags`; a manual tag takes precedence over the same autotag."""
+        scores = {}
+        for tag in self.get_all_tags():
+            scores.setdefault(tag.tag, tag.score)
+        return scores
+
+    def get_embedding(self, embedding_type: str) -> Union[Vector, None]:
+        if embedding_type == EMBEDDING_TYPE_DEFAULT:
+            return self.embedding
+        if not self.embeddings:
+            return None
+        return self.embeddings.get(embedding_type)
+
+    def set_embedding(self, embedding_type: str, vector: Vector):
+        if embedding_type == EMBEDDING_TYPE_DEFAULT:
+            self.embedding = vector
+        else:
+            if not self.embeddings:
+                self.embeddings = {}
+            self.embeddings[embedding_type] = vector
+        self._removed_embedding_types.discard(embedding_type)
+
+    def remove_embedding(self, embedding_type: str):
+        """Remove the embedding, also from the embedding store when the image is written next time."""
+        if embedding_type == EMBEDDING_TYPE_DEFAULT:
+            self.embedding = None
+        elif self.embeddings:
+            self.embeddings = {k: v for k, v in self.embeddings.items() if k != embedding_type}
+        self.embedding_types = [t for t in self.embedding_types if t != embedding_type]
+        self._stored_embeddings.pop(embedding_type, None)
+        self._removed_embedding_types.add(embedding_type)
+
+    def get_all_embeddings(self) -> Dict[str, Vector]:
+        """Embeddings currently loaded in this document, including the default one."""
+        embeddings = {}
+        if self.embedding:
+            embeddings[EMBEDDING_TYPE_DEFAULT] = self.embedding
+        if self.embeddings:
+            embeddings.update(self.embeddings)
+        return embeddings
+
 
 @dataclass
 class TagQueryTermTag:
@@ -128,11 +197,11 @@ class ImageRepo(Repo[Image]):
     )
     idx_tag_new = schema.add_indexer(
         [IndexField("tag", sa.String), IndexField("collected_at", sa.DateTime, descending=True)],
-        lambda image: [(tag.tag, image.collected_at) for tag in image.get_all_tags()],
+        lambda image: [(tag, image.collected_at) for tag in image.get_tag_scores()],
     )
     idx_tag_score = schema.add_indexer(
         [IndexField("tag", sa.String), IndexField("score", sa.Float, descending=True)],
-        lambda image: [(tag.tag, tag.score) for tag in image.get_all_tags()],
+        lambda image: list(image.get_tag_scores().items()),
     )
     idx_needs_autotagging = schema.add_indexer(
         [IndexField("needs_autotagging", sa.Boolean)],
@@ -140,53 +209,380 @@ class ImageRepo(Repo[Image]):
     )
     idx_embedding_types = schema.add_indexer(
         [IndexField("embedding_type", sa.String)],
-        lambda image: [(k, ) for k in image.embeddings.keys()] if image.embeddings else [],
+        lambda image: [(k, ) for k in image.embedding_types],
+    )
+    embedding_table = sa.Table(
+        "ImageEmbedding",
+        metadata,
+        sa.Column("embedding_type", sa.String, primary_key=True),
+        sa.Column("image_id", sa.String, sa.ForeignKey(schema.table.c.id), primary_key=True),
+        sa.Column("dtype", sa.String, nullable=False),
+        sa.Column("data", sa.LargeBinary, nullable=False),
+    )
+    # append-only log of written/removed vectors, consumed incrementally by index builds
+    embedding_change_table = sa.Table(
+        "ImageEmbeddingChange",
+        metadata,
+        sa.Column("seq", sa.Integer, primary_key=True),
+        sa.Column("embedding_type", sa.String, nullable=False),
+        sa.Column("image_id", sa.String, nullable=False),
+    )
+    # number of `idx_tag_score` entries by tag, maintained from the index changes
+    tag_count_table = sa.Table(
+        "ImageTagCount",
+        metadata,
+        sa.Column("tag", sa.String, primary_key=True),
+        sa.Column("count", sa.Integer, nullable=False),
     )
 
+    def __init__(self, db: Database):
+        super().__init__(db)
+        # called with the ids of written images whose tags changed or that are new, e.g. to update caches
+        self.tag_change_listeners: List[Callable[[Collection[str]], None]] = []
+
+    def _put_many(self, docs_by_id: Dict[str, Image]):
+        for image in docs_by_id.values():
+            image.embedding_types = list(dict.fromkeys(image.embedding_types + list(image.get_all_embeddings().keys())))
+
+        with self.db.transactional():
+            super()._put_many(docs_by_id)
+            self._put_embeddings(docs_by_id.values())
+
+    def _select_docs(self, fields: Optional[Collection[str]] = None):
+        query = super()._select_docs(fields)
+        if fields is not None and "embedding_types" in fields:
+            # documents written before the embedding store have the vectors inline, see `_projection_from_row`
+            query = query.add_columns(
+                self._content_field("embedding").label("_inline_embedding"),
+                self._content_field("embeddings").label("_inline_embeddings"),
+            )
+        return query
+
+    def _projection_from_row(self, row, fields: Collection[str]):
+        projection = super()._projection_from_row(row, fields)
+        if "embedding_types" in fields:
+            inline_types = list(row._mapping["_inline_embeddings"] or {})
+            if row._mapping["_inline_embedding"] is not None:
+                inline_types.insert(0, EMBEDDING_TYPE_DEFAULT)
+            projection.embedding_types = list(dict.fromkeys(projection.embedding_types + inline_types))
+        return projection
+
+    def _put_embeddings(self, images: Iterable[Image]):
+        rows = []
+        removed = []
+        for image in images:
+            removed.extend({"_embedding_type": embedding_type, "_image_id": image.id} for embedding_type in image._removed_embedding_types)
+            image._removed_embedding_types.clear()
+            for embedding_type, vector in image.get_all_embeddings().items():
+                if image._stored_embeddings.get(embedding_type) is vector:
+                    continue
+                arr = vector.to_numpy()
+                rows.append({
+                    "embedding_type": embedding_type,
+                    "image_id": image.id,
+                    "dtype": arr.dtype.name,
+                    "data": arr.tobytes(),
+                })
+                image._stored_embeddings[embedding_type] = vector
+        deletes = removed + [{"_embedding_type": row["embedding_type"], "_image_id": row["image_id"]} for row in rows]
+        if not deletes:
+            return
+
+        t = self.embedding_table
+        self.db.execute(
+            sa.delete(t).where((t.c.embedding_type == sa.bindparam("_embedding_type")) & (t.c.image_id == sa.bindparam("_image_id"))),
+            deletes,
+        )
+        if rows:
+            self.db.execute(sa.insert(t), rows)
+        self.db.execute(
+            sa.insert(self.embedding_change_table),
+            [{"embedding_type": params["_embedding_type"], "image_id": params["_image_id"]} for params in deletes],
+        )
+
+    def _on_index_changed(self, indexer: Indexer, inserted_rows: List[Dict], deleted_rows: List[Dict]):
+        if indexer is self.idx_tag_score:
+            deltas = Counter(row["tag"] for row in inserted_rows)
+            deltas.subtract(row["tag"] for row in deleted_rows)
+            self._update_tag_counts({tag: delta for tag, delta in deltas.items() if delta})
+        if indexer is self.idx_tag_new or indexer is self.idx_collected_at:
+            changed_ids = {row["id"] for row in inserted_rows} | {row["id"] for row in deleted_rows}
+            for listener in self.tag_change_listeners:
+                listener(changed_ids)
+
+    def _update_tag_counts(self, deltas: Dict[str, int]):
+        if not deltas:
+            return
+        t = self.tag_count_table
+        insert = pg_insert if self.db.engine.dialect.name == "postgresql" else sqlite_insert
+        upsert = insert(t)
+        upsert = upsert.on_conflict_do_update(index_elements=[t.c.tag], set_={"count": t.c.count + upsert.excluded.count})
+        # in the same order in every transaction, so that concurrent writers don't deadlock on the row locks
+        self.db.execute(upsert, [{"tag": tag, "count": delta} for tag, delta in sorted(deltas.items())])
+        decreased_tags = [tag for tag, delta in deltas.items() if delta < 0]
+        for chunk in self._chunked(decreased_tags):
+            self.db.execute(sa.delete(t).where(t.c.tag.in_(chunk) & (t.c.count <= 0)))
+
+    def ensure_tag_counts(self):
+        """Count the tags if the count table is empty, e.g. it was just created on an existing database.
+
+        Writes only apply their deltas to the counts, so run this at startup before images are written.
+        """
+        if self.db.execute(sa.select(self.tag_count_table.c.tag).limit(1)).first() is None:
+            self.rebuild_tag_counts()
+
+    def rebuild_tag_counts(self):
+        """Recount the tags from `idx_tag_score`, e.g. after the index was rebuilt."""
+        t = self.tag_count_table
+        with self.db.transactional():
+            self.db.execute(sa.delete(t))
+            self.db.execute(sa.insert(t).from_select(
+                ["tag", "count"],
+                sa.select(self.idx_tag_score.c.tag, sa.func.count())
+                    .where(self.idx_tag_score.c.tag.is_not(None))
+                    .group_by(self.idx_tag_score.c.tag),
+            ))
+
+    def rebuild_index(self, indexers: List[Indexer], progress_callback: Optional[Callable] = None):
+        super().rebuild_index(indexers, progress_callback)
+        if self.idx_tag_score in indexers:
+            self.rebuild_tag_counts()
+
+    def repair_tag_indexes(self):
+        """Rewrite the tag index entries of images listed more than once under a tag.
+
+        Entries were written per `get_all_tags` before, so a tag both in manual tags and autotags had two rows.
+        Only the affected images are rewritten, but finding them scans the whole index, so this is run once
+        by the `repair_tag_indexes` task rather than at startup.
+        """
+        t = self.idx_tag_new.table
+        duplicated = sa.select(t.c.id).group_by(t.c.id, t.c.tag).having(sa.func.count() > 1).subquery()
+        ids = [row.id for row in self.db.execute(sa.select(duplicated.c.id).distinct())]
+        if not ids:
+            return
+
+        for chunk in self._chunked(ids):
+            with self.db.transactional():
+                for id, image in self.get_many(chunk).items():
+                    self._update_index(self.idx_tag_new, id, image)
+                    self._update_index(self.idx_tag_score, id, image)
+        self.rebuild_tag_counts()
+        for listener in self.tag_change_listeners:
+            listener(set(ids))
+        logger.info(f"repaired tag index entries of {len(ids)} images")
+
+    def load_embeddings(self, images: Iterable[Image], embedding_types: Optional[Iterable[str]] = None):
+        """Load vectors from the embedding store into `embedding`/`embeddings` of the given images."""
+        images_by_id = {image.id: image for image in images}
+        t = self.embedding_table
+        condition = []
+        if embedding_types is not None:
+            condition.append(t.c.embedding_type.in_(list(embedding_types)))
+        for chunk in self._chunked(list(images_by_id.keys())):
+            for row in self.db.execute(sa.select(t).where(t.c.image_id.in_(chunk), *condition)):
+                image = images_by_id[row.image_id]
+                vector = Vector.from_numpy(np.frombuffer(row.data, dtype=row.dtype))
+                image.set_embedding(row.embedding_type, vector)
+                image._stored_embeddings[row.embedding_type] = vector
+
+    def iter_embeddings(self, embedding_types: Collection[str]) -> Iterator[Tuple[str, str, np.ndarray]]:
+        """Scan the embedding store once, yielding (embedding_type, image_id, vector) of the given types."""
+        t = self.embedding_table
+        for row in self.db.execute(
+            sa.select(t.c.embedding_type, t.c.image_id, t.c.dtype, t.c.data)
+                .where(t.c.embedding_type.in_(list(embedding_types)))
+        ):
+            yield row.embedding_type, row.image_id, np.frombuffer(row.data, dtype=row.dtype)
+
+    def get_embeddings(self, embedding_type: str, image_ids: Iterable[str]) -> Dict[str, np.ndarray]:
+        t = self.embedding_table
+        result = {}
+        for chunk in self._chunked(list(image_ids)):
+            for row in self.db.execute(
+                sa.select(t.c.image_id, t.c.dtype, t.c.data)
+                    .where((t.c.embedding_type == embedding_type) & t.c.image_id.in_(chunk))
+            ):
+                result[row.image_id] = np.frombuffer(row.data, dtype=row.dtype)
+        return result
+
+    def list_ids_with_embedding(self, embedding_type: str) -> List[str]:
+        t = self.embedding_table
+        return list(self.db.execute(sa.select(t.c.image_id).where(t.c.embedding_type == embedding_type)).scalars())
+
+    def list_ids_with_inline_embeddings(self) -> List[str]:
+        """Images whose documents still hold their vectors inline, as written before the embedding store."""
+        return list(self.db.execute(
+            sa.select(self.table.c.id).where(sa.or_(
+                self._content_field("embedding").as_string().is_not(None),
+                self._content_field("embeddings").as_string().is_not(None),
+            ))
+        ).scalars())
+
+    def last_embedding_change_seq(self) -> int:
+        return self.db.execute(sa.select(sa.func.max(self.embedding_change_table.c.seq))).scalar() or 0
+
+    def list_embedding_changes(self, after_seq: int) -> List[Tuple[int, str, str]]:
+        """(seq, embedding_type, image_id) of vectors written or removed after `after_seq`."""
+        t = self.embedding_change_table
+        return [tuple(row) for row in self.db.execute(
+            sa.select(t.c.seq, t.c.embedding_type, t.c.image_id)
+                .where(t.c.seq > after_seq)
+                .order_by(t.c.seq)
+        )]
+
+    def prune_embedding_changes(self, up_to_seq: int):
+        """Delete the changes at or below `up_to_seq`, once every reader of the changes has applied them.
+
+        The last change is kept, so that seqs keep increasing on backends that reuse the largest deleted key
+        (sqlite without AUTOINCREMENT).
+        """
+        t = self.embedding_change_table
+        up_to_seq = min(up_to_seq, self.last_embedding_change_seq() - 1)
+        with self.db.transactional():
+            self.db.execute(sa.delete(t).where(t.c.seq <= up_to_seq))
+
     def count(self) -> int:
         return self.db.execute(sa.select(sa.func.count()).select_from(self.table)).first()[0]
 
-    def list_by_collected_at_desc(self, offset: int, limit: int, descending: bool = True) -> List[Image]:
-        order_by = self.idx_collected_at.c.collected_at
-        if descending:
-            order_by = order_by.desc()
-        return [self._doc_from_row(row) for row in self.db.execute(
-            sa.select(self.table)
-                .join(self.idx_collected_at.table, self.table.c.id == self.idx_collected_at.c.id)
-                .order_by(order_by)
+    def list_by_collected_at_desc(self, offset: int, limit: int, descending: bool = True,
+                                  fields: Optional[Collection[str]] = None,
+                                  after: Optional[Tuple[datetime.datetime, str]] = None) -> List[Image]:
+        """`after` is the (collected_at, id) of the last image of the previous page, to seek instead of offset."""
+        t = self.idx_collected_at.table
+        return [self._doc_from_row(row, fields) for row in self.db.execute(
+            self._select_docs(fields)
+                .join(t, self.table.c.id == t.c.id)
+                .where(*self._collected_at_keyset_condition(t, descending, after))
+                .order_by(*self._collected_at_order_by(t, descending))
                 .offset(offset)
                 .limit(limit)
         )]
 
-    def list_by_tag_collected_at_desc(self, tag: TagQuery, offset: int, limit: int, descending: bool = True) -> List[Image]:
-        order_by = self.idx_collected_at.c.collected_at
-        if descending:
-            order_by = order_by.desc()
-        return [self._doc_from_row(row) for row in self.db.execute(
-            sa.select(self.table)
-                .join(self.idx_collected_at.table, self.idx_collected_at.c.id == self.table.c.id)
-                .where(*self._tag_condition(self.table, tag))
-                .order_by(order_by)
+    def list_by_tag_collected_at_desc(self, tag: TagQuery, offset: int, limit: int, descending: bool = True,
+                                      fields: Optional[Collection[str]] = None,
+                                      after: Optional[Tuple[datetime.datetime, str]] = None) -> List[Image]:
+        return [self._doc_from_row(row, fields) for row in self.db.execute(
+            self._select_by_tag_collected_at(tag, offset, limit, descending, fields, after)
+        )]
+
+    def _select_by_tag_collected_at(self, tag: TagQuery, offset: int, limit: int, descending: bool = True,
+                                    fields: Optional[Collection[str]] = None,
+                                    after: Optional[Tuple[datetime.datetime, str]] = None) -> sa.Select:
+        t, conditions = self._plan_tag_query(tag)
+        return (
+            self._select_docs(fields)
+                .join(t, t.c.id == self.table.c.id)
+                .where(*conditions)
+                .where(*self._collected_at_keyset_condition(t, descending, after))
+                .order_by(*self._collected_at_order_by(t, descending))
                 .offset(offset)
                 .limit(limit)
-        )]
+        )
+
+    def _collected_at_order_by(self, t: sa.Table, descending: bool):
+        # id breaks ties of images collected at the same time, so that the order is stable for keyset pagination
+        order_by = [t.c.collected_at, t.c.id]
+        if descending:
+            order_by = [column.desc() for column in order_by]
+        return order_by
+
+    def _collected_at_keyset_condition(self, t: sa.Table, descending: bool,
+                                       after: Optional[Tuple[datetime.datetime, str]]):
+        if after is None:
+            return []
+        collected_at, id = after
+        if descending:
+            return [(t.c.collected_at < collected_at) | ((t.c.collected_at == collected_at) & (t.c.id < id))]
+        return [(t.c.collected_at > collected_at) | ((t.c.collected_at == collected_at) & (t.c.id > id))]
     
     def count_by_tag(self, tag: TagQuery) -> int:
+        t, conditions = self._plan_tag_query(tag)
         return self.db.execute(
             sa.select(sa.func.count())
-                .select_from(self.table)
-                .where(*self._tag_condition(self.table, tag))
+                .select_from(t)
+                .where(*conditions)
         ).first()[0]
 
+    def get_tags_by_id(self, image_ids: Optional[Iterable[str]] = None) -> Dict[str, Set[str]]:
+        """Tags (`get_all_tags`) of the given existing images, or of all images."""
+        t = self.idx_tag_new.table
+        query = sa.select(self.table.c.id, t.c.tag).outerjoin(t, t.c.id == self.table.c.id)
+        if image_ids is None:
+            chunks = [None]
+        else:
+            chunks = self._chunked(list(image_ids))
+        result = {}
+        for chunk in chunks:
+            for row in self.db.execute(query if chunk is None else query.where(self.table.c.id.in_(chunk))):
+                tags = result.setdefault(row.id, set())
+                if row.tag is not None:
+                    tags.add(row.tag)
+        return result
+
+    def list_face_refs(self, image_ids: Optional[Collection[str]] = None) -> List[Tuple[str, str]]:
+        """(face_cluster_id, image_id) of the clustered faces, of all images or the given ones."""
+        t = FaceClusterRepo.idx_face_ref.table
+        if image_ids is None:
+            return self.db.execute(sa.select(t.c.id, t.c.image_id)).all()
+        result = []
+        for chunk in self._chunked(list(image_ids)):
+            result.extend(self.db.execute(sa.select(t.c.id, t.c.image_id).where(t.c.image_id.in_(chunk))).all())
+        return result
+
+    def list_ids_by_tag(self, tag: TagQuery) -> List[str]:
+        t, conditions = self._plan_tag_query(tag)
+        return [row.id for row in self.db.execute(
+            sa.select(t.c.id).where(*conditions)
+        )]
+
+    def _plan_tag_query(self, tag: Union[str, TagQuery]) -> Tuple[sa.Table, List]:
+        """Pick the index table to scan for a tag query, with one row per matching image and its collected_at.
+
+        The `idx_tag_new` entries of the most selective positive tag can be walked in collected_at order,
+        with the other terms as semi/anti-joins. Without positive tags, all images are walked with `idx_collected_at`.
+        """
+        if not isinstance(tag, TagQuery):
+            tag = TagQuery.parse(tag)
+        positive_tags = list(dict.fromkeys(
+            term.tag.tag for term in tag.terms
+            if isinstance(term.tag, TagQueryTermTag) and not term.negated
+        ))
+        if not positive_tags:
+            t = self.idx_collected_at.table
+            return t, self._tag_condition(t, tag)
+
+        if len(positive_tags) > 1:
+            counts = self._count_tag_entries(positive_tags)
+            driving_tag = min(positive_tags, key=lambda tag: counts.get(tag, 0))
+        else:
+            driving_tag = positive_tags[0]
+        other_terms = [
+            term for term in tag.terms
+            if term.negated or not isinstance(term.tag, TagQueryTermTag) or term.tag.tag != driving_tag
+        ]
+        t = self.idx_tag_new.table
+        return t, [t.c.tag == driving_tag, *self._tag_condition(t, TagQuery(other_terms))]
+
+    def _count_tag_entries(self, tags: List[str]) -> Dict[str, int]:
+        t = self.idx_tag_new.table
+        return dict(self.db.execute(
+            sa.select(t.c.tag, sa.func.count())
+                .where(t.c.tag.in_(tags))
+                .group_by(t.c.tag)
+        ).all())
+
     def _tag_condition(self, table: sa.Table, tag: Union[str, TagQuery]):
         clauses = []
         if not isinstance(tag, TagQuery):
             tag = TagQuery.parse(tag)
+        # aliased so that they are not correlated when `table` is the same index table
+        idx_tag_new = self.idx_tag_new.table.alias()
+        idx_face_ref = FaceClusterRepo.idx_face_ref.table.alias()
         for term in tag.terms:
             if isinstance(term.tag, TagQueryTermTag):
-                q = sa.select(self.idx_tag_new.c.id).where(self.idx_tag_new.c.tag == term.tag.tag)
+                q = sa.select(idx_tag_new.c.id).where(idx_tag_new.c.tag == term.tag.tag)
             elif isinstance(term.tag, TagQueryTermFace):
-                q = sa.select(FaceClusterRepo.idx_face_ref.c.image_id).where(FaceClusterRepo.idx_face_ref.c.id == term.tag.face_cluster_id)
+                q = sa.select(idx_face_ref.c.image_id).where(idx_face_ref.c.id == term.tag.face_cluster_id)
             else:
                 raise ValueError("unknown tag type")
 
@@ -223,9 +619,15 @@ class ImageRepo(Repo[Image]):
         )]
     
     def list_all_tags_with_count(self, q: Union[str, None]) -> List[Tuple[str, int]]:
-        query = sa.select(self.idx_tag_score.c.tag, sa.func.count())
-        if q:
-            query = query.where(*self._tag_condition(self.idx_tag_score.table, q))
+        """Tags with their image counts, or with the counts among the images matching the query `q`."""
+        if not q:
+            t = self.tag_count_table
+            return self.db.execute(sa.select(t.c.tag, t.c.count)).all()
+
+        # tags co-occurring in the images matching the query
+        matching, conditions = self._plan_tag_query(q)
         return self.db.execute(
-            query.group_by(self.idx_tag_score.c.tag)
+            sa.select(self.idx_tag_score.c.tag, sa.func.count())
+                .where(self.idx_tag_score.c.id.in_(sa.select(matching.c.id).where(*conditions)))
+                .group_by(self.idx_tag_score.c.tag)
         ).all()
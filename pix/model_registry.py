@@ -0,0 +1,169 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+import gc
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterator, Protocol, TypeVar, Union
+from typing_extensions import Annotated
+
+from pixdb.inject import Value
+
+logger = logging.getLogger(__name__)
+
+
+class Model(Protocol):
+    def load_model(self): ...
+
+
+M = TypeVar("M", bound=Model)
+
+
+@dataclass
+class _Entry:
+    model: Model
+    footprint: int
+    last_used: float
+    in_use: int = 0
+
+
+class ModelRegistry:
+    """Models of the API process, loaded on first use and unloaded when idle or over the memory budget.
+
+    Models are created by the factory given at use and owned by the registry, so they are freed once evicted.
+    The footprint of a model is the growth of the resident memory while loading it; loads run one at a time
+    to measure it, and concurrent uses of a model being loaded wait for that load. It is only an estimate, so
+    the budget is approximate: memory allocated by other threads meanwhile (requests, the pipeline) is counted,
+    freed memory reused by the allocator and memory-mapped weights not paged in yet are not, and neither is
+    GPU memory. The largest footprint measured for a model is kept, as a reload tends to measure less.
+    """
+
+    def __init__(
+            self,
+            model_memory_budget_mb: Annotated[Union[int, None], Value],
+            model_idle_seconds: Annotated[float, Value],
+    ):
+        self.memory_budget = model_memory_budget_mb * 1024 * 1024 if model_memory_budget_mb else None
+        self.idle_seconds = model_idle_seconds
+        self._entries: Dict[str, _Entry] = {}
+        # footprints of models loaded before, to make room before loading them again
+        self._footprints: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    @contextmanager
+    def use(self, key: str, factory: Callable[[], M]) -> Iterator[M]:
+        """The model under the key, created by `factory` and loaded if not yet. It is not evicted until exit."""
+        entry = self._acquire(key, factory)
+        try:
+            yield entry.model
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+                entry.last_used = time.monotonic()
+
+    def preload(self, key: str, factory: Callable[[], Model]):
+        with self.use(key, factory):
+            pass
+
+    def _acquire(self, key: str, factory: Callable[[], Model]) -> _Entry:
+        entry = self._get_entry(key)
+        if entry is not None:
+            return entry
+
+        with self._load_lock:
+            # may have been loaded while waiting for the lock
+            entry = self._get_entry(key)
+            if entry is not None:
+                return entry
+
+            self._evict_over_budget(self._footprints.get(key, 0))
+            start = time.perf_counter()
+            rss = _resident_memory()
+            model = factory()
+            model.load_model()
+            footprint = max(_resident_memory() - rss, self._footprints.get(key, 0))
+            logger.info(f"{key}: loaded in {time.perf_counter() - start:.1f}s, {footprint / 1024 / 1024:.0f} MB")
+
+            entry = _Entry(model, footprint, time.monotonic(), in_use=1)
+            with self._lock:
+                self._entries[key] = entry
+                self._footprints[key] = footprint
+            self._evict_over_budget(0)
+            return entry
+
+    def _get_entry(self, key: str) -> Union[_Entry, None]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.in_use += 1
+                entry.last_used = time.monotonic()
+            return entry
+
+    def memory_usage(self) -> int:
+        with self._lock:
+            return sum(entry.footprint for entry in self._entries.values())
+
+    def _evict_over_budget(self, needed: int):
+        """Evict the least recently used models not in use until `needed` more bytes fit in the budget."""
+        if self.memory_budget is None:
+            return
+        with self._lock:
+            usage = sum(entry.footprint for entry in self._entries.values())
+            candidates = sorted(
+                (item for item in self._entries.items() if not item[1].in_use),
+                key=lambda item: item[1].last_used,
+            )
+            evicted = []
+            for key, entry in candidates:
+                if usage + needed <= self.memory_budget:
+                    break
+                del self._entries[key]
+                usage -= entry.footprint
+                evicted.append(key)
+        if usage + needed > self.memory_budget:
+            logger.warning(f"models in use take {usage / 1024 / 1024:.0f} MB, over the budget")
+        self._unloaded(evicted, "over the memory budget")
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            evicted = [
+                key for key, entry in self._entries.items()
+                if not entry.in_use and now - entry.last_used > self.idle_seconds
+            ]
+            for key in evicted:
+                del self._entries[key]
+        self._unloaded(evicted, "idle")
+
+    def _unloaded(self, keys, reason: str):
+        if keys:
+            gc.collect()
+            logger.info(f"unloaded {reason} models: {keys}")
+
+    def start_sweeper(self, interval_seconds: float = 60):
+        """Evict idle models from a background thread."""
+        self._stop_sweeper = threading.Event()
+        self._sweeper = threading.Thread(target=self._sweep, args=(interval_seconds, ), daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stop_sweeper.set()
+        self._sweeper.join()
+
+    def _sweep(self, interval_seconds: float):
+        while not self._stop_sweeper.wait(interval_seconds):
+            try:
+                self.evict_idle()
+            except Exception:
+                logger.exception("failed to evict idle models")
+
+
+def _resident_memory() -> int:
+    """Resident set size of this process in bytes, 0 where it can't be read."""
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
@@ -2,13 +2,14 @@ from datetime import datetime, timezone
 import threading
 from apscheduler.schedulers.background import BackgroundScheduler
 from pix.task.download import DownloadTask
-from pix.task import autotag, embedding, build_embedding_index, facedetect, facecluster
+from pix.task import autotag, custom_autotag, embedding, build_embedding_index, facedetect, facecluster
 from pixdb.inject import Graph
 
 
 def run_pipeline(graph: Graph):
     graph.get_instance(DownloadTask).handle()
     graph.run(autotag.main)
+    graph.run(custom_autotag.main)
     graph.run(embedding.main)
     graph.run(build_embedding_index.main)
     graph.run(facedetect.main)
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
+from pathlib import Path
+import threading
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from pix.autotagger.wd import REGISTRY_KEY as WD_REGISTRY_KEY, WdAutotagger
+from pix.embeddings.provider import EmbedderProvider
+from pix.model.image import EMBEDDING_TYPE_DEFAULT, Vector
+from pix.model_registry import Model, ModelRegistry
+from pixdb.inject import Graph
+
+
+class QueryEmbeddingService:
+    """Embeddings of queries that are not in the library, e.g. to search similar images to an uploaded one.
+
+    The models run concurrently in a worker pool and results are cached by the content hash of the image,
+    so repeated queries with the same image don't run the models again. Models are held by the `ModelRegistry`.
+    """
+
+    cache_size = 64
+
+    def __init__(self, registry: ModelRegistry, provider: EmbedderProvider, graph: Graph):
+        self._registry = registry
+        self._provider = provider
+        # (embedding type, registry key, factory, extraction)
+        self._extractors: List[Tuple[str, str, Callable[[], Model], Callable[[Model, Path], np.ndarray]]] = []
+        for embedding_type in "clip", "csd":
+            self._extractors.append((
+                embedding_type,
+                *provider.registry_entry(embedding_type),
+                lambda model, file: model.extract(file),
+            ))
+        self._extractors.append((
+            EMBEDDING_TYPE_DEFAULT,
+            WD_REGISTRY_KEY,
+            lambda: graph.create_instance(WdAutotagger),
+            lambda model, file: model.extract(file).embedding,
+        ))
+        self._executor = ThreadPoolExecutor(len(self._extractors), thread_name_prefix="query-embedding")
+        # content hash -> future of the embeddings, so concurrent requests for the same image share the work
+        self._cache: "OrderedDict[str, Future]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def warm_up(self) -> List[Future]:
+        """Load the models in the background, instead of on the first query."""
+        return [
+            self._executor.submit(self._registry.preload, key, factory)
+            for _, key, factory, _ in self._extractors
+        ]
+
+    def encode_text(self, text: str) -> np.ndarray:
+        """CLIP embedding of the text. The text encoder is only available on torch."""
+        with self._registry.use(*self._provider.registry_entry("clip", "torch")) as model:
+            return model.encode_text(text)
+
+    def extract(self, file: Path) -> Dict[str, Vector]:
+        key = _file_hash(file)
+        with self._lock:
+            future = self._cache.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._cache[key] = future
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.move_to_end(key)
+
+        if owner:
+            try:
+                future.set_result(self._extract_all(file))
+            except BaseException as e:
+                with self._lock:
+                    if self._cache.get(key) is future:
+                        del self._cache[key]
+                future.set_exception(e)
+        return future.result()
+
+    def _extract_all(self, file: Path) -> Dict[str, Vector]:
+        futures = {
+            embedding_type: self._executor.submit(self._extract, key, factory, extract, file)
+            for embedding_type, key, factory, extract in self._extractors
+        }
+        embeddings = {}
+        for embedding_type, future in futures.items():
+            emb = future.result()
+            if emb is not None:
+                embeddings[embedding_type] = Vector.from_numpy(emb)
+        return embeddings
+
+    def _extract(self, key: str, factory: Callable[[], Model], extract: Callable[[Model, Path], np.ndarray], file: Path):
+        with self._registry.use(key, factory) as model:
+            return extract(model, file)
+
+
+def _file_hash(file: Path) -> str:
+    h = hashlib.sha256()
+    with open(file, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
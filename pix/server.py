@@ -1,4 +1,5 @@
 from contextlib import asynccontextmanager
+import threading
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 
@@ -8,7 +9,12 @@ from pix.api.face_clusters import face_clusters_router
 from pix.api.images import images_router
 from pix.api.tasks import tasks_router
 from pix.config import Settings
+from pix.embedding_index import MultiEmbeddingIndexManager
+from pix.model.image import ImageRepo
+from pix.model_registry import ModelRegistry
 from pix.pipeline import PipelineExecutor
+from pix.query_embedding import QueryEmbeddingService
+from pix.tag_index import TagIndex
 
 graph = create_graph(debug=True)
 
@@ -16,9 +22,20 @@ graph = create_graph(debug=True)
 @asynccontextmanager
 async def lifespan(_: FastAPI):
     AppGraph.bind(graph)
+    # before the pipeline writes images
+    graph.get_instance(ImageRepo).ensure_tag_counts()
     scheduler = graph.get_instance(PipelineExecutor)
     scheduler.start()
+    embedding_indexes = graph.get_instance(MultiEmbeddingIndexManager)
+    embedding_indexes.start_watcher()
+    # build in the background instead of on the first request
+    threading.Thread(target=graph.get_instance(TagIndex).refresh, daemon=True).start()
+    model_registry = graph.get_instance(ModelRegistry)
+    model_registry.start_sweeper()
+    graph.get_instance(QueryEmbeddingService).warm_up()
     yield
+    model_registry.stop_sweeper()
+    embedding_indexes.stop_watcher()
     scheduler.shutdown()
 
 
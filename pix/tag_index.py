@@ -0,0 +1,226 @@
+import logging
+import threading
+import time
+from collections import Counter
+from typing import Collection, Dict, List, Set, Tuple, Union
+
+import numpy as np
+
+from pix.embedding_index import encode_ids
+from pix.model.face_cluster import FaceClusterRepo
+from pix.model.image import ImageRepo, TagQuery, TagQueryTermFace, TagQueryTermTag
+
+logger = logging.getLogger(__name__)
+
+
+class _Snapshot:
+    """Posting lists of all images at one point in time.
+
+    Images are numbered densely. Each tag and face cluster has a sorted array of image numbers, which is
+    turned into a bitmap (bool array over all images) only while evaluating a query.
+    """
+
+    def __init__(self, tags_by_id: Dict[str, Set[str]], face_refs: List[Tuple[str, str]]):
+        self.ids = list(tags_by_id.keys())
+        self.numbers = {id: number for number, id in enumerate(self.ids)}
+        # to select the matching images in embedding index searches without a string per image
+        self.id_keys = encode_ids(self.ids)
+
+        entry_numbers = []
+        entry_tags = []
+        for number, tags in enumerate(tags_by_id.values()):
+            entry_numbers.extend([number] * len(tags))
+            entry_tags.extend(tags)
+        self.tags, entry_tag_numbers = np.unique(np.array(entry_tags, dtype=object), return_inverse=True)
+        self.tag_numbers = {tag: i for i, tag in enumerate(self.tags)}
+        # entries sorted by tag then image, so that the postings of a tag are a slice
+        order = np.lexsort((np.array(entry_numbers, dtype=np.int64), entry_tag_numbers))
+        self.entry_numbers = np.array(entry_numbers, dtype=np.int32)[order]
+        self.entry_tag_numbers = entry_tag_numbers.astype(np.int32)[order]
+        self.tag_offsets = np.searchsorted(self.entry_tag_numbers, np.arange(len(self.tags) + 1))
+
+        face_numbers = {}
+        for face_cluster_id, image_id in face_refs:
+            number = self.numbers.get(image_id)
+            if number is not None:
+                face_numbers.setdefault(face_cluster_id, []).append(number)
+        self.face_postings = {
+            face_cluster_id: np.unique(np.array(numbers, dtype=np.int32))
+            for face_cluster_id, numbers in face_numbers.items()
+        }
+
+    def __len__(self):
+        return len(self.ids)
+
+    def postings(self, tag: Union[TagQueryTermTag, TagQueryTermFace]) -> np.ndarray:
+        if isinstance(tag, TagQueryTermFace):
+            return self.face_postings.get(tag.face_cluster_id, np.empty(0, dtype=np.int32))
+        i = self.tag_numbers.get(tag.tag)
+        if i is None:
+            return np.empty(0, dtype=np.int32)
+        return self.entry_numbers[self.tag_offsets[i]:self.tag_offsets[i + 1]]
+
+    def evaluate(self, query: TagQuery) -> np.ndarray:
+        """Bitmap of the matching images, intersecting from the shortest positive posting list."""
+        positives = sorted(
+            (self.postings(term.tag) for term in query.terms if not term.negated),
+            key=len,
+        )
+        if positives:
+            mask = np.zeros(len(self), dtype=bool)
+            mask[positives[0]] = True
+            for postings in positives[1:]:
+                selected = mask[postings]
+                mask[:] = False
+                mask[postings[selected]] = True
+        else:
+            mask = np.ones(len(self), dtype=bool)
+        for term in query.terms:
+            if term.negated:
+                mask[self.postings(term.tag)] = False
+        return mask
+
+
+class TagIndex:
+    """In-memory inverted index of image tags and faces, to evaluate `TagQuery` and count facets without SQL scans.
+
+    Images written since the snapshot was built are tracked through `ImageRepo.tag_change_listeners`
+    and `FaceClusterRepo.face_change_listeners`, and their current tags and faces are read from the database
+    while evaluating queries. The snapshot is rebuilt in the background when there are changes and it gets old,
+    or too many images changed.
+    """
+
+    refresh_seconds = 600
+    max_changed_images = 10000
+
+    def __init__(self, image_repo: ImageRepo, face_cluster_repo: FaceClusterRepo):
+        self.image_repo = image_repo
+        self._snapshot: Union[_Snapshot, None] = None
+        self._snapshot_time = 0.0
+        self._changed_ids: Set[str] = set()
+        # changes that happened before the snapshot being built started, they may not be in it
+        self._building_changed_ids: Set[str] = set()
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        image_repo.tag_change_listeners.append(self._on_tags_changed)
+        face_cluster_repo.face_change_listeners.append(self._on_tags_changed)
+
+    def _on_tags_changed(self, image_ids: Collection[str]):
+        with self._lock:
+            self._changed_ids.update(image_ids)
+
+    def count(self, query: TagQuery) -> int:
+        mask, changed_matches = self._evaluate(query)
+        return int(np.count_nonzero(mask)) + len(changed_matches)
+
+    def list_ids(self, query: TagQuery) -> List[str]:
+        snapshot = self._get_snapshot()
+        mask, changed_matches = self._evaluate(query, snapshot)
+        return [snapshot.ids[number] for number in np.flatnonzero(mask)] + list(changed_matches.keys())
+
+    def list_id_keys(self, query: TagQuery) -> np.ndarray:
+        """`list_ids` as utf-8 encoded ids in a numpy array, see `EmbeddingIndex.search`."""
+        snapshot = self._get_snapshot()
+        mask, changed_matches = self._evaluate(query, snapshot)
+        return np.concatenate([snapshot.id_keys[mask], encode_ids(changed_matches.keys())])
+
+    def tag_counts(self, query: TagQuery) -> List[Tuple[str, int]]:
+        """Tags of the images matching the query, with the number of those images having each."""
+        snapshot = self._get_snapshot()
+        mask, changed_matches = self._evaluate(query, snapshot)
+        counts = np.bincount(snapshot.entry_tag_numbers[mask[snapshot.entry_numbers]], minlength=len(snapshot.tags))
+        result = Counter({snapshot.tags[i]: int(counts[i]) for i in np.flatnonzero(counts)})
+        for tags in changed_matches.values():
+            result.update(tags)
+        return list(result.items())
+
+    def _evaluate(self, query: TagQuery, snapshot: Union[_Snapshot, None] = None):
+        """(bitmap of the matching images in the snapshot except changed ones, tags of the matching changed images by id)"""
+        if snapshot is None:
+            snapshot = self._get_snapshot()
+        with self._lock:
+            changed_ids = self._changed_ids | self._building_changed_ids
+        mask = snapshot.evaluate(query)
+        if not changed_ids:
+            return mask, {}
+
+        changed_numbers = [snapshot.numbers[id] for id in changed_ids if id in snapshot.numbers]
+        mask[changed_numbers] = False
+        face_refs = set()
+        if any(isinstance(term.tag, TagQueryTermFace) for term in query.terms):
+            face_refs = {(image_id, face_cluster_id) for face_cluster_id, image_id in self.image_repo.list_face_refs(changed_ids)}
+        changed_matches = {}
+        for id, tags in self.image_repo.get_tags_by_id(changed_ids).items():
+            if self._matches(query, tags, lambda face_cluster_id: (id, face_cluster_id) in face_refs):
+                changed_matches[id] = tags
+        return mask, changed_matches
+
+    @staticmethod
+    def _matches(query: TagQuery, tags: Set[str], has_face) -> bool:
+        for term in query.terms:
+            if isinstance(term.tag, TagQueryTermFace):
+                present = has_face(term.tag.face_cluster_id)
+            else:
+                present = term.tag.tag in tags
+            if present == term.negated:
+                return False
+        return True
+
+    def _get_snapshot(self) -> _Snapshot:
+        snapshot = self._snapshot
+        if snapshot is None:
+            # nothing to serve yet
+            with self._build_lock:
+                if self._snapshot is None:
+                    self._rebuild()
+            return self._snapshot
+        if self._is_stale():
+            self._refresh_in_background()
+        return snapshot
+
+    def _refresh_in_background(self):
+        """Rebuild from a background thread unless a rebuild is running.
+
+        The old snapshot keeps serving meanwhile, with the changed images read from the database.
+        """
+        if not self._build_lock.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                if self._is_stale():
+                    self._rebuild()
+            except Exception:
+                logger.exception("failed to rebuild tag index")
+            finally:
+                self._build_lock.release()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _is_stale(self) -> bool:
+        with self._lock:
+            if self._snapshot is None:
+                return True
+            if not self._changed_ids:
+                return False
+            return (
+                time.monotonic() - self._snapshot_time > self.refresh_seconds
+                or len(self._changed_ids) > self.max_changed_images
+            )
+
+    def refresh(self):
+        """Rebuild the snapshot from the database. Concurrent callers wait for a single rebuild."""
+        with self._build_lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        with self._lock:
+            self._building_changed_ids = self._changed_ids
+            self._changed_ids = set()
+        started_at = time.monotonic()
+        snapshot = _Snapshot(self.image_repo.get_tags_by_id(), self.image_repo.list_face_refs())
+        with self._lock:
+            self._snapshot = snapshot
+            self._snapshot_time = started_at
+            self._building_changed_ids = set()
+        logger.info(f"built tag index of {len(snapshot)} images in {time.monotonic() - started_at:.1f}s")
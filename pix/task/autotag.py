@@ -1,22 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing_extensions import Annotated
+import numpy as np
 from tqdm.auto import tqdm
-from pix.autotagger.wd import WdAutotagger
+from pix.autotagger.wd import REGISTRY_KEY, WdAutotagger
 from pix.model.image import ImageRepo, ImageTag, Vector
-from pixdb.inject import Value
+from pix.model_registry import ModelRegistry
+from pix.task.utils import chunked, map_prefetch
+from pixdb.inject import Graph, Value
+
+WRITE_BATCH_SIZE = 100
+INFER_BATCH_SIZE = 16
+DECODE_WORKERS = 4
 
 
 def main(
         image_repo: ImageRepo,
-        autotagger: WdAutotagger,
+        registry: ModelRegistry,
+        graph: Graph,
         images_dir: Annotated[Path, Value],
 ):
-    autotagger.load_model()
-
     images = image_repo.list_needs_autotagging()
-    for image in tqdm(images):
-        f = images_dir / image.local_filename
-        result = autotagger.extract(f)
-        image.tags = [ImageTag(tag=tag, type=type, score=score) for tag, type, score in result.tags]
-        image.embedding = Vector.from_numpy(result.embedding)
-        image_repo.update(image)
+    if not images:
+        return
+
+    # held by the registry rather than the graph, so that it is unloaded when idle in the API process
+    with registry.use(REGISTRY_KEY, lambda: graph.create_instance(WdAutotagger)) as autotagger:
+        def preprocess(image):
+            return image, autotagger.preprocess(images_dir / image.local_filename)
+
+        # decoding runs ahead in the pool while the model runs on the previous batch
+        with ThreadPoolExecutor(DECODE_WORKERS) as executor:
+            preprocessed = map_prefetch(executor, preprocess, tqdm(images), INFER_BATCH_SIZE * 2)
+            for chunk in chunked(_predict_batches(autotagger, preprocessed), WRITE_BATCH_SIZE):
+                image_repo.put_many(chunk)
+
+
+def _predict_batches(autotagger: WdAutotagger, preprocessed):
+    for batch in chunked(preprocessed, INFER_BATCH_SIZE):
+        results = autotagger.predict_batch(np.stack([x for _, x in batch]))
+        for (image, _), result in zip(batch, results):
+            image.tags = [ImageTag(tag=tag, type=type, score=score) for tag, type, score in result.tags]
+            image.embedding = Vector.from_numpy(result.embedding)
+            yield image
@@ -1,43 +1,199 @@
+from collections import defaultdict
+from dataclasses import dataclass
+import json
+import logging
 from pathlib import Path
-from typing import Union
+from typing import Collection, Dict, Mapping, Union
 from typing_extensions import Annotated
 
+import numpy as np
 from tqdm.auto import tqdm
-from pix.embedding_index import EmbeddingIndex
-from pix.model.image import ImageRepo
+from pix.embedding_index import INDEX_TYPE_FLAT, EmbeddingIndex
+from pix.model.image import EMBEDDING_TYPE_DEFAULT, ImageRepo
+from pix.task import custom_autotag
+from pix.task.migrate_embeddings import migrate_embeddings
 from pixdb.inject import Value
 
+logger = logging.getLogger(__name__)
 
-def build_index(
-    embedding_name: Union[str, None],
+EMBEDDING_TYPES = [EMBEDDING_TYPE_DEFAULT, "clip", "resnet", "dinov2", "csd", "siglip2"]
+
+# rebuild from scratch when this fraction of the index labels belong to removed docs
+MAX_REMOVED_RATIO = 0.3
+
+# embeddings added to an index at once
+ADD_BATCH_SIZE = 1000
+
+
+@dataclass
+class IndexConfig:
+    index_type: str = INDEX_TYPE_FLAT
+    search_params: str = ""
+
+
+def build_indexes_full(
+    embedding_types: Collection[str],
     image_repo: ImageRepo,
-    embedding_index_dir: Path,
+    emb_dir: Path,
+    configs: Mapping[str, IndexConfig] = {},
 ):
-    index = EmbeddingIndex()
+    """Build the indexes from scratch with a single pass over the embedding store."""
+    # vectors still inline in documents are not in the store, the index would lose them
+    migrate_embeddings(image_repo)
+
+    # changes committed during the scan are applied again by the next incremental build
+    seq = image_repo.last_embedding_change_seq()
+
+    indexes = {}
+    for embedding_type in embedding_types:
+        config = configs.get(embedding_type, IndexConfig())
+        indexes[embedding_type] = EmbeddingIndex(config.index_type, config.search_params)
 
-    for image in tqdm(image_repo.all(), desc=embedding_name):
-        if embedding_name:
-            if not image.embeddings: continue
-            emb = image.embeddings.get(embedding_name)
+    pending = defaultdict(dict)
+    for embedding_type, image_id, emb in tqdm(image_repo.iter_embeddings(embedding_types), desc="embeddings"):
+        batch = pending[embedding_type]
+        batch[image_id] = emb
+        if len(batch) >= ADD_BATCH_SIZE:
+            _add_batch(indexes[embedding_type], batch)
+            batch.clear()
+
+    for embedding_type, batch in pending.items():
+        _add_batch(indexes[embedding_type], batch)
+
+    for embedding_type, index in indexes.items():
+        index.meta["seq"] = seq
+        _save(index, emb_dir / embedding_type)
+
+
+def build_indexes_incremental(
+    embedding_types: Collection[str],
+    image_repo: ImageRepo,
+    emb_dir: Path,
+    configs: Mapping[str, IndexConfig] = {},
+):
+    """Apply the embedding changes since the last build to each index, falling back to full builds."""
+    indexes: Dict[str, EmbeddingIndex] = {}
+    full_build_types = []
+    for embedding_type in embedding_types:
+        config = configs.get(embedding_type, IndexConfig())
+        index = _load(emb_dir / embedding_type)
+        if index is None or "seq" not in index.meta:
+            full_build_types.append(embedding_type)
+        elif index.meta.get("requested_index_type", index.index_type) != config.index_type:
+            logger.info(f"{embedding_type}: index type changed to {config.index_type}")
+            full_build_types.append(embedding_type)
+        elif "requested_index_type" in index.meta and len(index) >= EmbeddingIndex.train_size:
+            # enough vectors to train the requested index type now
+            full_build_types.append(embedding_type)
         else:
-            emb = image.embedding
-        
-        if not emb: continue
-        emb = emb.to_numpy()
-        index.add(image.id, emb)
+            index.set_search_params(config.search_params)
+            indexes[embedding_type] = index
+
+    if indexes:
+        changes = image_repo.list_embedding_changes(min(index.meta["seq"] for index in indexes.values()))
+        last_seq = changes[-1][0] if changes else None
+        changed_ids = defaultdict(set)
+        for seq, embedding_type, image_id in changes:
+            index = indexes.get(embedding_type)
+            if index is not None and seq > index.meta["seq"]:
+                changed_ids[embedding_type].add(image_id)
+
+        for embedding_type, index in indexes.items():
+            image_ids = changed_ids[embedding_type]
+            if image_ids:
+                try:
+                    index.remove(image_ids)
+                except RuntimeError:
+                    logger.info(f"{embedding_type}: {index.index_type} index doesn't support removal")
+                    full_build_types.append(embedding_type)
+                    continue
+                _add_batch(index, image_repo.get_embeddings(embedding_type, image_ids))
+                logger.info(f"{embedding_type}: applied {len(image_ids)} changes")
+
+            if index.removed_count > MAX_REMOVED_RATIO * (len(index) + index.removed_count):
+                full_build_types.append(embedding_type)
+                continue
+
+            if last_seq is not None:
+                index.meta["seq"] = max(index.meta["seq"], last_seq)
+            if image_ids:
+                _save(index, emb_dir / embedding_type)
+            else:
+                # only advance the watermark / update search params
+                index.save_meta(EmbeddingIndex.current_dir(emb_dir / embedding_type))
+
+    if full_build_types:
+        logger.info(f"full build: {full_build_types}")
+        build_indexes_full(full_build_types, image_repo, emb_dir, configs)
+
+
+def prune_embedding_changes(
+    embedding_types: Collection[str],
+    image_repo: ImageRepo,
+    emb_dir: Path,
+    custom_autotag_state_path: Path,
+):
+    """Delete the embedding changes applied by all of their readers, the indexes and `custom_autotag`.
+
+    Readers without a watermark (no index of the type yet, custom tags never applied) start with a full pass
+    over the embedding store, so they don't hold the changes back.
+    """
+    seqs = [_load_seq(emb_dir / embedding_type) for embedding_type in embedding_types]
+    seqs.append(custom_autotag.applied_embedding_change_seq(custom_autotag_state_path))
+    seqs = [seq for seq in seqs if seq is not None]
+    if seqs:
+        image_repo.prune_embedding_changes(min(seqs))
+
+
+def get_index_configs(
+    embedding_index_types: Mapping[str, str],
+    embedding_index_search_params: Mapping[str, str],
+) -> Dict[str, IndexConfig]:
+    return {
+        embedding_type: IndexConfig(
+            index_type=embedding_index_types.get(embedding_type, INDEX_TYPE_FLAT),
+            search_params=embedding_index_search_params.get(embedding_type, ""),
+        )
+        for embedding_type in EMBEDDING_TYPES
+    }
+
+
+def _add_batch(index: EmbeddingIndex, embs: Mapping[str, np.ndarray]):
+    if embs:
+        index.add_batch(list(embs.keys()), np.stack(list(embs.values())))
+
+
+def _load(dir: Path):
+    dir = EmbeddingIndex.current_dir(dir)
+    if not (dir / EmbeddingIndex._META_FILENAME).exists():
+        return None
+    index = EmbeddingIndex()
+    index.load(dir)
+    return index
+
+
+def _load_seq(dir: Path) -> Union[int, None]:
+    """The watermark of the index in `meta`, without loading the index."""
+    meta_path = EmbeddingIndex.current_dir(dir) / EmbeddingIndex._META_FILENAME
+    if not meta_path.exists():
+        return None
+    with meta_path.open() as fp:
+        return json.load(fp).get("seq")
+
 
-    embedding_index_dir.mkdir(parents=True, exist_ok=True)
-    index.save(embedding_index_dir)
+def _save(index: EmbeddingIndex, dir: Path):
+    if len(index) == 0 and index.removed_count == 0:
+        # no embeddings of the type yet
+        return
+    index.save_version(dir)
 
 
 def main(
         image_repo: ImageRepo,
         data_dir: Annotated[Path, Value],
+        embedding_index_types: Annotated[Dict[str, str], Value],
+        embedding_index_search_params: Annotated[Dict[str, str], Value],
 ):
-    emb_dir = data_dir / "emb-index"
-    build_index(None, image_repo, emb_dir / "default")
-    build_index("clip", image_repo, emb_dir / "clip")
-    build_index("resnet", image_repo, emb_dir / "resnet")
-    build_index("dinov2", image_repo, emb_dir / "dinov2")
-    build_index("csd", image_repo, emb_dir / "csd")
-    build_index("siglip2", image_repo, emb_dir / "siglip2")
+    configs = get_index_configs(embedding_index_types, embedding_index_search_params)
+    build_indexes_incremental(EMBEDDING_TYPES, image_repo, data_dir / "emb-index", configs)
+    prune_embedding_changes(EMBEDDING_TYPES, image_repo, data_dir / "emb-index", data_dir / custom_autotag.STATE_FILENAME)
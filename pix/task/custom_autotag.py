@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import List, Mapping, Tuple, Union
+from typing_extensions import Annotated
+
+import numpy as np
+from tqdm.auto import tqdm
+from pix.autotagger.custom import REGISTRY_KEY, CustomAutotagger
+from pix.model.image import EMBEDDING_TYPE_DEFAULT, ImageRepo, ImageTag, TagType
+from pix.task.utils import chunked
+from pix.model_registry import ModelRegistry
+from pixdb.inject import Graph, Value
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+STATE_FILENAME = "custom-autotag.json"
+
+
+def main(
+        image_repo: ImageRepo,
+        registry: ModelRegistry,
+        graph: Graph,
+        data_dir: Annotated[Path, Value],
+):
+    # not loaded until the registry uses it
+    autotagger = graph.create_instance(CustomAutotagger)
+    if not autotagger.model_path.exists():
+        logger.info(f"no custom autotagger model at {autotagger.model_path}")
+        return
+
+    # held by the registry rather than the graph, so that it is unloaded when idle in the API process
+    with registry.use(REGISTRY_KEY, lambda: autotagger) as autotagger:
+        apply_custom_autotags(image_repo, autotagger, data_dir / STATE_FILENAME)
+
+
+def apply_custom_autotags(image_repo: ImageRepo, autotagger: CustomAutotagger, state_path: Path):
+    """Tag the images whose WD embedding changed since the last run (all images on the first run or after the model changed).
+
+    The predictions replace the image's previous `custom_tags`, so rerunning doesn't accumulate stale tags.
+    """
+    autotagger.load_model()
+    model_version = autotagger.model_path.stat().st_mtime_ns
+
+    state = _load_state(state_path)
+    if state.get("model_version") == model_version:
+        changes = image_repo.list_embedding_changes(state["seq"])
+        seq = changes[-1][0] if changes else state["seq"]
+        image_ids = list(dict.fromkeys(image_id for _, embedding_type, image_id in changes if embedding_type == EMBEDDING_TYPE_DEFAULT))
+    else:
+        seq = image_repo.last_embedding_change_seq()
+        image_ids = image_repo.list_ids_with_embedding(EMBEDDING_TYPE_DEFAULT)
+
+    for chunk in chunked(tqdm(image_ids, desc="custom autotag"), BATCH_SIZE):
+        # removed embeddings are skipped
+        embeddings = image_repo.get_embeddings(EMBEDDING_TYPE_DEFAULT, chunk)
+        if not embeddings:
+            continue
+        results = autotagger.extract_batch(np.stack(list(embeddings.values())))
+        _apply(image_repo, dict(zip(embeddings.keys(), results)))
+
+    _save_state(state_path, {"model_version": model_version, "seq": seq})
+
+
+def applied_embedding_change_seq(state_path: Path) -> Union[int, None]:
+    """The embedding change seq the custom tags are up to date with, None if they were never applied."""
+    return _load_state(state_path).get("seq")
+
+
+def _apply(image_repo: ImageRepo, results: Mapping[str, List[Tuple[str, float]]]):
+    images = image_repo.get_many(list(results.keys()))
+    changed = []
+    for image_id, tags in results.items():
+        image = images.get(image_id)
+        if image is None:
+            continue
+        # tags set manually or by the WD tagger are kept as they are
+        existing_tags = {tag.tag for tag in (image.manual_tags or []) + (image.tags or [])}
+        custom_tags = [
+            ImageTag(tag=tag, type=TagType.CHARACTER, score=score)
+            for tag, score in tags if tag not in existing_tags
+        ]
+        if custom_tags != (image.custom_tags or []):
+            image.custom_tags = custom_tags
+            changed.append(image)
+    if changed:
+        image_repo.put_many(changed)
+
+
+def _load_state(path: Path) -> dict:
+    if not path.exists():
+        return {}
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def _save_state(path: Path, state: dict):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as fp:
+        json.dump(state, fp)
+    os.replace(tmp_path, path)
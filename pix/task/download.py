@@ -1,8 +1,17 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import logging
+import os
+from pathlib import Path
+import tempfile
+import threading
 import time
-from typing import List, Tuple, Union
+from typing import Dict, List, Tuple, Union
+from urllib.parse import urlsplit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from pix.config import Settings
 from pix.downloader.twitter_base import TwitterDownloader
@@ -12,6 +21,23 @@ from pixdb.db import Database
 
 logger = logging.getLogger(__name__)
 
+DOWNLOAD_WORKERS = 8
+# concurrent downloads from one host, e.g. pbs.twimg.com
+PER_HOST_DOWNLOADS = 4
+# (connect, read) seconds
+DOWNLOAD_TIMEOUT = (10, 60)
+DOWNLOAD_RETRY = Retry(
+    total=5,
+    backoff_factor=1,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET"],
+)
+
+# mkstemp creates files only readable by the owner, downloads get the permissions of a newly created file
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+DOWNLOAD_FILE_MODE = 0o666 & ~_UMASK
+
 
 class DownloadTask:
     def __init__(
@@ -27,6 +53,12 @@ class DownloadTask:
         self.tweet_repo = tweet_repo
         self.image_repo = image_repo
         self.twitter_downloader = twitter_downloader
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=DOWNLOAD_WORKERS, max_retries=DOWNLOAD_RETRY)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._host_semaphores: Dict[str, threading.Semaphore] = defaultdict(lambda: threading.Semaphore(PER_HOST_DOWNLOADS))
+        self._host_semaphores_lock = threading.Lock()
 
     def handle(self, pages: Union[int, None] = None):
         tweets = self._get_new_tweets(pages)
@@ -34,9 +66,9 @@ class DownloadTask:
         attachments = self._download_images(tweets)
 
         with self.db.transactional():
-            for tweet in tweets:
-                self.tweet_repo.put(tweet.id, tweet)
+            self.tweet_repo.put_many(tweets)
             
+            images = []
             for tweet, attachment in attachments:
                 collected_at = datetime.datetime.now(tz=datetime.timezone.utc)
                 if pages is not None and tweet.created_at:
@@ -52,7 +84,8 @@ class DownloadTask:
                     tweet_id=tweet.id,
                     tweet_username=tweet.username,
                 )
-                self.image_repo.update(image)
+                images.append(image)
+            self.image_repo.put_many(images)
 
     def _get_new_tweets(self, pages: Union[int, None] = None):
         with self.twitter_downloader.open():
@@ -69,8 +102,9 @@ class DownloadTask:
                 pagination_state = result.pagination_state
 
                 found_saved = False
+                saved_tweets = self.tweet_repo.get_many(tweet.id for tweet in result.tweets)
                 for tweet in result.tweets:
-                    if self.tweet_repo.get(tweet.id):
+                    if tweet.id in saved_tweets:
                         logger.info(f"saved tweet found: {tweet.id}")
                         found_saved = True
                     else:
@@ -83,17 +117,39 @@ class DownloadTask:
 
     def _download_images(self, tweets: List[Tweet]) -> List[Tuple[Tweet, Attachment]]:
         result = []
+        downloads: Dict[Path, str] = {}
         for tweet in tweets:
             for attachment in tweet.attachments:
                 download_path = self.settings.images_dir / attachment.make_local_filename()
                 if download_path.exists():
                     logger.info(f"already exists: {download_path.name}")
                 else:
-                    r = requests.get(attachment.url)
-                    # if not r.ok:
-                    #     print(f"error: {r.status_code}, {download_path.name}")
-                    #     continue
-                    r.raise_for_status()
-                    download_path.write_bytes(r.content)
+                    downloads[download_path] = attachment.url
                 result.append((tweet, attachment))
+
+        with ThreadPoolExecutor(DOWNLOAD_WORKERS) as executor:
+            futures = [executor.submit(self._download, url, path) for path, url in downloads.items()]
+        # fails like before if any download failed, keeping the completed ones
+        for future in futures:
+            future.result()
         return result
+
+    def _download(self, url: str, path: Path):
+        with self._host_semaphore(urlsplit(url).hostname):
+            with self._session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                r.raise_for_status()
+                # written to a temporary file first, so that an interrupted download is not taken as existing
+                fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".download-")
+                try:
+                    with os.fdopen(fd, "wb") as fp:
+                        os.fchmod(fd, DOWNLOAD_FILE_MODE)
+                        for chunk in r.iter_content(chunk_size=1024 * 1024):
+                            fp.write(chunk)
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+
+    def _host_semaphore(self, host: str) -> threading.Semaphore:
+        with self._host_semaphores_lock:
+            return self._host_semaphores[host]
@@ -1,69 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from pathlib import Path
+from typing import Dict, List
 from typing_extensions import Annotated
 from tqdm.auto import tqdm
-from pix.embeddings.clip import ClipEmbedding
-from pix.embeddings.csd import CsdEmbedding
-from pix.embeddings.dinov2 import Dinov2Embedding
-from pix.embeddings.resnet import ResnetEmbedding
-from pix.embeddings.siglip2 import Siglip2Embedding
-from pix.model.image import ImageRepo, Vector
-from pixdb.inject import Graph, Value
+from pix.embeddings.base import Embedder, decode_image
+from pix.embeddings.provider import EmbedderProvider
+from pix.model.image import Image, ImageRepo, Vector
+from pix.model_registry import ModelRegistry
+from pix.task.utils import chunked, map_prefetch
+from pixdb.inject import Value
+
+WRITE_BATCH_SIZE = 100
+DECODE_WORKERS = 4
 
 
 def main(
-        graph: Graph,
+        provider: EmbedderProvider,
+        registry: ModelRegistry,
         image_repo: ImageRepo,
         images_dir: Annotated[Path, Value],
 ):
-    embeddings = {
-        'clip': ClipEmbedding,
-        'resnet': ResnetEmbedding,
-        'dinov2': Dinov2Embedding,
-        'csd': CsdEmbedding,
-        'siglip2': Siglip2Embedding,
-    }
+    embedding_types = ['clip', 'resnet', 'dinov2', 'csd', 'siglip2']
 
     reset_embedding = None
     # reset_embedding = 'dinov2'
     # with image_repo.db.transactional():
     #     for image in tqdm(image_repo.list_has_embedding(reset_embedding)):
-    #         if image.embeddings and reset_embedding in image.embeddings:
-    #             del image.embeddings[reset_embedding]
+    #         if reset_embedding in image.embedding_types:
+    #             image.remove_embedding(reset_embedding)
     #             image_repo.update(image)
 
-    for embedding_type, model_cls in embeddings.items():
+    # missing embedding types by image, to process every image once for all of them
+    images: Dict[str, Image] = {}
+    needed_types: Dict[str, List[str]] = {}
+    for embedding_type in embedding_types:
         if embedding_type == reset_embedding:
-            images = image_repo.all()
+            type_images = image_repo.all()
         else:
-            images = image_repo.list_needs_embedding(embedding_type)
-            if not images:
-                continue
-
-        model = graph.get_instance(model_cls)
-        model.load_model()
+            type_images = image_repo.list_needs_embedding(embedding_type)
+        for image in type_images:
+            images.setdefault(image.id, image)
+            needed_types.setdefault(image.id, []).append(embedding_type)
+    if not images:
+        return
 
-        batch_size = getattr(model, 'batch_size', 1)
+    # held by the registry rather than the graph, so that they are unloaded when idle in the API process
+    with ExitStack() as stack:
+        models: Dict[str, Embedder] = {
+            embedding_type: stack.enter_context(registry.use(*provider.registry_entry(embedding_type)))
+            for embedding_type in dict.fromkeys(t for types in needed_types.values() for t in types)
+        }
 
-        for chunk in chunked(tqdm(images), batch_size):
-            files = [images_dir / image.local_filename for image in chunk]
-            if batch_size > 1:
-                embeddings = model.extract_batch(files)
-            else:
-                embeddings = [model.extract(f) for f in files]
-            
-            for image, embedding in zip(chunk, embeddings):
-                if not image.embeddings:
-                    image.embeddings = {}
-                image.embeddings[embedding_type] = Vector.from_numpy(embedding)
-                image_repo.update(image)
+        def preprocess(image: Image):
+            im = decode_image(images_dir / image.local_filename)
+            return image, {embedding_type: models[embedding_type].preprocess(im) for embedding_type in needed_types[image.id]}
 
+        # each round has enough images to fill a batch of every model
+        round_size = max(model.batch_size for model in models.values())
+        with ThreadPoolExecutor(DECODE_WORKERS) as executor:
+            preprocessed = map_prefetch(executor, preprocess, tqdm(images.values()), round_size * 2)
+            pending = []
+            for chunk in chunked(preprocessed, round_size):
+                for embedding_type, model in models.items():
+                    targets = [(image, inputs[embedding_type]) for image, inputs in chunk if embedding_type in inputs]
+                    for batch in chunked(targets, model.batch_size):
+                        vectors = model.extract_preprocessed([x for _, x in batch])
+                        for (image, _), vector in zip(batch, vectors):
+                            image.set_embedding(embedding_type, Vector.from_numpy(vector))
 
-def chunked(it, size: int):
-    batch = []
-    for x in it:
-        batch.append(x)
-        if len(batch) >= size:
-            yield batch
-            batch.clear()
-    if batch:
-        yield batch
+                # all new embeddings of an image are written with one update
+                pending.extend(image for image, _ in chunk)
+                if len(pending) >= WRITE_BATCH_SIZE:
+                    image_repo.put_many(pending)
+                    pending = []
+            image_repo.put_many(pending)
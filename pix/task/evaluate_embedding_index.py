@@ -0,0 +1,87 @@
+import time
+from pathlib import Path
+from typing import Dict, List
+from typing_extensions import Annotated
+import numpy as np
+from tqdm.auto import tqdm
+from pix.embedding_index import INDEX_TYPE_FLAT, EmbeddingIndex
+from pix.model.image import ImageRepo
+from pix.task.build_embedding_index import get_index_configs
+from pix.task.utils import chunked
+from pixdb.inject import Value
+
+QUERY_COUNT = 200
+TOP_K = 10
+ADD_BATCH_SIZE = 10000
+
+
+def evaluate_recall(index: EmbeddingIndex, exact_index: EmbeddingIndex, query_ids: List[str], queries: np.ndarray, top_k: int):
+    """Returns recall@top_k of `index` against `exact_index`, and mean search latency of both in ms.
+
+    The queries are vectors of indexed docs (`query_ids`), as the built index can't be searched without them.
+    Each query's own doc is excluded from the results of both indexes, since it would trivially be the first hit.
+    """
+    hits = 0
+    elapsed = 0.0
+    exact_elapsed = 0.0
+    for query_id, query in zip(query_ids, queries):
+        start = time.perf_counter()
+        expected = exact_index.search(query, top_k + 1)
+        exact_elapsed += time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = index.search(query, top_k + 1)
+        elapsed += time.perf_counter() - start
+
+        expected_ids = [doc_id for doc_id, _ in expected if doc_id != query_id][:top_k]
+        actual_ids = [doc_id for doc_id, _ in actual if doc_id != query_id][:top_k]
+        hits += len(set(expected_ids) & set(actual_ids))
+    return (
+        hits / (len(queries) * top_k),
+        elapsed / len(queries) * 1000,
+        exact_elapsed / len(queries) * 1000,
+    )
+
+
+def main(
+        image_repo: ImageRepo,
+        data_dir: Annotated[Path, Value],
+        embedding_index_types: Annotated[Dict[str, str], Value],
+        embedding_index_search_params: Annotated[Dict[str, str], Value],
+):
+    """Compare the built approximate indexes with exact search over the same vectors."""
+    emb_dir = data_dir / "emb-index"
+    configs = get_index_configs(embedding_index_types, embedding_index_search_params)
+    rng = np.random.default_rng(1234)
+
+    for embedding_type, config in configs.items():
+        dir = EmbeddingIndex.current_dir(emb_dir / embedding_type)
+        if not (dir / EmbeddingIndex._INDEX_FILENAME).exists():
+            continue
+        index = EmbeddingIndex()
+        index.load(dir)
+        if index.index_type == INDEX_TYPE_FLAT:
+            continue
+        # try the configured search params, which may not be applied to the built index yet
+        index.set_search_params(config.search_params)
+
+        exact_index = EmbeddingIndex()
+        queries = []
+        i = 0
+        embeddings = tqdm(image_repo.iter_embeddings([embedding_type]), desc=embedding_type)
+        for chunk in chunked(embeddings, ADD_BATCH_SIZE):
+            exact_index.add_batch([image_id for _, image_id, _ in chunk], np.stack([emb for _, _, emb in chunk]))
+            for _, image_id, emb in chunk:
+                # reservoir sampling
+                if len(queries) < QUERY_COUNT:
+                    queries.append((image_id, emb))
+                else:
+                    j = rng.integers(0, i + 1)
+                    if j < QUERY_COUNT:
+                        queries[j] = (image_id, emb)
+                i += 1
+
+        recall, latency, exact_latency = evaluate_recall(
+            index, exact_index, [image_id for image_id, _ in queries], np.stack([emb for _, emb in queries]), TOP_K)
+        print(f"{embedding_type} ({index.index_type} {config.search_params}): "
+              f"recall@{TOP_K}={recall:.3f} latency={latency:.2f}ms flat={exact_latency:.2f}ms")
@@ -0,0 +1,10 @@
+from pix.embeddings.onnx_embedder import OnnxEmbedders
+from pix.embeddings.provider import TORCH_EMBEDDERS, EmbedderProvider
+
+
+def main(
+        provider: EmbedderProvider,
+        onnx_embedders: OnnxEmbedders,
+):
+    for embedding_type in TORCH_EMBEDDERS.keys():
+        onnx_embedders.export(embedding_type, provider.get_torch(embedding_type))
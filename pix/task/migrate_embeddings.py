@@ -0,0 +1,19 @@
+from tqdm.auto import tqdm
+from pix.model.image import ImageRepo
+from pix.task.utils import chunked
+
+
+def migrate_embeddings(image_repo: ImageRepo):
+    """Move vectors stored inline in Image documents into the embedding store."""
+    ids = image_repo.list_ids_with_inline_embeddings()
+    if not ids:
+        return
+    with tqdm(total=len(ids), desc="migrate embeddings") as progress:
+        for chunk in chunked(ids, 100):
+            # loading the document reads the inline vectors, writing moves them to the store
+            image_repo.put_many(image_repo.get_many(chunk).values())
+            progress.update(len(chunk))
+
+
+def main(image_repo: ImageRepo):
+    migrate_embeddings(image_repo)
@@ -0,0 +1,6 @@
+from pix.model.image import ImageRepo
+
+
+def main(image_repo: ImageRepo):
+    """Fill the tag count table from the tag index, e.g. for databases created before it existed."""
+    image_repo.rebuild_tag_counts()
@@ -0,0 +1,6 @@
+from pix.model.image import ImageRepo
+
+
+def main(image_repo: ImageRepo):
+    """Deduplicate the tag index entries of databases written before the extractors were distinct."""
+    image_repo.repair_tag_indexes()
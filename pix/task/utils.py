@@ -0,0 +1,24 @@
+from collections import deque
+from concurrent.futures import Executor
+
+
+def chunked(it, size: int):
+    batch = []
+    for x in it:
+        batch.append(x)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def map_prefetch(executor: Executor, fn, it, depth: int):
+    """Like `executor.map`, but keeps at most `depth` items in flight instead of submitting everything up front."""
+    pending = deque()
+    for x in it:
+        pending.append(executor.submit(fn, x))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
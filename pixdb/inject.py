@@ -33,6 +33,12 @@ class Graph:
         if cached is not None:
             return cached
 
+        instance = self.create_instance(type)
+        self._cache[type] = instance
+        return instance
+
+    def create_instance(self, type: Type[T]) -> T:
+        """A new instance with its dependencies from the graph, not shared with `get_instance` callers."""
         try:
             custom_factory = self._factories.get(type)
             if custom_factory:
@@ -41,9 +47,7 @@ class Graph:
                 factory, func = type, type.__init__
             
             kwargs = self._build_kwargs(func)
-            instance = factory(**kwargs)
-            self._cache[type] = instance
-            return instance
+            return factory(**kwargs)
         except Exception as e:
             raise ValueError(f"error while instantiating {type}") from e
     
@@ -1,8 +1,10 @@
 import json
-from typing import Callable, ClassVar, Generic, Iterator, List, Optional, TypeVar, Union
+from collections import Counter, defaultdict
+from typing import Callable, ClassVar, Collection, Dict, Generic, Iterable, Iterator, List, Optional, TypeVar, Union
 
-from pydantic import BaseModel
-from sqlalchemy import Row, select, insert, update, delete
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import JSON, Row, Select, bindparam, cast, select, insert, type_coerce, update, delete
+from sqlalchemy.dialects import postgresql
 
 from pixdb.schema import Indexer, Schema
 from pixdb.db import Database
@@ -10,6 +12,9 @@ from pixdb.db import Database
 
 T = TypeVar("T", bound=BaseModel)
 
+# keep IN (...) lists well below the bound parameter limits of the backends
+_MAX_IN_PARAMS = 500
+
 
 class Repo(Generic[T]):
     schema: ClassVar[Schema[T]]
@@ -18,29 +23,131 @@ class Repo(Generic[T]):
         self.table = self.schema.table
         self.db = db
     
-    def get(self, id: str) -> Union[T, None]:
-        row = self.db.execute(select(self.table).where(self.table.c.id == id)).first()
-        return self._doc_from_row(row)
+    def get(self, id: str, fields: Optional[Collection[str]] = None) -> Union[T, None]:
+        row = self.db.execute(self._select_docs(fields).where(self.table.c.id == id)).first()
+        return self._doc_from_row(row, fields)
+
+    def get_many(self, ids: Iterable[str], fields: Optional[Collection[str]] = None) -> Dict[str, T]:
+        """Load documents by id with batched IN queries. Missing ids are omitted from the result."""
+        result = {}
+        for chunk in self._chunked(list(dict.fromkeys(ids))):
+            for row in self.db.execute(self._select_docs(fields).where(self.table.c.id.in_(chunk))):
+                result[row.id] = self._doc_from_row(row, fields)
+        return result
     
     def put(self, id: str, doc: T):
-        content = doc.model_dump_json(exclude={"id"})
+        self._put_many({id: doc})
+    
+    def put_many(self, docs: Iterable[T]):
+        """Write many documents and their index entries in one transaction using executemany."""
+        self._put_many({doc.id: doc for doc in docs})
+
+    def _put_many(self, docs_by_id: Dict[str, T]):
+        if not docs_by_id:
+            return
 
         with self.db.transactional():
-            existing = self.db.execute(select(self.table.c.id).where(self.table.c.id == id).with_for_update()).first()
-            if existing:
-                self.db.execute(update(self.table).values(content=content).where(self.table.c.id == id))
-            else:
-                self.db.execute(insert(self.table).values(id=id, content=content))
+            # previous versions are needed to diff index entries; None means it can't be parsed anymore
+            previous_docs: Dict[str, Union[T, None]] = {}
+            for chunk in self._chunked(list(docs_by_id.keys())):
+                for row in self.db.execute(select(self.table).where(self.table.c.id.in_(chunk)).with_for_update()):
+                    try:
+                        previous_docs[row.id] = self._doc_from_row(row)
+                    except ValidationError:
+                        previous_docs[row.id] = None
+
+            updates = []
+            inserts = []
+            for id, doc in docs_by_id.items():
+                content = doc.model_dump_json(exclude={"id"})
+                if id in previous_docs:
+                    updates.append({"_id": id, "_content": content})
+                else:
+                    inserts.append({"id": id, "content": content})
+            if updates:
+                self.db.execute(
+                    update(self.table)
+                        .where(self.table.c.id == bindparam("_id"))
+                        .values(content=bindparam("_content")),
+                    updates,
+                )
+            if inserts:
+                self.db.execute(insert(self.table), inserts)
 
             for indexer in self.schema.indexers:
-                self._update_index(indexer, id, doc)
-    
+                self._update_index_diff(indexer, docs_by_id, previous_docs)
+
     def _update_index(self, indexer: Indexer, id: str, doc: T):
         index_table = indexer.table
         self.db.execute(delete(index_table).where(index_table.c.id == id))
         entries = [entry + (id, ) for entry in indexer.entries_extractor(doc)]
         if entries:
             self.db.execute(insert(index_table).values(entries))
+
+    def _update_index_diff(self, indexer: Indexer, docs_by_id: Dict[str, T], previous_docs: Dict[str, Union[T, None]]):
+        """Only delete/insert the index rows whose entries differ from the previous version of each document.
+
+        Assumes the index table is consistent with the stored documents; use `rebuild_index` otherwise.
+        """
+        index_table = indexer.table
+        columns = [field.name for field in indexer.fields + (indexer.meta_fields or [])]
+
+        unknown_ids = []
+        deletes = defaultdict(list)  # null columns -> params
+        deleted_rows = []
+        inserts = []
+        for id, doc in docs_by_id.items():
+            entries = Counter(indexer.entries_extractor(doc))
+            if id in previous_docs and previous_docs[id] is None:
+                unknown_ids.append(id)
+                previous_entries = Counter()
+            elif id in previous_docs:
+                previous_entries = Counter(indexer.entries_extractor(previous_docs[id]))
+            else:
+                previous_entries = Counter()
+
+            if entries == previous_entries:
+                continue
+
+            for entry in previous_entries.keys() | entries.keys():
+                if previous_entries[entry] == entries[entry]:
+                    continue
+                if previous_entries[entry]:
+                    null_columns = tuple(column for column, value in zip(columns, entry) if value is None)
+                    params = {"_" + column: value for column, value in zip(columns, entry) if value is not None}
+                    params["_id"] = id
+                    deletes[null_columns].append(params)
+                    deleted_rows.extend([dict(zip(columns, entry), id=id)] * previous_entries[entry])
+                inserts.extend([dict(zip(columns, entry), id=id)] * entries[entry])
+
+        for chunk in self._chunked(unknown_ids):
+            condition = index_table.c.id.in_(chunk)
+            deleted_rows.extend(row._asdict() for row in self.db.execute(select(index_table).where(condition)))
+            self.db.execute(delete(index_table).where(condition))
+
+        for null_columns, params in deletes.items():
+            self.db.execute(
+                delete(index_table).where(
+                    index_table.c.id == bindparam("_id"),
+                    *[
+                        index_table.c[column].is_(None) if column in null_columns
+                        else index_table.c[column] == bindparam("_" + column)
+                        for column in columns
+                    ],
+                ),
+                params,
+            )
+
+        if inserts:
+            self.db.execute(insert(index_table), inserts)
+
+        if inserts or deleted_rows:
+            self._on_index_changed(indexer, inserts, deleted_rows)
+
+    def _on_index_changed(self, indexer: Indexer, inserted_rows: List[Dict], deleted_rows: List[Dict]):
+        """Called in the write transaction with the index rows (column name -> value, including id) that
+        `put` inserted and deleted, e.g. to maintain aggregates of the index. Not called by `rebuild_index`."""
+        pass
     
     def update(self, doc: T):
         # TODO: optimistic locking
@@ -60,12 +167,46 @@ class Repo(Generic[T]):
                 for indexer in indexers:
                     self._update_index(indexer, row.id, doc)
 
-    def all(self) -> Iterator[T]:
-        return (self._doc_from_row(row) for row in self.db.execute(select(self.table)))
+    def all_ids(self) -> List[str]:
+        return [row.id for row in self.db.execute(select(self.table.c.id))]
+
+    def all(self, fields: Optional[Collection[str]] = None) -> Iterator[T]:
+        return (self._doc_from_row(row, fields) for row in self.db.execute(self._select_docs(fields)))
+
+    def _select_docs(self, fields: Optional[Collection[str]] = None) -> Select:
+        """Select whole documents, or only `fields` extracted from the JSON content in the database."""
+        if fields is None:
+            return select(self.table)
+        return select(self.table.c.id, *[self._content_field(field).label(field) for field in fields])
+
+    def _content_field(self, name: str):
+        if self.db.engine.dialect.name == "postgresql":
+            content = cast(self.table.c.content, postgresql.JSONB)
+        else:
+            content = type_coerce(self.table.c.content, JSON)
+        return content[name]
     
-    def _doc_from_row(self, row: Union[Row, None]) -> Union[T, None]:
+    def _doc_from_row(self, row: Union[Row, None], fields: Optional[Collection[str]] = None) -> Union[T, None]:
         if row is None:
             return None
+        if fields is not None:
+            return self._projection_from_row(row, fields)
         content = json.loads(row.content)
         content["id"] = row.id
         return self.schema.doc_cls.model_validate(content)
+
+    def _projection_from_row(self, row: Row, fields: Collection[str]):
+        projection_cls = self.schema.projection_cls(fields)
+        content = {"id": row.id}
+        for field in fields:
+            value = row._mapping[field]
+            # missing keys are also extracted as null, let the field default apply to them
+            if value is None and not projection_cls.model_fields[field].is_required():
+                continue
+            content[field] = value
+        return projection_cls.model_validate(content)
+
+    @staticmethod
+    def _chunked(items: List, size: int = _MAX_IN_PARAMS) -> Iterator[List]:
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
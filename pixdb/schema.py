@@ -1,5 +1,5 @@
-from typing import Callable, Generic, Iterator, List, Tuple, Type, TypeVar, Union
-from pydantic import BaseModel
+from typing import Callable, Dict, FrozenSet, Generic, Iterable, Iterator, List, Tuple, Type, TypeVar, Union
+from pydantic import BaseModel, create_model
 from sqlalchemy import Column, ForeignKey, Index, MetaData, String, Table, desc
 
 from sqlalchemy.sql.type_api import TypeEngine
@@ -49,6 +49,7 @@ class Schema(Generic[T]):
         self.doc_cls = doc_cls
         self.table_name = table_name or doc_cls.__name__
         self.indexers: List[Indexer] = []
+        self._projection_classes: Dict[FrozenSet[str], Type[BaseModel]] = {}
         self.table = Table(
             self.table_name,
             metadata,
@@ -72,3 +73,19 @@ class Schema(Generic[T]):
         indexer = Indexer(table, fields, entries_extractor, meta_fields)
         self.indexers.append(indexer)
         return indexer
+
+    def projection_cls(self, fields: Iterable[str]) -> Type[BaseModel]:
+        """Model with only `id` and the given fields of the document class, for partially loaded documents."""
+        fields = frozenset(fields) | {"id"}
+        cls = self._projection_classes.get(fields)
+        if cls is None:
+            cls = create_model(
+                f"{self.doc_cls.__name__}Projection",
+                **{
+                    name: (field.annotation, field)
+                    for name, field in self.doc_cls.model_fields.items()
+                    if name in fields
+                },
+            )
+            self._projection_classes[fields] = cls
+        return cls
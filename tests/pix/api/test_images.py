@@ -0,0 +1,83 @@
+import datetime
+from typing import Dict, List, Tuple
+import numpy as np
+from sqlalchemy import create_engine
+from pix.api.images import _search_similar_images, _similar_image_results
+from pix.app import AppGraph
+from pix.embedding_index import MultiEmbeddingIndexManager
+from pix.model.base import metadata
+from pix.model.image import Image, ImageRepo, Vector
+from pixdb.db import Database
+from pixdb.inject import Graph
+
+
+class FakeIndexManager:
+    def __init__(self, hits: List[Tuple[str, float]]):
+        self.hits = hits
+
+    def search(self, emb: np.ndarray, top_k: int):
+        return self.hits[:top_k]
+
+
+class FakeMultiIndexManager:
+    def __init__(self, hits_by_type: Dict[str, List[Tuple[str, float]]]):
+        self.managers = {embedding_type: FakeIndexManager(hits) for embedding_type, hits in hits_by_type.items()}
+
+    def get_manager(self, name: str):
+        return self.managers[name]
+
+
+def _setup(hits_by_type: Dict[str, List[Tuple[str, float]]]) -> ImageRepo:
+    engine = create_engine("sqlite://", echo=True)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(Database(engine))
+    graph = Graph()
+    graph.bind_instance(ImageRepo, image_repo)
+    graph.bind_instance(MultiEmbeddingIndexManager, FakeMultiIndexManager(hits_by_type))
+    AppGraph.bind(graph)
+    return image_repo
+
+
+def test_similar_image_results():
+    image_repo = _setup({})
+    image_repo.put_many([_new_image("a", {}), _new_image("b", {})])
+
+    results = _similar_image_results([("b", 0.9), ("missing", 0.8), ("a", 0.5)])
+    assert [(result["image"].id, result["score"]) for result in results] == [("b", 0.9), ("a", 0.5)]
+
+
+def test_search_similar_images():
+    image_repo = _setup({
+        "clip": [("q", 1.0), ("a", 0.9), ("missing", 0.8), ("b", 0.7)],
+        "resnet": [("c", 0.6)],
+    })
+    image_repo.put_many([
+        _new_image("a", {"clip": [1, 0], "resnet": [1, 0]}),
+        _new_image("b", {"clip": [0, 1], "resnet": [0.6, 0.8]}),
+        _new_image("c", {"clip": [0.8, 0.6], "resnet": [0, 1]}),
+    ])
+
+    results = _search_similar_images({"clip": _vector([1, 0]), "resnet": _vector([0, 1])}, "q")
+    # the hits of the other types are scored against the query, the query image and missing ids are left out
+    assert [
+        (result["type"], [(image["image"].id, round(image["score"], 6)) for image in result["images"]])
+        for result in results
+    ] == [
+        ("clip", [("a", 0.9), ("c", 0.8), ("b", 0.7)]),
+        ("resnet", [("b", 0.8), ("c", 0.6), ("a", 0.0)]),
+    ]
+
+
+def _vector(values: List[float]) -> Vector:
+    return Vector.from_numpy(np.array(values, dtype=np.float32))
+
+
+def _new_image(id: str, embeddings: Dict[str, List[float]]):
+    return Image(
+        id=id,
+        local_filename="",
+        collected_at=datetime.datetime.now(),
+        source_url=None,
+        tweet_id=None,
+        embeddings={embedding_type: _vector(values) for embedding_type, values in embeddings.items()},
+    )
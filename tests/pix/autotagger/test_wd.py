@@ -0,0 +1,44 @@
+import numpy as np
+from pix.autotagger.wd import predict
+from pix.model.image import TagType
+
+
+class FakeSession:
+    def __init__(self, probs: np.ndarray, embs: np.ndarray):
+        self.probs = probs
+        self.embs = embs
+
+    def run(self, output_names, feeds):
+        return self.probs, self.embs
+
+
+def _predict_per_label(probs, general_threshold, character_threshold, tag_names, rating_indexes, general_indexes, character_indexes):
+    """The per-label loop `predict` replaced."""
+    labels = list(zip(tag_names, probs.astype(float)))
+    ratings = [(f"rating:{tag[0]}", TagType.RATING, score) for tag, score in [labels[i] for i in rating_indexes] if score > general_threshold]
+    general_res = [(tag, None, score) for tag, score in [labels[i] for i in general_indexes] if score > general_threshold]
+    character_res = [(tag, TagType.CHARACTER, score) for tag, score in [labels[i] for i in character_indexes] if score > character_threshold]
+    return ratings + general_res + character_res
+
+
+def test_predict_matches_per_label_selection():
+    rng = np.random.default_rng(0)
+    tag_names = np.array(["general", "sensitive", "questionable", "explicit"] + [f"tag{i}" for i in range(200)], dtype=object)
+    rating_indexes = np.arange(4)
+    general_indexes = np.arange(4, 150)
+    # not in label order, the selection follows the order of the indexes
+    character_indexes = rng.permutation(np.arange(150, 204))
+    probs = rng.random((5, len(tag_names)), dtype=np.float32) ** 4
+    probs[3] = 0  # nothing selected
+    embs = rng.random((5, 8), dtype=np.float32)
+
+    results = predict(
+        np.zeros((5, 1)), FakeSession(probs, embs), "input", ["probs", "embs"], 0.35, 0.85,
+        tag_names, rating_indexes, general_indexes, character_indexes,
+    )
+    assert len(results) == 5
+    for row, result in zip(probs, results):
+        assert result.tags == _predict_per_label(row, 0.35, 0.85, tag_names, rating_indexes, general_indexes, character_indexes)
+    assert results[3].tags == []
+    assert any(type == TagType.CHARACTER for result in results for _, type, _ in result.tags)
+    assert np.array_equal(results[1].embedding, embs[1])
@@ -0,0 +1,130 @@
+from pathlib import Path
+import numpy as np
+import PIL.Image
+import pytest
+from pix.embeddings.onnx_embedder import TRANSFORMS, OnnxEmbedder, OnnxEmbedders
+
+
+def _random_image(width: int, height: int):
+    rng = np.random.default_rng(0)
+    return PIL.Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+def test_image_transform():
+    x = TRANSFORMS["clip"](_random_image(300, 451))
+    assert x.shape == (3, 224, 224)
+    assert x.dtype == np.float32
+
+    x = TRANSFORMS["siglip2"](_random_image(300, 451))
+    assert x.shape == (3, 256, 256)
+    assert -1 <= x.min() and x.max() <= 1
+
+
+def test_image_transform_matches_torchvision():
+    transforms = pytest.importorskip("torchvision.transforms")
+    expected_transform = transforms.Compose([
+        transforms.Resize(224, interpolation=transforms.InterpolationMode.BICUBIC),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)),
+    ])
+    for size in (300, 451), (451, 300), (223, 223):
+        im = _random_image(*size)
+        np.testing.assert_allclose(TRANSFORMS["csd"](im), expected_transform(im).numpy(), atol=1e-5)
+
+
+def test_image_transform_matches_model_processors():
+    expected_transforms = {}
+    try:
+        from torchvision import models
+        expected_transforms["resnet"] = models.ResNet152_Weights.DEFAULT.transforms()
+    except ImportError:
+        pass
+    try:
+        import open_clip
+        expected_transforms["clip"] = open_clip.image_transform(224, is_train=False)
+    except ImportError:
+        pass
+    try:
+        from transformers import AutoImageProcessor
+        for embedding_type, model_id in ("dinov2", "facebook/dinov2-base"), ("siglip2", "google/siglip2-large-patch16-256"):
+            try:
+                processor = AutoImageProcessor.from_pretrained(model_id)
+            except OSError:
+                # not downloaded and offline
+                continue
+            expected_transforms[embedding_type] = lambda im, processor=processor: processor(images=im, return_tensors="pt").pixel_values[0]
+    except ImportError:
+        pass
+    if not expected_transforms:
+        pytest.skip("no model preprocessing libraries")
+
+    for embedding_type, expected_transform in expected_transforms.items():
+        for size in (300, 451), (451, 300), (223, 223):
+            im = _random_image(*size)
+            np.testing.assert_allclose(TRANSFORMS[embedding_type](im), expected_transform(im).numpy(), atol=1e-4, err_msg=embedding_type)
+
+
+def test_export_only_when_outdated(tmpdir: Path):
+    class FakeTorchEmbedder:
+        model_id = "a"
+        exported = 0
+
+        def export_onnx(self, path: Path, input_size):
+            self.exported += 1
+            path.write_bytes(b"")
+
+    onnx_embedders = OnnxEmbedders(Path(tmpdir), embedding_onnx_quantize=False, embedding_threads=None)
+    torch_embedder = FakeTorchEmbedder()
+    assert not onnx_embedders.exists("clip")
+    onnx_embedders.export("clip", torch_embedder)
+    assert onnx_embedders.exists("clip")
+    onnx_embedders.export("clip", torch_embedder)
+    assert torch_embedder.exported == 1
+
+    torch_embedder.model_id = "b"
+    onnx_embedders.export("clip", torch_embedder)
+    assert torch_embedder.exported == 2
+
+    # exported before the versioned metadata
+    onnx_embedders.meta_path("clip").unlink()
+    assert not onnx_embedders.exists("clip")
+    onnx_embedders.export("clip", torch_embedder)
+    assert torch_embedder.exported == 3
+    assert onnx_embedders.exists("clip")
+
+
+def test_export_matches_torch(tmpdir: Path):
+    torch = pytest.importorskip("torch")
+    from pix.embeddings.torch_embedder import TorchEmbedder, TorchRuntime
+
+    class TinyEmbedder(TorchEmbedder):
+        def load_model(self):
+            if self._model_loaded:
+                return
+            torch.manual_seed(0)
+            self.model = torch.nn.Sequential(
+                torch.nn.Conv2d(3, 8, 3, stride=2),
+                torch.nn.ReLU(),
+                torch.nn.AdaptiveAvgPool2d(1),
+                torch.nn.Flatten(),
+            ).eval()
+            self._model_loaded = True
+
+        def preprocess(self, im):
+            return torch.from_numpy(TRANSFORMS["clip"](im))
+
+        def forward(self, images):
+            return self.model(images)
+
+    torch_embedder = TinyEmbedder(TorchRuntime("cpu", "float16", None))
+    path = Path(tmpdir) / "tiny.onnx"
+    torch_embedder.export_onnx(path, TRANSFORMS["clip"].input_size)
+    onnx_embedder = OnnxEmbedder(path, TRANSFORMS["clip"])
+    onnx_embedder.load_model()
+
+    images = [_random_image(300, 451), _random_image(224, 224), _random_image(500, 300)]
+    expected = torch_embedder.extract_preprocessed([torch_embedder.preprocess(im) for im in images])
+    actual = onnx_embedder.extract_preprocessed([onnx_embedder.preprocess(im) for im in images])
+    assert actual.shape == (3, 8)
+    np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-5)
@@ -1,8 +1,11 @@
 import datetime
+import json
 from typing import List, Mapping, Union
+import numpy as np
+import sqlalchemy as sa
 from sqlalchemy import create_engine
 from pix.model.base import metadata
-from pix.model.image import Image, ImageRepo, ImageTag, Vector
+from pix.model.image import Image, ImageRepo, ImageTag, TagQuery, Vector
 from pixdb.db import Database
 
 
@@ -21,6 +24,92 @@ def test_list_by_tag_collected_at_desc():
     assert set(doc.id for doc in image_repo.list_by_tag_collected_at_desc("-b", 0, 10)) == {"a"}
 
 
+def test_tag_query_plan_walks_tag_index():
+    engine = create_engine("sqlite://", echo=True)
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+
+    image_repo.put_many([_new_image(f"common{i}", tags=["common"]) for i in range(10)])
+    image_repo.update(_new_image("rare", tags=["common", "rare"]))
+
+    assert [doc.id for doc in image_repo.list_by_tag_collected_at_desc("common rare -b face:x", 0, 10)] == []
+    assert [doc.id for doc in image_repo.list_by_tag_collected_at_desc("common rare -b", 0, 10)] == ["rare"]
+    assert image_repo.count_by_tag("common -rare") == 10
+
+    query = image_repo._select_by_tag_collected_at(TagQuery.parse("common rare -b face:x"), 0, 20)
+    plan = [row.detail for row in db.execute(sa.text(
+        "EXPLAIN QUERY PLAN " + str(query.compile(engine, compile_kwargs={"literal_binds": True}))
+    ))]
+    # driven by the entries of the rarest tag in collected_at order, without sorting all matches
+    assert any(
+        detail.startswith(f"SEARCH {image_repo.idx_tag_new.table.name} USING INDEX") and "tag=?" in detail
+        for detail in plan
+    ), plan
+    assert "USE TEMP B-TREE FOR ORDER BY" not in plan
+    table, conditions = image_repo._plan_tag_query("common rare -b")
+    assert table is image_repo.idx_tag_new.table
+    assert conditions[0].right.value == "rare"
+
+
+def test_tag_counts_are_maintained():
+    engine = create_engine("sqlite://", echo=True)
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+
+    image_repo.put_many([_new_image("a", tags=["a"]), _new_image("ab", tags=["a", "b"])])
+    image = _new_image("c", tags=["c"])
+    image.manual_tags = [ImageTag(tag="b", type=None)]
+    image_repo.update(image)
+    assert dict(image_repo.list_all_tags_with_count(None)) == {"a": 2, "b": 2, "c": 1}
+
+    image_repo.update(_new_image("ab", tags=["b"]))
+    image_repo.update(_new_image("c", tags=[]))
+    assert dict(image_repo.list_all_tags_with_count(None)) == {"a": 1, "b": 1}
+    assert dict(image_repo.list_all_tags_with_count("b")) == {"b": 1}
+    assert dict(image_repo.list_all_tags_with_count("-b")) == {"a": 1}
+
+    counts = dict(image_repo.list_all_tags_with_count(None))
+    image_repo.rebuild_tag_counts()
+    assert dict(image_repo.list_all_tags_with_count(None)) == counts
+
+    # the table created empty on a database that already had tags
+    with db.transactional():
+        db.execute(sa.delete(image_repo.tag_count_table))
+    image_repo.ensure_tag_counts()
+    assert dict(image_repo.list_all_tags_with_count(None)) == counts
+    image_repo.update(_new_image("d", tags=["a", "d"]))
+    image_repo.ensure_tag_counts()
+    assert dict(image_repo.list_all_tags_with_count(None)) == {"a": 2, "b": 1, "d": 1}
+
+
+def test_tag_in_manual_and_auto_tags_is_indexed_once():
+    engine = create_engine("sqlite://", echo=True)
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+
+    image = _new_image("x", tags=["a", "b"])
+    image.manual_tags = [ImageTag(tag="a", type=None)]
+    image_repo.update(image)
+
+    assert [doc.id for doc in image_repo.list_by_tag_collected_at_desc("a", 0, 10)] == ["x"]
+    assert [doc.id for doc in image_repo.list_by_tag_collected_at_desc("a b", 0, 10)] == ["x"]
+    assert image_repo.count_by_tag("a") == 1
+    assert dict(image_repo.list_all_tags_with_count(None)) == {"a": 1, "b": 1}
+    # the manual tag takes precedence
+    assert db.execute(sa.select(image_repo.idx_tag_score.c.score).where(image_repo.idx_tag_score.c.tag == "a")).scalars().all() == [1.0]
+
+    # entries written before the extractors were distinct
+    t = image_repo.idx_tag_new.table
+    with db.transactional():
+        db.execute(sa.insert(t).values(tag="a", collected_at=image.collected_at, id="x"))
+    assert image_repo.count_by_tag("a") == 2
+    image_repo.repair_tag_indexes()
+    assert image_repo.count_by_tag("a") == 1
+
+
 def test_list_needs_embedding():
     engine = create_engine("sqlite://", echo=True)
     db = Database(engine)
@@ -34,6 +123,107 @@ def test_list_needs_embedding():
     assert set(doc.id for doc in image_repo.list_needs_embedding("clip")) == {"empty", "no_clip"}
 
 
+def test_embeddings_are_stored_outside_document():
+    engine = create_engine("sqlite://", echo=True)
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+
+    clip = np.arange(4, dtype=np.float32)
+    image = _new_image("a", embeddings={"clip": Vector.from_numpy(clip)})
+    image.embedding = Vector.from_numpy(np.ones(2, dtype=np.float32))
+    image_repo.update(image)
+
+    content = db.execute(sa.select(image_repo.table.c.content)).scalar_one()
+    assert "clip" in content and Vector.from_numpy(clip).data.decode() not in content
+
+    image = image_repo.get("a")
+    assert image.embeddings is None
+    assert set(image.embedding_types) == {"default", "clip"}
+
+    image_repo.load_embeddings([image], ["clip"])
+    assert image.embedding is None
+    assert np.array_equal(image.get_embedding("clip").to_numpy(), clip)
+
+    image.set_embedding("resnet", Vector.from_numpy(np.zeros(3, dtype=np.float32)))
+    image_repo.update(image)
+    assert [(embedding_type, image_id) for embedding_type, image_id, _ in image_repo.iter_embeddings(["resnet"])] == [("resnet", "a")]
+    assert set(image_repo.get("a").embedding_types) == {"default", "clip", "resnet"}
+
+
+def test_list_with_fields():
+    engine = create_engine("sqlite://", echo=True)
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+
+    image_repo.update(_new_image("a", tags=["a"]))
+
+    images = image_repo.list_by_collected_at_desc(0, 10, fields=["collected_at", "tags", "embedding_types"])
+    assert len(images) == 1
+    image = images[0]
+    assert image.id == "a"
+    assert [tag.tag for tag in image.tags] == ["a"]
+    assert isinstance(image.collected_at, datetime.datetime)
+    assert image.embedding_types == []
+    assert not hasattr(image, "faces")
+
+    assert image_repo.get_many(["a"], fields=["source_url"])["a"].source_url is None
+
+
+def test_projection_of_inline_embeddings():
+    engine = create_engine("sqlite://", echo=True)
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+
+    # written before the embedding store
+    image = _new_image("legacy")
+    content = json.loads(image.model_dump_json(exclude={"id"}))
+    content["embedding"] = json.loads(Vector.from_numpy(np.ones(2, dtype=np.float32)).model_dump_json())
+    content["embeddings"] = {"clip": json.loads(Vector.from_numpy(np.zeros(2, dtype=np.float32)).model_dump_json())}
+    with db.transactional():
+        db.execute(sa.insert(image_repo.table).values(id="legacy", content=json.dumps(content)))
+    image_repo.update(_new_image("new", embeddings={"clip": Vector.from_numpy(np.zeros(2, dtype=np.float32))}))
+
+    projections = image_repo.get_many(["legacy", "new"], fields=["embedding_types"])
+    assert projections["legacy"].embedding_types == ["default", "clip"]
+    assert projections["new"].embedding_types == ["clip"]
+    assert image_repo.get("legacy").embedding_types == ["default", "clip"]
+
+
+def test_list_by_collected_at_desc_after():
+    engine = create_engine("sqlite://", echo=True)
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+
+    collected_at = datetime.datetime(2024, 1, 1)
+    images = []
+    for i, id in enumerate(["a", "b", "c", "d", "e"]):
+        image = _new_image(id, tags=["t"])
+        # two images at each time to check the id tie breaker
+        image.collected_at = collected_at + datetime.timedelta(minutes=i // 2)
+        images.append(image)
+    image_repo.put_many(images)
+
+    for descending in (True, False):
+        expected = sorted(images, key=lambda image: (image.collected_at, image.id), reverse=descending)
+        pages = []
+        after = None
+        while True:
+            page = image_repo.list_by_tag_collected_at_desc("t", 0, 2, descending=descending, after=after)
+            if not page:
+                break
+            pages.extend(page)
+            after = (page[-1].collected_at, page[-1].id)
+        assert [image.id for image in pages] == [image.id for image in expected]
+
+        after = (expected[2].collected_at, expected[2].id)
+        page = image_repo.list_by_collected_at_desc(0, 10, descending=descending, after=after)
+        assert [image.id for image in page] == [image.id for image in expected[3:]]
+
+
 def _new_image(id: str, *, tags: Union[List[str], None] = None, embeddings: Union[Mapping[str, Vector], None] = None):
     return Image(
         id=id,
@@ -0,0 +1,111 @@
+import datetime
+import json
+from pathlib import Path
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy import create_engine
+from pix.embedding_index import EmbeddingIndex
+from pix.model.base import metadata
+from pix.model.image import Image, ImageRepo, Vector
+from pix.task.build_embedding_index import build_indexes_incremental, prune_embedding_changes
+from pixdb.db import Database
+
+
+def test_build_indexes_incremental(tmpdir: Path):
+    engine = create_engine("sqlite://", echo=True)
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+    emb_dir = Path(tmpdir)
+
+    xb = np.eye(4, dtype='float32')
+    image_repo.put_many([_new_image("a", xb[0]), _new_image("b", xb[1])])
+    build_indexes_incremental(["clip"], image_repo, emb_dir)
+    assert _search(emb_dir, xb[1]) == "b"
+
+    image_c = _new_image("c", xb[2])
+    image_b = image_repo.get("b")
+    image_b.set_embedding("clip", Vector.from_numpy(xb[3]))
+    image_a = image_repo.get("a")
+    image_a.remove_embedding("clip")
+    image_repo.put_many([image_a, image_b, image_c])
+    build_indexes_incremental(["clip"], image_repo, emb_dir)
+
+    index = EmbeddingIndex()
+    index.load(EmbeddingIndex.current_dir(emb_dir / "clip"))
+    assert index.meta["seq"] == image_repo.last_embedding_change_seq()
+    assert len(index) == 2
+    assert _search(emb_dir, xb[3]) == "b"
+    assert _search(emb_dir, xb[2]) == "c"
+    assert "a" not in index
+
+
+def test_full_build_migrates_inline_embeddings(tmpdir: Path):
+    engine = create_engine("sqlite://", echo=True)
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+    emb_dir = Path(tmpdir)
+
+    xb = np.eye(4, dtype='float32')
+    # written before the embedding store
+    legacy = _new_image("legacy", xb[0])
+    content = json.loads(legacy.model_dump_json(exclude={"id"}))
+    content["embeddings"] = {"clip": json.loads(legacy.embeddings["clip"].model_dump_json())}
+    with db.transactional():
+        db.execute(sa.insert(image_repo.table).values(id="legacy", content=json.dumps(content)))
+    image_repo.put_many([_new_image("new", xb[1])])
+    assert image_repo.list_ids_with_inline_embeddings() == ["legacy"]
+
+    build_indexes_incremental(["clip"], image_repo, emb_dir)
+    assert _search(emb_dir, xb[0]) == "legacy"
+    assert _search(emb_dir, xb[1]) == "new"
+    assert image_repo.list_ids_with_inline_embeddings() == []
+
+
+def test_prune_embedding_changes(tmpdir: Path):
+    engine = create_engine("sqlite://", echo=True)
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+    emb_dir = Path(tmpdir) / "emb-index"
+    state_path = Path(tmpdir) / "custom-autotag.json"
+
+    xb = np.eye(4, dtype='float32')
+    image_repo.put_many([_new_image("a", xb[0])])
+    custom_seq = image_repo.last_embedding_change_seq()
+    state_path.write_text(json.dumps({"seq": custom_seq}))
+    image_repo.put_many([_new_image("b", xb[1]), _new_image("c", xb[2])])
+    build_indexes_incremental(["clip"], image_repo, emb_dir)
+
+    # held back by the custom autotagger
+    prune_embedding_changes(["clip", "resnet"], image_repo, emb_dir, state_path)
+    assert [image_id for _, _, image_id in image_repo.list_embedding_changes(0)] == ["b", "c"]
+
+    # the last change is kept so that its seq is not reused
+    state_path.unlink()
+    last_seq = image_repo.last_embedding_change_seq()
+    prune_embedding_changes(["clip", "resnet"], image_repo, emb_dir, state_path)
+    assert [image_id for _, _, image_id in image_repo.list_embedding_changes(0)] == ["c"]
+
+    image_repo.put_many([_new_image("d", xb[3])])
+    assert image_repo.last_embedding_change_seq() > last_seq
+    build_indexes_incremental(["clip"], image_repo, emb_dir)
+    assert _search(emb_dir, xb[3]) == "d"
+
+
+def _search(emb_dir: Path, emb: np.ndarray):
+    index = EmbeddingIndex()
+    index.load(EmbeddingIndex.current_dir(emb_dir / "clip"))
+    return index.search(emb, 1)[0][0]
+
+
+def _new_image(id: str, clip: np.ndarray):
+    return Image(
+        id=id,
+        local_filename="",
+        collected_at=datetime.datetime.now(),
+        source_url=None,
+        tweet_id=None,
+        embeddings={"clip": Vector.from_numpy(clip)},
+    )
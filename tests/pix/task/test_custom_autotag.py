@@ -0,0 +1,98 @@
+import datetime
+from pathlib import Path
+import numpy as np
+from sqlalchemy import create_engine
+from pix.autotagger.custom import select_tags
+from pix.model.base import metadata
+from pix.model.image import Image, ImageRepo, ImageTag, TagType, Vector
+from pix.task.custom_autotag import apply_custom_autotags
+from pixdb.db import Database
+
+
+class FakeAutotagger:
+    tags = ["alice", "bob"]
+
+    def __init__(self, model_path: Path):
+        self.model_path = model_path
+        self.extracted = 0
+
+    def load_model(self):
+        pass
+
+    def extract_batch(self, embeddings: np.ndarray):
+        self.extracted += len(embeddings)
+        return select_tags(embeddings[:, :2], np.array(self.tags, dtype=object), 0.7)
+
+
+def test_apply_custom_autotags(tmpdir: Path):
+    engine = create_engine("sqlite://", echo=True)
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+    model_path = Path(tmpdir) / "model.onnx"
+    model_path.touch()
+    state_path = Path(tmpdir) / "state.json"
+    autotagger = FakeAutotagger(model_path)
+
+    image_repo.put_many([
+        _new_image("a", [0.9, 0.1, 0], [ImageTag(tag="bob", type=TagType.CHARACTER, score=0.9), ImageTag(tag="cat", type=None)]),
+        _new_image("b", [0.1, 0.1, 0], [ImageTag(tag="dog", type=None)]),
+    ])
+    apply_custom_autotags(image_repo, autotagger, state_path)
+    image_a = image_repo.get("a")
+    # the WD tagger's bob is kept although it is in the custom vocabulary
+    assert [(tag.tag, tag.type) for tag in image_a.tags] == [("bob", TagType.CHARACTER), ("cat", None)]
+    assert [(tag.tag, tag.type) for tag in image_a.custom_tags] == [("alice", TagType.CHARACTER)]
+    assert image_repo.get("b").custom_tags is None
+    assert autotagger.extracted == 2
+
+    # only the changed embedding is scored again
+    image_b = image_repo.get("b")
+    image_b.embedding = Vector.from_numpy(np.array([0.1, 0.8, 0], dtype=np.float32))
+    image_repo.put_many([image_b])
+    apply_custom_autotags(image_repo, autotagger, state_path)
+    assert [tag.tag for tag in image_repo.get("b").custom_tags] == ["bob"]
+    assert autotagger.extracted == 3
+
+    # a prediction that is no longer made is removed
+    image_b = image_repo.get("b")
+    image_b.embedding = Vector.from_numpy(np.array([0.1, 0.1, 0], dtype=np.float32))
+    image_repo.put_many([image_b])
+    apply_custom_autotags(image_repo, autotagger, state_path)
+    image_b = image_repo.get("b")
+    assert image_b.custom_tags == []
+    assert [tag.tag for tag in image_b.tags] == ["dog"]
+    assert autotagger.extracted == 4
+
+    apply_custom_autotags(image_repo, autotagger, state_path)
+    assert autotagger.extracted == 4
+
+
+def test_apply_custom_autotags_skips_manual_tags(tmpdir: Path):
+    engine = create_engine("sqlite://", echo=True)
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+    model_path = Path(tmpdir) / "model.onnx"
+    model_path.touch()
+    autotagger = FakeAutotagger(model_path)
+
+    image = _new_image("a", [0.9, 0.8, 0], [ImageTag(tag="cat", type=None)])
+    image.manual_tags = [ImageTag(tag="alice", type=TagType.CHARACTER)]
+    image_repo.put_many([image])
+    apply_custom_autotags(image_repo, autotagger, Path(tmpdir) / "state.json")
+    assert [tag.tag for tag in image_repo.get("a").tags] == ["cat"]
+    assert [tag.tag for tag in image_repo.get("a").custom_tags] == ["bob"]
+    assert dict(image_repo.list_all_tags_with_count(None)) == {"alice": 1, "bob": 1, "cat": 1}
+
+
+def _new_image(id: str, embedding, tags):
+    return Image(
+        id=id,
+        local_filename="",
+        collected_at=datetime.datetime.now(),
+        source_url=None,
+        tweet_id=None,
+        tags=tags,
+        embedding=Vector.from_numpy(np.array(embedding, dtype=np.float32)),
+    )
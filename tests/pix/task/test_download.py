@@ -0,0 +1,77 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import threading
+from types import SimpleNamespace
+import pytest
+import requests
+from pix.model.tweet import Attachment, Tweet
+from pix.task.download import DOWNLOAD_FILE_MODE, DownloadTask
+
+
+class Handler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        Handler.requests.append(self.path)
+        # fails the first request of /flaky/ paths
+        if self.path.startswith("/flaky/") and Handler.requests.count(self.path) == 1:
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.path.startswith("/missing/"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def _tweet(id: str, urls):
+    return Tweet(
+        id=id,
+        attachments=[Attachment(tweet_id=id, type="photo", url=url) for url in urls],
+        created_at=None,
+    )
+
+
+def test_download_images(tmpdir: Path, server: str):
+    images_dir = Path(tmpdir)
+    task = DownloadTask(SimpleNamespace(images_dir=images_dir), None, None, None, None)
+    (images_dir / "1.photo.b.jpg").write_bytes(b"existing")
+
+    tweets = [
+        _tweet("1", [f"{server}/a/a.jpg", f"{server}/b/b.jpg"]),
+        _tweet("2", [f"{server}/flaky/c.jpg"]),
+    ]
+    result = task._download_images(tweets)
+
+    assert [attachment.url for _, attachment in result] == [attachment.url for tweet in tweets for attachment in tweet.attachments]
+    assert (images_dir / "1.photo.a.jpg").read_bytes() == b"/a/a.jpg"
+    assert (images_dir / "1.photo.b.jpg").read_bytes() == b"existing"
+    assert (images_dir / "2.photo.c.jpg").read_bytes() == b"/flaky/c.jpg"
+    assert (images_dir / "1.photo.a.jpg").stat().st_mode & 0o777 == DOWNLOAD_FILE_MODE
+    assert sorted(Handler.requests) == ["/a/a.jpg", "/flaky/c.jpg", "/flaky/c.jpg"]
+
+
+def test_download_images_failure(tmpdir: Path, server: str):
+    images_dir = Path(tmpdir)
+    task = DownloadTask(SimpleNamespace(images_dir=images_dir), None, None, None, None)
+
+    with pytest.raises(requests.HTTPError):
+        task._download_images([_tweet("1", [f"{server}/a/a.jpg", f"{server}/missing/b.jpg"])])
+    assert sorted(path.name for path in images_dir.iterdir()) == ["1.photo.a.jpg"]
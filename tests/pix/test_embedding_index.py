@@ -1,6 +1,10 @@
 from pathlib import Path
 
-from pix.embedding_index import EmbeddingIndex
+import faiss
+import numpy as np
+import pytest
+
+from pix.embedding_index import EmbeddingIndex, EmbeddingIndexManager, encode_ids
 
 
 def test_e2e(tmpdir: Path):
@@ -26,3 +30,164 @@ def test_e2e(tmpdir: Path):
     after_save_result = index.search(xb[0], 5)
 
     assert before_save_result == after_save_result
+
+
+def test_remove(tmpdir: Path):
+    index = EmbeddingIndex()
+
+    xb = np.eye(4, dtype='float32')
+    for i, x in enumerate(xb):
+        index.add(f"id{i}", x)
+
+    index.remove(["id1"])
+    index.add("id2", xb[1])  # re-embedded
+    assert len(index) == 3
+    assert "id1" not in index
+    assert index.search(xb[1], 1) == [("id2", 1.0)]
+
+    index.meta["seq"] = 3
+    index.save(tmpdir)
+
+    index = EmbeddingIndex()
+    index.load(tmpdir)
+    assert index.meta["seq"] == 3
+    assert index.removed_count == 2
+    assert [doc_id for doc_id, _ in index.search(xb[3], 4)][0] == "id3"
+    assert index.search(xb[1], 1) == [("id2", 1.0)]
+
+
+def test_batch():
+    index = EmbeddingIndex()
+
+    xb = np.eye(4, dtype='float32')
+    index.add_batch(["id0", "id1", "id2"], xb[:3])
+    index.add_batch(["id2", "id3"], xb[[1, 3]])  # id2 re-embedded
+    assert len(index) == 4
+    assert index.removed_count == 1
+
+    results = index.search_batch(xb[[0, 1]], 2)
+    assert results[0][0] == ("id0", 1.0)
+    assert sorted(doc_id for doc_id, _ in results[1]) == ["id1", "id2"]
+    assert index.search(xb[3], 1) == [("id3", 1.0)]
+
+
+@pytest.mark.parametrize("index_type,search_params", [("Flat", ""), ("HNSW16", ""), ("IVF4,Flat", "nprobe=4")])
+def test_filtered_search(index_type: str, search_params: str):
+    index = EmbeddingIndex(index_type, search_params)
+    index.train_size = 100
+    np.random.seed(1234)
+    xb = np.random.random((1000, 16)).astype('float32')
+    index.add_batch([f"id{i}" for i in range(len(xb))], xb)
+
+    doc_ids = [f"id{i}" for i in range(0, len(xb), 50)]
+    hits = index.search(xb[0], 10, doc_ids + ["unknown"])
+    assert len(hits) == 10
+    assert hits[0][0] == "id0"
+    assert set(doc_id for doc_id, _ in hits) <= set(doc_ids)
+    assert index.search(xb[0], 10, []) == []
+
+
+@pytest.mark.parametrize("index_type,search_params", [("HNSW16", "efSearch=16"), ("IVF16,Flat", "nprobe=1")])
+def test_selective_filtered_search_is_exact(index_type: str, search_params: str):
+    index = EmbeddingIndex(index_type, search_params)
+    index.train_size = 1000
+    rng = np.random.default_rng(1234)
+    xb = rng.random((5000, 16), dtype=np.float32) - 0.5
+    doc_ids = [f"id{i}" for i in range(len(xb))]
+    index.add_batch(doc_ids, xb)
+
+    # too few for the HNSW walk even at max_filtered_ef_search, or for a single IVF probe
+    selected = rng.choice(len(xb), 12, replace=False)
+    faiss.normalize_L2(xb)
+    for query in xb[:5]:
+        hits = index.search(query, 5, [doc_ids[i] for i in selected])
+        expected = selected[np.argsort(-(xb[selected] @ query), kind="stable")[:5]]
+        assert [doc_id for doc_id, _ in hits] == [doc_ids[i] for i in expected]
+
+
+def test_filtered_search_of_legacy_index(tmpdir: Path):
+    # indexes written before IDMap were bare flat indexes with sequential labels
+    xb = np.eye(4, dtype='float32')
+    flat = faiss.IndexFlatIP(4)
+    flat.add(xb)
+    faiss.write_index(flat, str(Path(tmpdir) / EmbeddingIndex._INDEX_FILENAME))
+    (Path(tmpdir) / EmbeddingIndex._ID_FILENAME).write_text("id0\nid1\nid2\nid3\n")
+    index = EmbeddingIndex()
+    index.load(Path(tmpdir))
+
+    assert index.search(xb[1], 2, ["id1", "id3"])[0] == ("id1", 1.0)
+    assert sorted(doc_id for doc_id, _ in index.search(xb[1], 2, ["id2", "id3"])) == ["id2", "id3"]
+
+
+def test_trained_index_type(tmpdir: Path):
+    index = EmbeddingIndex("IVF4,Flat", "nprobe=4")
+    index.train_size = 100
+
+    np.random.seed(1234)
+    xb = np.random.random((200, 16)).astype('float32')
+    for i, x in enumerate(xb):
+        index.add(f"id{i}", x)
+    index.remove(["id0"])
+    index.save(tmpdir)
+
+    index = EmbeddingIndex()
+    index.load(tmpdir)
+    assert index.index_type == "IVF4,Flat"
+    assert index.search(xb[1], 1)[0][0] == "id1"
+    assert "id0" not in [doc_id for doc_id, _ in index.search(xb[0], 10)]
+
+
+def test_untrainable_index_type_falls_back_to_flat():
+    index = EmbeddingIndex("IVF64,Flat")
+    xb = np.eye(4, dtype='float32')
+    for i, x in enumerate(xb):
+        index.add(f"id{i}", x)
+    assert index.search(xb[2], 1)[0][0] == "id2"
+    assert index.index_type == "Flat"
+    assert index.meta["requested_index_type"] == "IVF64,Flat"
+
+
+def test_manager_reloads_new_version(tmpdir: Path):
+    dir = Path(tmpdir)
+    xb = np.eye(4, dtype='float32')
+    index = EmbeddingIndex()
+    index.add_batch(["id0", "id1"], xb[:2])
+    index.save_version(dir)
+
+    manager = EmbeddingIndexManager(dir)
+    manager.watched = True
+    assert manager.search(xb[1], 1) == [("id1", 1.0)]
+
+    index.add("id2", xb[2])
+    index.save_version(dir)
+    # keeps serving the loaded version until reloaded
+    assert manager.search(xb[2], 1)[0][0] != "id2"
+    assert manager.reload()
+    assert not manager.reload()
+    assert manager.search(xb[2], 1) == [("id2", 1.0)]
+
+    for _ in range(EmbeddingIndex.keep_versions):
+        index.save_version(dir)
+    assert len(list((dir / EmbeddingIndex._VERSIONS_DIRNAME).iterdir())) == EmbeddingIndex.keep_versions
+
+
+def test_load_mmap(tmpdir: Path):
+    xb = np.eye(4, dtype='float32')
+    index = EmbeddingIndex()
+    index.add_batch(["id0", "id1", "id2"], xb[:3])
+    index.remove(["id1"])
+    index.save(tmpdir)
+
+    index = EmbeddingIndex()
+    index.load(tmpdir, mmap=True)
+    assert len(index) == 2
+    assert index.removed_count == 1
+    assert "id2" in index
+    assert "id1" not in index
+    assert index.search(xb[2], 1) == [("id2", 1.0)]
+    assert index.search(xb[0], 2, ["id1", "id2", "unknown"]) == [("id2", 0.0)]
+    assert index.search(xb[0], 2, encode_ids(["id0", "id2"]))[0] == ("id0", 1.0)
+    # ids are looked up without building a dict in each process
+    assert index._labels is None
+    with pytest.raises(ValueError):
+        index.add("id3", xb[3])
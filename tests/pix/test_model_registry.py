@@ -0,0 +1,79 @@
+import threading
+import time
+import pix.model_registry
+from pix.model_registry import ModelRegistry
+
+MB = 1024 * 1024
+
+
+class FakeModel:
+    memory = 0
+    loads = 0
+
+    def __init__(self, size_mb: int):
+        self.size = size_mb * MB
+
+    def load_model(self):
+        time.sleep(0.01)
+        FakeModel.memory += self.size
+        FakeModel.loads += 1
+
+
+def _setup(monkeypatch):
+    FakeModel.memory = 0
+    FakeModel.loads = 0
+    monkeypatch.setattr(pix.model_registry, "_resident_memory", lambda: FakeModel.memory)
+
+
+def test_concurrent_uses_load_once(monkeypatch):
+    _setup(monkeypatch)
+    registry = ModelRegistry(None, 900)
+    models = []
+
+    def use():
+        with registry.use("a", lambda: FakeModel(10)) as model:
+            models.append(model)
+
+    threads = [threading.Thread(target=use) for _ in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert FakeModel.loads == 1
+    assert len(set(map(id, models))) == 1
+    assert registry.memory_usage() == 10 * MB
+
+
+def test_evict_over_budget(monkeypatch):
+    _setup(monkeypatch)
+    registry = ModelRegistry(25, 900)
+    registry.preload("a", lambda: FakeModel(10))
+    registry.preload("b", lambda: FakeModel(10))
+    with registry.use("a", lambda: FakeModel(10)):
+        pass
+    # b is the least recently used
+    registry.preload("c", lambda: FakeModel(10))
+    assert FakeModel.loads == 3
+    assert registry.memory_usage() == 20 * MB
+
+    with registry.use("a", lambda: FakeModel(10)) as model:
+        assert FakeModel.loads == 3
+        # models in use are kept even over the budget
+        registry.preload("b", lambda: FakeModel(10))
+        registry.preload("c", lambda: FakeModel(10))
+        with registry.use("a", lambda: FakeModel(10)) as model2:
+            assert model2 is model
+
+
+def test_evict_idle(monkeypatch):
+    _setup(monkeypatch)
+    registry = ModelRegistry(None, 0.05)
+    registry.preload("a", lambda: FakeModel(10))
+    with registry.use("b", lambda: FakeModel(10)):
+        time.sleep(0.1)
+        registry.evict_idle()
+        assert registry.memory_usage() == 10 * MB
+    registry.evict_idle()
+    assert registry.memory_usage() == 10 * MB
+
+    time.sleep(0.1)
+    registry.evict_idle()
+    assert registry.memory_usage() == 0
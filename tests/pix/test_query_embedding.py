@@ -0,0 +1,81 @@
+from collections import Counter
+from pathlib import Path
+import threading
+import time
+import numpy as np
+from pix.autotagger.wd import AutotagResult, WdAutotagger
+from pix.model_registry import ModelRegistry
+from pix.query_embedding import QueryEmbeddingService
+from pixdb.inject import Graph
+
+extracted = Counter()
+
+
+class FakeModel:
+    def __init__(self, key: str):
+        self.key = key
+
+    def load_model(self):
+        pass
+
+    def extract(self, file: Path):
+        time.sleep(0.05)
+        extracted[self.key] += 1
+        return np.full(2, len(file.read_bytes()), dtype=np.float32)
+
+
+class FakeWdAutotagger(FakeModel):
+    def __init__(self):
+        super().__init__("wd")
+
+    def extract(self, file: Path):
+        return AutotagResult(tags=[], embedding=super().extract(file))
+
+
+class FakeProvider:
+    def registry_entry(self, embedding_type: str, runtime=None):
+        return f"onnx:{embedding_type}", lambda: FakeModel(embedding_type)
+
+
+def _service() -> QueryEmbeddingService:
+    extracted.clear()
+    graph = Graph()
+    graph.bind_factory(WdAutotagger, FakeWdAutotagger)
+    return QueryEmbeddingService(ModelRegistry(None, 900), FakeProvider(), graph)
+
+
+def test_concurrent_queries_share_extraction(tmpdir: Path):
+    service = _service()
+    file = Path(tmpdir) / "a.jpg"
+    file.write_bytes(b"abc")
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(service.extract(file))) for _ in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert extracted == {"clip": 1, "csd": 1, "wd": 1}
+    assert sorted(results[0].keys()) == ["clip", "csd", "default"]
+    assert all(result is results[0] for result in results)
+
+
+def test_cache_by_content(tmpdir: Path):
+    service = _service()
+    service.cache_size = 1
+    file_a = Path(tmpdir) / "a.jpg"
+    file_a.write_bytes(b"abc")
+    # same content under another name
+    file_a2 = Path(tmpdir) / "a2.jpg"
+    file_a2.write_bytes(b"abc")
+    file_b = Path(tmpdir) / "b.jpg"
+    file_b.write_bytes(b"abcd")
+
+    embeddings = service.extract(file_a)
+    assert np.array_equal(embeddings["clip"].to_numpy(), [3, 3])
+    assert service.extract(file_a2) is embeddings
+    assert extracted == {"clip": 1, "csd": 1, "wd": 1}
+
+    assert np.array_equal(service.extract(file_b)["clip"].to_numpy(), [4, 4])
+    assert extracted == {"clip": 2, "csd": 2, "wd": 2}
+    # evicted by b
+    service.extract(file_a)
+    assert extracted == {"clip": 3, "csd": 3, "wd": 3}
@@ -0,0 +1,103 @@
+import datetime
+from typing import List
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+from pix.model.base import metadata
+from pix.model.face_cluster import FaceCluster, FaceClusterFace, FaceClusterRepo
+from pix.model.image import Image, ImageRepo, ImageTag, TagQuery
+from pix.tag_index import TagIndex
+from pixdb.db import Database
+
+
+def test_tag_index():
+    engine = create_engine("sqlite://", echo=True)
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+    face_cluster_repo = FaceClusterRepo(db)
+    tag_index = TagIndex(image_repo, face_cluster_repo)
+
+    image_repo.put_many([
+        _new_image("a", ["a"]),
+        _new_image("ab", ["a", "b"]),
+        _new_image("b", ["b"]),
+        _new_image("none", []),
+    ])
+    face_cluster_repo.put("f", FaceCluster(id="f", label=None, faces=[FaceClusterFace(image_id="ab", index=0, embedding_hash="")]))
+    queries = ["a", "a b", "a -b", "-b", "", "face:f", "a -face:f", "unknown", "-unknown"]
+    _assert_same_as_sql(image_repo, tag_index, queries)
+    assert dict(tag_index.tag_counts(TagQuery.parse("a"))) == {"a": 2, "b": 1}
+
+    # changes after the snapshot was built
+    image_repo.put_many([_new_image("ab", ["a"]), _new_image("new", ["b", "c"])])
+    _assert_same_as_sql(image_repo, tag_index, queries + ["c"])
+    assert dict(tag_index.tag_counts(TagQuery.parse("b"))) == {"b": 2, "c": 1}
+
+    tag_index.refresh()
+    _assert_same_as_sql(image_repo, tag_index, queries + ["c"])
+    assert dict(tag_index.tag_counts(TagQuery.parse("b"))) == {"b": 2, "c": 1}
+
+    # face cluster changes after the snapshot was built
+    face_cluster_repo.put("f", FaceCluster(id="f", label=None, faces=[FaceClusterFace(image_id="b", index=0, embedding_hash="")]))
+    face_cluster_repo.put("g", FaceCluster(id="g", label=None, faces=[FaceClusterFace(image_id="a", index=0, embedding_hash="")]))
+    _assert_same_as_sql(image_repo, tag_index, queries + ["face:g", "face:f -face:g", "b face:f"])
+    assert tag_index.list_ids(TagQuery.parse("face:f")) == ["b"]
+
+
+def test_tag_index_rebuilds_only_when_changed():
+    engine = create_engine("sqlite://", echo=True)
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+    tag_index = TagIndex(image_repo, FaceClusterRepo(db))
+    tag_index.refresh_seconds = 0
+
+    image_repo.put_many([_new_image("a", ["a"])])
+    assert tag_index.list_ids(TagQuery.parse("a")) == ["a"]
+    assert not tag_index._is_stale()
+
+    image_repo.put_many([_new_image("b", ["a"])])
+    assert tag_index._is_stale()
+
+
+def test_tag_index_rebuilds_in_background():
+    # the same in-memory database from the rebuilding thread
+    engine = create_engine("sqlite://", echo=True, poolclass=StaticPool, connect_args={"check_same_thread": False})
+    db = Database(engine)
+    metadata.create_all(engine)
+    image_repo = ImageRepo(db)
+    tag_index = TagIndex(image_repo, FaceClusterRepo(db))
+    tag_index.max_changed_images = 0
+
+    image_repo.put_many([_new_image("a", ["a"])])
+    assert tag_index.list_ids(TagQuery.parse("a")) == ["a"]
+    snapshot = tag_index._snapshot
+
+    image_repo.put_many([_new_image("b", ["a"])])
+    # served by the old snapshot and the changed images while rebuilding
+    assert set(tag_index.list_ids(TagQuery.parse("a"))) == {"a", "b"}
+    with tag_index._build_lock:
+        assert tag_index._snapshot is not snapshot
+    assert set(tag_index.list_ids(TagQuery.parse("a"))) == {"a", "b"}
+
+
+def _assert_same_as_sql(image_repo: ImageRepo, tag_index: TagIndex, queries: List[str]):
+    for q in queries:
+        query = TagQuery.parse(q)
+        expected = set(image_repo.list_ids_by_tag(query))
+        assert set(tag_index.list_ids(query)) == expected, q
+        assert set(key.decode() for key in tag_index.list_id_keys(query)) == expected, q
+        assert tag_index.count(query) == len(expected), q
+
+
+def _new_image(id: str, tags: List[str]):
+    return Image(
+        id=id,
+        local_filename="",
+        collected_at=datetime.datetime.now(),
+        source_url=None,
+        tweet_id=None,
+        tags=[ImageTag(tag=tag, type=None) for tag in tags],
+    )
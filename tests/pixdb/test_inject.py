@@ -31,6 +31,15 @@ def test_auto_instantiation():
     assert graph.get_instance(B) is a.b
 
 
+def test_create_instance():
+    graph = Graph()
+    b = graph.get_instance(B)
+    a = graph.create_instance(A)
+    assert a.b is b
+    assert graph.create_instance(A) is not a
+    assert graph.get_instance(A) is not a
+
+
 def test_bind_instance():
     graph = Graph()
     b = B()
@@ -1,7 +1,7 @@
 import datetime
 from typing import List
 from pydantic import BaseModel
-from sqlalchemy import BigInteger, MetaData, String, create_engine, select
+from sqlalchemy import BigInteger, MetaData, String, create_engine, event, select
 from pixdb.db import Database
 
 from pixdb.schema import IndexField, Schema
@@ -58,6 +58,57 @@ def test_index():
     assert r == [("1", ), ("2", )]
 
 
+def test_get_many_put_many():
+    engine = create_engine("sqlite://", echo=True)
+    metadata.create_all(engine)
+
+    db = Database(engine)
+    image_repo = ImageRepo(db)
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    image1 = Image(id="1", created_at=now, tags=[ImageTag(name="red", score=0.5)])
+    image2 = Image(id="2", created_at=now - datetime.timedelta(days=1), tags=[])
+    image_repo.update(image1)
+
+    image1.tags.append(ImageTag(name="big", score=0.44))
+    image2.tags.append(ImageTag(name="big", score=0.1))
+    image_repo.put_many([image1, image2])
+
+    assert image_repo.get_many(["2", "missing", "1"]) == {"1": image1, "2": image2}
+
+    idx_tag = ImageRepo.idx_tag
+    r = db.execute(
+        select(idx_tag.c.tag, idx_tag.c.id)
+            .order_by(idx_tag.c.tag, idx_tag.c.id)
+    ).all()
+    assert r == [("big", "1"), ("big", "2"), ("red", "1")]
+
+
+def test_put_only_touches_changed_index_rows():
+    engine = create_engine("sqlite://", echo=True)
+    metadata.create_all(engine)
+
+    db = Database(engine)
+    image_repo = ImageRepo(db)
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    image = Image(id="1", created_at=now, tags=[ImageTag(name="red", score=0.5), ImageTag(name="big", score=0.44)])
+    image_repo.update(image)
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement))
+
+    image.tags[1].score = 0.9  # entries unchanged for idx_tag and idx_created_at
+    image_repo.update(image)
+    assert not any(ImageRepo.idx_tag.table.name in statement for statement in statements)
+    assert not any(ImageRepo.idx_created_at.table.name in statement for statement in statements)
+
+    image.tags = [ImageTag(name="red", score=0.5), ImageTag(name="small", score=0.3)]
+    image_repo.update(image)
+
+    idx_tag = ImageRepo.idx_tag
+    r = db.execute(select(idx_tag.c.tag, idx_tag.c.id).order_by(idx_tag.c.tag)).all()
+    assert r == [("red", "1"), ("small", "1")]
+
+
 metadata = MetaData()
 
 